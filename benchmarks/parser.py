@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark for parsing messages received from backends.
+
+Compares nuqql.backend.parse_msg() with the previous split based parser on
+synthetic traffic or on recorded traffic. Recorded traffic is a capture file
+of the "capture" command, only received messages are used, or a file with
+one raw protocol line per line.
+
+Usage: benchmarks/parser.py [<traffic file>]
+"""
+
+import html
+import os
+import random
+import re
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import nuqql.backend    # noqa: E402
+
+
+###################
+# Previous parser #
+###################
+
+def old_parse_message_msg(orig_msg):
+    """
+    Previous "message" parser
+    """
+
+    orig_msg = orig_msg[9:]
+    part = orig_msg.split(" ")
+    acc = part[0]
+    acc_name = part[1]
+    tstamp = part[2]
+    sender = part[3]
+    msg = " ".join(part[4:])
+    msg = "\n".join(re.split("<br/>", msg, flags=re.IGNORECASE))
+    msg = html.unescape(msg)
+
+    return "message", acc, acc_name, int(tstamp), sender, msg
+
+
+def old_parse_buddy_msg(orig_msg):
+    """
+    Previous "buddy" parser
+    """
+
+    orig_msg = orig_msg[7:]
+    part = orig_msg.split(" ")
+    return "buddy", part[0], part[2], part[4], part[6]
+
+
+def old_parse_status_msg(orig_msg):
+    """
+    Previous "status" parser
+    """
+
+    part = orig_msg[9:].split(" ")
+    return "status", part[1], part[3]
+
+
+def old_parse_account_msg(orig_msg):
+    """
+    Previous "account" parser
+    """
+
+    part = orig_msg[9:].split(" ")
+    return "account", part[0], part[1], part[2].lower(), part[3], part[4]
+
+
+OLD_PARSE_FUNCTIONS = {
+    "message:": old_parse_message_msg,
+    "collect:": old_parse_message_msg,
+    "buddy:": old_parse_buddy_msg,
+    "account:": old_parse_account_msg,
+    "status:": old_parse_status_msg,
+    "info:": lambda msg: ("info", msg[6:]),
+    "error:": lambda msg: ("error", msg[7:]),
+}
+
+
+def old_parse_msg(orig_msg):
+    """
+    Previous message parser
+    """
+
+    msg_type = orig_msg.split(maxsplit=1)[0]
+    try:
+        return OLD_PARSE_FUNCTIONS[msg_type](orig_msg)
+    except KeyError:
+        return "parsing error", "-1", "error", int(time.time()), \
+            "<backend>", "Error parsing message: " + orig_msg
+
+
+###########
+# Traffic #
+###########
+
+def get_synthetic_traffic(num_lines):
+    """
+    Create synthetic traffic: mostly buddy updates and plain messages, some
+    messages with line breaks and html entities
+    """
+
+    rand = random.Random(0)
+    lines = []
+    for i in range(num_lines):
+        kind = rand.random()
+        buddy = "buddy{}@example.com".format(rand.randrange(1000))
+        if kind < 0.6:
+            status = rand.choice(("Available", "Away", "Offline"))
+            lines.append("buddy: 0 status: {} name: {} alias: {}".format(
+                status, buddy, buddy.split("@")[0]))
+        elif kind < 0.9:
+            lines.append("message: 0 me@example.com {} {} hello there, "
+                         "this is message number {}".format(
+                             1571234567 + i, buddy, i))
+        elif kind < 0.97:
+            lines.append("message: 0 me@example.com {} {} line one<br/>"
+                         "line &lt;two&gt; &amp; three".format(
+                             1571234567 + i, buddy))
+        else:
+            lines.append("status: account 0 status: available")
+    return lines
+
+
+def read_traffic(file_name):
+    """
+    Read recorded traffic from capture file or file with raw protocol lines
+    """
+
+    with open(file_name) as in_file:
+        lines = [line.rstrip("\r\n") for line in in_file if line.strip()]
+
+    # capture files contain [timestamp, direction, message] JSON records
+    if lines and lines[0].startswith("["):
+        return [msg for unused_tstamp, msg in
+                nuqql.backend.read_capture(file_name)]
+    return lines
+
+
+def main():
+    """
+    Run benchmark
+    """
+
+    if len(sys.argv) > 1:
+        lines = read_traffic(sys.argv[1])
+    else:
+        lines = get_synthetic_traffic(100000)
+
+    def run_old():
+        for line in lines:
+            old_parse_msg(line)
+
+    def run_new():
+        for line in lines:
+            nuqql.backend.parse_msg(line)
+
+    old = min(timeit.repeat(run_old, number=1, repeat=5))
+    new = min(timeit.repeat(run_new, number=1, repeat=5))
+    print("lines: {}".format(len(lines)))
+    print("old parser: {:.3f} s ({:.0f} ns/line)".format(
+        old, old / len(lines) * 1e9))
+    print("new parser: {:.3f} s ({:.0f} ns/line)".format(
+        new, new / len(lines) * 1e9))
+    print("speedup: {:.2f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
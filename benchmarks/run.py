@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for nuqql's hot paths: parsing backend messages, routing
+messages to conversations, buddy updates, loading history files, redrawing
+log windows and the conversation list, and sorting the conversation list.
+
+Every benchmark runs with synthetic data at several scales (number of
+messages, buddies or conversations). Results are written as JSON and can be
+saved as a baseline and compared against it. nuqql writes history files, so
+the benchmarks run with a temporary home directory. Windows are rendered on
+an in-memory stub screen, so no terminal is needed; rendering benchmarks
+also report frames and bytes written per run.
+
+Usage: benchmarks/run.py [--scales N [N ...]] [--only NAME [NAME ...]]
+                         [--output FILE] [--save] [--compare]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# run with a temporary home directory, nuqql writes its files there
+HOME = tempfile.mkdtemp(prefix="nuqql-bench-")
+os.environ["HOME"] = HOME
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import nuqql.backend        # noqa: E402
+import nuqql.config         # noqa: E402
+import nuqql.conversation   # noqa: E402
+import nuqql.history        # noqa: E402
+import nuqql.stubscreen     # noqa: E402
+import nuqql.ui             # noqa: E402
+import nuqql.win            # noqa: E402
+
+# default scales: number of messages, buddies, or conversations
+SCALES = [1000, 10000, 100000]
+
+# fixed number of operations for benchmarks that run against N items
+OPS = 1000
+
+# number of runs of each benchmark, the fastest run is reported
+REPEAT = 3
+
+# baseline file and allowed slowdown compared to baseline before a result is
+# reported as a regression
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+THRESHOLD = 0.2
+
+# stub screen size for rendering benchmarks
+SCREEN_Y = 50
+SCREEN_X = 160
+
+# stub screen for rendering benchmarks
+SCREEN = nuqql.stubscreen.install(SCREEN_Y, SCREEN_X)
+
+
+class NullWin:
+    """
+    Window replacement for conversations in benchmarks that do not render
+    """
+
+    def redraw(self):
+        """
+        Do not redraw anything
+        """
+
+    def redraw_pad(self):
+        """
+        Do not redraw anything
+        """
+
+
+###########
+# Helpers #
+###########
+
+def get_traffic(num_lines):
+    """
+    Create synthetic backend traffic: mostly buddy updates and plain
+    messages, some messages with line breaks and html entities
+    """
+
+    rand = random.Random(0)
+    lines = []
+    for i in range(num_lines):
+        kind = rand.random()
+        buddy = "buddy{}@example.com".format(rand.randrange(1000))
+        if kind < 0.6:
+            status = rand.choice(("Available", "Away", "Offline"))
+            lines.append("buddy: 0 status: {} name: {} alias: {}".format(
+                status, buddy, buddy.split("@")[0]))
+        elif kind < 0.9:
+            lines.append("message: 0 me@example.com {} {} hello there, "
+                         "this is message number {}".format(
+                             1571234567 + i, buddy, i))
+        elif kind < 0.97:
+            lines.append("message: 0 me@example.com {} {} line one<br/>"
+                         "line &lt;two&gt; &amp; three".format(
+                             1571234567 + i, buddy))
+        else:
+            lines.append("status: account 0 status: available")
+    return lines
+
+
+def get_buddy_name(index):
+    """
+    Get name of buddy number index
+    """
+
+    return "buddy{}@example.com".format(index)
+
+
+def create_account(num_buddies):
+    """
+    Create a backend with an account with num_buddies buddies and a buddy
+    conversation for each buddy. Conversations do not render and share a
+    single history logger and history file.
+    """
+
+    backend = nuqql.backend.Backend("bench")
+    account = nuqql.backend.Account("0", "bench", "me@example.com")
+    backend.accounts[account.aid] = account
+    log_file = os.path.join(HOME, "history")
+    logger = nuqql.history.get_logger("bench", log_file)
+
+    convs = []
+    for i in range(num_buddies):
+        name = get_buddy_name(i)
+        buddy = nuqql.backend.Buddy(backend, account, name)
+        buddy.update("Available", name.split("@")[0])
+        account.buddies.append(buddy)
+        account.buddy_index[name] = buddy
+
+        # create conversation without the per conversation logger
+        conv = nuqql.conversation.BuddyConversation.__new__(
+            nuqql.conversation.BuddyConversation)
+        nuqql.conversation.Conversation.__init__(conv, backend, account, name)
+        conv.peers = [buddy]
+        conv.wins.list_win = NullWin()
+        conv.history.logger = logger
+        conv.history.log_file = log_file
+        convs.append(conv)
+
+    return backend, account, convs
+
+
+def create_log(num_msgs):
+    """
+    Create num_msgs log messages
+    """
+
+    rand = random.Random(0)
+    log = []
+    tstamp = 1571234567
+    for i in range(num_msgs):
+        own = rand.random() < 0.3
+        sender = "you" if own else "buddy@example.com"
+        msg = "this is message number {}".format(i)
+        log_msg = nuqql.history.LogMessage(
+            tstamp + i, sender, msg, own=own)
+        log_msg.is_read = True
+        log.append(log_msg)
+    return log
+
+
+##############
+# Benchmarks #
+##############
+
+def bench_parse_msg(scale):
+    """
+    Parse scale messages received from a backend
+    """
+
+    lines = get_traffic(scale)
+
+    def run():
+        for line in lines:
+            nuqql.backend.parse_msg(line)
+
+    return scale, run
+
+
+def bench_handle_message(scale):
+    """
+    Route OPS messages to scale buddy conversations and log them
+    """
+
+    backend, unused_account, convs = create_account(scale)
+    rand = random.Random(0)
+    senders = [get_buddy_name(rand.randrange(scale)) for _ in range(OPS)]
+
+    def run():
+        nuqql.conversation.CONVERSATIONS[:] = convs
+        for sender in senders:
+            nuqql.ui.handle_message(backend, "0", 1571234567, sender,
+                                    "hello there")
+
+    return OPS, run
+
+
+def bench_update_buddy(scale):
+    """
+    Update OPS buddies of an account with scale buddies and conversations
+    """
+
+    backend, account, convs = create_account(scale)
+    rand = random.Random(0)
+    updates = []
+    for i in range(OPS):
+        name = get_buddy_name(rand.randrange(scale))
+        status = ("Available", "Away")[i % 2]
+        updates.append((name, name.split("@")[0], status))
+
+    def run():
+        nuqql.conversation.CONVERSATIONS[:] = convs
+        for name, alias, status in updates:
+            account.update_buddy(backend, name, alias, status)
+
+    return OPS, run
+
+
+def bench_init_log_from_file(scale):
+    """
+    Load a history file with scale messages
+    """
+
+    unused_backend, unused_account, convs = create_account(1)
+    conv = convs[0]
+    conv.history.log_file = nuqql.history.get_conv_path(conv) + \
+        nuqql.history.HISTORY_FILE
+    with open(conv.history.log_file, "wb") as out_file:
+        out_file.write(nuqql.history.HISTORY_HEADER)
+        for log_msg in create_log(scale):
+            line = nuqql.history.create_log_line(log_msg) + "\r\n"
+            out_file.write(line.encode())
+
+    def run():
+        conv.history.log = nuqql.history.LogStore()
+        nuqql.history.init_log_from_file(conv)
+
+    return scale, run
+
+
+def bench_log_win_redraw(scale):
+    """
+    Redraw a log window with scale messages
+    """
+
+    unused_backend, unused_account, convs = create_account(1)
+    conv = convs[0]
+    log_win = nuqql.win.LogWin(nuqql.config.get("log_win"), conv, "bench")
+    log_win.list = nuqql.history.LogStore(create_log(scale))
+
+    def run():
+        log_win.redraw()
+
+    return 1, run
+
+
+def bench_list_win_redraw(scale):
+    """
+    Redraw a list window with scale buddy conversations
+    """
+
+    unused_backend, unused_account, convs = create_account(scale)
+    list_win = nuqql.win.ListWin(nuqql.config.get("list_win"), None, "bench")
+    list_win.list = convs
+
+    def run():
+        list_win.redraw_pad()
+
+    return 1, run
+
+
+def bench_list_win_sort(scale):
+    """
+    Sort a conversation list with scale buddy conversations
+    """
+
+    unused_backend, unused_account, convs = create_account(scale)
+    rand = random.Random(0)
+    for conv in convs:
+        conv.peers[0].status = rand.choice(("on", "afk", "off"))
+        conv.notification = int(rand.random() < 0.01)
+    rand.shuffle(convs)
+
+    def run():
+        conv_list = convs[:]
+        conv_list.sort()
+
+    return scale, run
+
+
+BENCHMARKS = {
+    "parse_msg": bench_parse_msg,
+    "handle_message": bench_handle_message,
+    "update_buddy": bench_update_buddy,
+    "init_log_from_file": bench_init_log_from_file,
+    "log_win_redraw": bench_log_win_redraw,
+    "list_win_redraw": bench_list_win_redraw,
+    "list_win_sort": bench_list_win_sort,
+}
+
+
+###########
+# Running #
+###########
+
+def run_benchmark(bench, scale):
+    """
+    Run a single benchmark at a scale and return its result
+    """
+
+    ops, run = bench(scale)
+
+    SCREEN.reset()
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+
+    result = {
+        "ops": ops,
+        "time": best,
+        "per_op": best / ops,
+    }
+
+    # rendering statistics of one run
+    stats = SCREEN.get_stats()
+    if stats["frames"]:
+        result["frames"] = stats["frames"] / REPEAT
+        result["bytes"] = stats["bytes"] / REPEAT
+    return result
+
+
+def run_benchmarks(names, scales):
+    """
+    Run benchmarks and return results
+    """
+
+    results = {}
+    for name in names:
+        for scale in scales:
+            result = run_benchmark(BENCHMARKS[name], scale)
+            key = "{}/{}".format(name, scale)
+            results[key] = result
+            print("{:<30} {:>12.0f} ns/op".format(
+                key, result["per_op"] * 1e9), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results to baseline. Return list of regressions.
+    """
+
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result["per_op"] / baseline[key]["per_op"]
+        result["baseline_ratio"] = ratio
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = "REGRESSION"
+        print("{:<30} {:>6.2f}x baseline {}".format(key, ratio, flag),
+              file=sys.stderr)
+    return regressions
+
+
+def get_args():
+    """
+    Parse command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="nuqql benchmarks.")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES,
+                        help="number of messages/buddies/conversations")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--output", help="write JSON results to file")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help="baseline file")
+    parser.add_argument("--save", action="store_true",
+                        help="save results as baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare results to baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed slowdown compared to baseline")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run benchmarks
+    """
+
+    args = get_args()
+
+    # logging to history files goes to temporary home directory, make sure
+    # nothing is printed
+    logging.raiseExceptions = False
+
+    try:
+        results = run_benchmarks(args.only, args.scales)
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)
+
+    # compare with baseline
+    regressions = []
+    if args.compare:
+        with open(args.baseline) as in_file:
+            baseline = json.load(in_file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+
+    # output results
+    output = {
+        "python": sys.version.split()[0],
+        "scales": args.scales,
+        "results": results,
+    }
+    if args.save:
+        with open(args.baseline, "w") as out_file:
+            json.dump(output, out_file, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(output, out_file, indent=4, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=4, sort_keys=True))
+
+    if regressions:
+        print("Regressions: " + ", ".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+"""
+Fake backend for nuqql. It speaks nuqql's backend protocol on a UNIX socket
+and generates a synthetic workload, so nuqql can be load tested without real
+chat networks.
+"""
+
+import argparse
+import os
+import random
+import select
+import socket
+import sys
+import time
+
+from collections import deque
+
+# network buffer
+BUFFER_SIZE = 4096
+
+# words for random messages
+WORDS = ("hello", "there", "how", "are", "you", "today", "this", "is", "a",
+         "fake", "message", "with", "some", "random", "words", "nuqql",
+         "backend", "load", "test", "lorem", "ipsum", "dolor", "sit", "amet")
+
+
+class Account:
+    """
+    Class for fake accounts
+    """
+
+    def __init__(self, aid, num_buddies):
+        self.aid = aid
+        self.user = "fake{}@fake.example".format(aid)
+        self.status = "available"
+        self.buddies = []
+        for i in range(num_buddies):
+            self.buddies.append({
+                "name": "buddy{}-{}@fake.example".format(aid, i),
+                "alias": "Buddy{}-{}".format(aid, i),
+                "status": "Available",
+            })
+
+
+class Client:
+    """
+    Class for connected nuqql clients
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.in_buffer = ""
+        self.out_buffer = bytearray()
+
+
+class FakeBackend:
+    """
+    Class for the fake backend server
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.accounts = [Account(i, args.buddies)
+                         for i in range(args.accounts)]
+        self.clients = {}
+        self.server = None
+
+        # retained messages for collect
+        self.messages = deque(maxlen=args.retain)
+
+        # workload state
+        self.msg_credit = 0.0
+        self.churn_credit = 0.0
+        self.last_step = time.time()
+        self.next_burst = time.time() + args.burst_interval
+
+    def start(self):
+        """
+        Start listening on UNIX socket
+        """
+
+        sock_file = os.path.join(self.args.dir, self.args.sockfile)
+        os.makedirs(self.args.dir, exist_ok=True)
+        if os.path.exists(sock_file):
+            os.unlink(sock_file)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(sock_file)
+        self.server.listen()
+
+    def send(self, client, line):
+        """
+        Queue line for sending to client
+        """
+
+        client.out_buffer += (line + "\r\n").encode()
+
+    def broadcast(self, line):
+        """
+        Queue line for sending to all clients
+        """
+
+        for client in self.clients.values():
+            self.send(client, line)
+
+    def get_account(self, aid):
+        """
+        Get account by id string
+        """
+
+        try:
+            return self.accounts[int(aid)]
+        except (ValueError, IndexError):
+            return None
+
+    def random_text(self):
+        """
+        Create random message text, some with line breaks and html entities
+        """
+
+        words = [self.rand.choice(WORDS)
+                 for _ in range(self.rand.randint(1, 20))]
+        text = " ".join(words)
+        kind = self.rand.random()
+        if kind < 0.05:
+            text += "<br/>" + " ".join(words[:3])
+        elif kind < 0.1:
+            text += " &lt;3 &amp; more"
+        return text
+
+    def new_message(self):
+        """
+        Create a new message from a random buddy and send it to clients
+        """
+
+        acc = self.rand.choice(self.accounts)
+        if not acc.buddies:
+            return
+        buddy = self.rand.choice(acc.buddies)
+        msg = (acc.aid, int(time.time()), buddy["name"], self.random_text())
+        self.messages.append(msg)
+        self.broadcast(self.format_message(acc, msg))
+
+    def format_message(self, acc, msg):
+        """
+        Format message line
+        """
+
+        aid, tstamp, sender, text = msg
+        return "message: {} {} {} {} {}".format(aid, acc.user, tstamp, sender,
+                                                text)
+
+    @staticmethod
+    def format_buddy(acc, buddy):
+        """
+        Format buddy line
+        """
+
+        return "buddy: {} status: {} name: {} alias: {}".format(
+            acc.aid, buddy["status"], buddy["name"], buddy["alias"])
+
+    def churn(self):
+        """
+        Change status of a random buddy and send it to clients
+        """
+
+        acc = self.rand.choice(self.accounts)
+        if not acc.buddies:
+            return
+        buddy = self.rand.choice(acc.buddies)
+        buddy["status"] = self.rand.choice(("Available", "Away", "Offline"))
+        self.broadcast(self.format_buddy(acc, buddy))
+
+    def step(self):
+        """
+        Generate workload since last step
+        """
+
+        now = time.time()
+        delta = now - self.last_step
+        self.last_step = now
+
+        # messages and presence churn at configured rates
+        self.msg_credit += self.args.rate * delta
+        while self.msg_credit >= 1:
+            self.msg_credit -= 1
+            self.new_message()
+        self.churn_credit += self.args.churn * delta
+        while self.churn_credit >= 1:
+            self.churn_credit -= 1
+            self.churn()
+
+        # message bursts
+        if self.args.burst_interval > 0 and now >= self.next_burst:
+            self.next_burst = now + self.args.burst_interval
+            for _ in range(self.args.burst_size):
+                self.new_message()
+
+    def handle_account_command(self, client, parts):
+        """
+        Handle "account" command
+        """
+
+        # account list
+        if parts[1] == "list":
+            for acc in self.accounts:
+                self.send(client, "account: {0} fake{0} fake {1} [{2}]".format(
+                    acc.aid, acc.user, acc.status))
+            self.send(client, "info: listed accounts.")
+            return
+
+        acc = self.get_account(parts[1])
+        if acc is None or len(parts) < 3:
+            self.send(client, "error: invalid account")
+            return
+        command = parts[2]
+
+        # account <id> buddies
+        if command == "buddies":
+            for buddy in acc.buddies:
+                self.send(client, self.format_buddy(acc, buddy))
+            return
+
+        # account <id> collect <tstamp>
+        if command == "collect":
+            tstamp = 0
+            if len(parts) > 3:
+                try:
+                    tstamp = int(parts[3])
+                except ValueError:
+                    pass
+            for msg in self.messages:
+                if msg[0] == acc.aid and msg[1] >= tstamp:
+                    self.send(client, self.format_message(acc, msg))
+            return
+
+        # account <id> send <buddy> <msg>
+        if command == "send":
+            return
+
+        # account <id> status get|set [<status>]
+        if command == "status" and len(parts) > 3:
+            if parts[3] == "set" and len(parts) > 4:
+                acc.status = parts[4]
+            self.send(client, "status: account {} status: {}".format(
+                acc.aid, acc.status))
+            return
+
+        self.send(client, "error: unknown command")
+
+    def handle_line(self, client, line):
+        """
+        Handle command line from client
+        """
+
+        parts = line.split(" ", 4)
+        if parts[0] == "account" and len(parts) > 1:
+            self.handle_account_command(client, parts)
+            return
+        if parts[0] in ("bye", "quit"):
+            self.close(client)
+            return
+        self.send(client, "error: unknown command")
+
+    def close(self, client):
+        """
+        Close client connection
+        """
+
+        del self.clients[client.sock]
+        client.sock.close()
+
+    def handle_read(self, sock):
+        """
+        Handle readable socket
+        """
+
+        # new client
+        if sock is self.server:
+            conn, unused_addr = self.server.accept()
+            self.clients[conn] = Client(conn)
+            return
+
+        # read commands from client
+        client = self.clients[sock]
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            self.close(client)
+            return
+        client.in_buffer += data.decode(errors="replace")
+        while "\r\n" in client.in_buffer:
+            line, client.in_buffer = client.in_buffer.split("\r\n", 1)
+            self.handle_line(client, line)
+
+    def handle_write(self, sock):
+        """
+        Handle writable socket
+        """
+
+        client = self.clients.get(sock)
+        if client is None:
+            return
+        try:
+            sent = sock.send(client.out_buffer)
+        except OSError:
+            self.close(client)
+            return
+        del client.out_buffer[:sent]
+
+    def run(self):
+        """
+        Run the fake backend
+        """
+
+        self.start()
+        while True:
+            reads = [self.server] + list(self.clients)
+            writes = [sock for sock, client in self.clients.items()
+                      if client.out_buffer]
+            readable, writable, unused_errs = select.select(
+                reads, writes, [], self.args.tick)
+            for sock in readable:
+                self.handle_read(sock)
+            for sock in writable:
+                self.handle_write(sock)
+            self.step()
+
+
+def get_args():
+    """
+    Parse command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description="Fake backend for nuqql.")
+    parser.add_argument("--af", choices=["unix"], default="unix",
+                        help="socket address family")
+    parser.add_argument("--dir", default=".", help="working directory")
+    parser.add_argument("--sockfile", default="fakebackend.sock",
+                        help="socket file in working directory")
+    parser.add_argument("--accounts", type=int, default=1,
+                        help="number of accounts")
+    parser.add_argument("--buddies", type=int, default=100,
+                        help="number of buddies per account")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="messages per second")
+    parser.add_argument("--churn", type=float, default=1.0,
+                        help="buddy status changes per second")
+    parser.add_argument("--burst-interval", type=float, default=0,
+                        help="seconds between message bursts, 0 disables")
+    parser.add_argument("--burst-size", type=int, default=100,
+                        help="messages per burst")
+    parser.add_argument("--retain", type=int, default=10000,
+                        help="messages retained for collect")
+    parser.add_argument("--tick", type=float, default=0.01,
+                        help="workload generation interval in seconds")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="random seed")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main entry point
+    """
+
+    backend = FakeBackend(get_args())
+    try:
+        backend.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
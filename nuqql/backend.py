@@ -6,29 +6,150 @@ Backend part of nuqql.
 # NETWORK PART #
 ################
 
+import logging.handlers
+import asyncio
+import codecs
 import subprocess
+import threading
 import socket
 import select
 import shutil
 import time
+import random
+import json
 import html
 import os
+import queue
 import re
 
+from collections import Counter, deque, namedtuple
+from functools import partial
 from pathlib import Path
+from types import SimpleNamespace
 
 import nuqql.conversation
+import nuqql.history
+import nuqql.stats
 import nuqql.ui
+import nuqql.watchdog
 
 # network buffer
 BUFFER_SIZE = 4096
 
-# update buddies only every BUDDY_UPDATE_TIMER seconds
+# update buddies every BUDDY_UPDATE_TIMER seconds after activity. If the
+# buddy list did not change, back off up to BUDDY_UPDATE_TIMER_MAX seconds.
+# If the backend pushes buddy updates, only reconcile the buddy list every
+# BUDDY_RECONCILE_TIMER seconds. Spread updates of accounts with a random
+# jitter of BUDDY_UPDATE_JITTER times the update interval.
 BUDDY_UPDATE_TIMER = 5
+BUDDY_UPDATE_TIMER_MAX = 120
+BUDDY_RECONCILE_TIMER = 300
+BUDDY_UPDATE_JITTER = 0.2
+
+# a reply to a buddy list request starts at most BUDDY_REPLY_TIMEOUT seconds
+# after the request and ends when no buddy message is received for
+# BUDDY_REPLY_TIME seconds. Buddy messages received while no reply is
+# outstanding are considered as pushed by the backend. After
+# BUDDY_PUSH_THRESHOLD pushed buddy messages, the backend is considered to
+# push buddy updates until a whole update cycle passes without pushes.
+BUDDY_REPLY_TIMEOUT = 10
+BUDDY_REPLY_TIME = 2
+BUDDY_PUSH_THRESHOLD = 3
+
+# wait at most BACKEND_START_TIMEOUT seconds for backends to accept
+# connections; retry connecting with a backoff between
+# BACKEND_START_BACKOFF_MIN and BACKEND_START_BACKOFF_MAX seconds
+BACKEND_START_TIMEOUT = 10
+BACKEND_START_BACKOFF_MIN = 0.01
+BACKEND_START_BACKOFF_MAX = 0.5
+
+# keep the last SERVER_OUTPUT_LINES lines of each backend server's
+# stdout/stderr output in memory
+SERVER_OUTPUT_LINES = 1000
+
+# optionally, also write backend server's output to a rotating file in the
+# server's working directory
+SERVER_OUTPUT_FILE = ""     # e.g., "output.log"; empty string disables it
+SERVER_OUTPUT_FILE_SIZE = 1024 * 1024
+SERVER_OUTPUT_FILE_COUNT = 3
+
+# restart crashed backend servers and reconnect lost clients with an
+# exponential backoff between SUPERVISOR_BACKOFF_MIN and
+# SUPERVISOR_BACKOFF_MAX seconds. If a backend stays up for at least
+# SUPERVISOR_STABLE_TIME seconds, the backoff is reset.
+SUPERVISOR_BACKOFF_MIN = 1
+SUPERVISOR_BACKOFF_MAX = 60
+SUPERVISOR_STABLE_TIME = 60
+
+# write high-water marks of received messages at most every
+# COLLECT_SAVE_TIMER seconds
+COLLECT_SAVE_TIMER = 5
+
+# messages received while collecting messages of an account are ingested in
+# bulk: they are not painted, and history writes and notifications are
+# batched. A collect burst ends after COLLECT_QUIET_TIME seconds without
+# messages of the account or after COLLECT_MAX_TIME seconds.
+COLLECT_QUIET_TIME = 0.5
+COLLECT_MAX_TIME = 10
+
+# directory for capture files of backend traffic
+CAPTURE_DIR = str(Path.home()) + "/.config/nuqql/captures"
+
+# environment variable that enables the fake backend for load testing and
+# contains its workload arguments
+FAKEBACKEND_ENV = "NUQQL_FAKEBACKEND"
+
+# handle at most NETWORK_MSG_BUDGET messages or NETWORK_BYTE_BUDGET bytes of
+# messages per backend and wakeup, so a flooding backend cannot starve other
+# backends and user input
+NETWORK_MSG_BUDGET = 100
+NETWORK_BYTE_BUDGET = 64 * 1024
+
+# received messages are handled by priority: chat messages first, then
+# account, status, info and error messages, then buddy presence updates; the
+# presence priority is the lowest one
+MSG_PRIORITY_DEFAULT = 1
+MSG_PRIORITY_PRESENCE = 2
+MSG_PRIORITIES = {
+    "message": 0,
+    "buddy": MSG_PRIORITY_PRESENCE,
+}
+
+# maximum number of parsed messages waiting for handling per backend; if it
+# is reached, no more data is read from the backend until it drains
+INBOX_SIZE = 10000
+
+# if more than PRESENCE_COLLAPSE_THRESHOLD presence updates are waiting for
+# handling, updates of the same buddy are collapsed, the last update wins
+PRESENCE_COLLAPSE_THRESHOLD = 1000
+
+# network thread: maximum number of parsed messages queued per backend for
+# the main loop, and timeout in seconds for noticing new and reconnected
+# clients
+IO_QUEUE_SIZE = 10000
+IO_SELECT_TIMEOUT = 0.05
 
 # dictionary for all active backends
 BACKENDS = {}
 
+# state of network handling: backend handled first in the next wakeup, it is
+# rotated round-robin, and callback for waking up the asyncio event loop when
+# backends need supervision or polling, see nuqql.eventloop
+NETWORK = SimpleNamespace(start=0, wake=None)
+
+# state of the network thread, see start_io_thread()
+IO = SimpleNamespace(
+    # network thread and event for stopping it
+    thread=None,
+    stop=threading.Event(),
+    # queues of (parsed message, receive time, parse time, message size)
+    # tuples per backend name
+    queues={},
+    # self-pipe for waking up the main loop
+    wake_read=None,
+    wake_write=None,
+)
+
 
 class BackendServer:
     """
@@ -40,6 +161,11 @@ class BackendServer:
         self.proc = None
         self.server_path = path
         self.server_cmd = cmd
+        self.start_time = 0
+
+        # ring buffer and optional logger for server's stdout/stderr output
+        self.output = deque(maxlen=SERVER_OUTPUT_LINES)
+        self.output_logger = None
 
     def start(self):
         """
@@ -49,7 +175,9 @@ class BackendServer:
         # make sure server's working directory exists
         Path(self.server_path).mkdir(parents=True, exist_ok=True)
 
-        # start server process
+        # start server process, do not wait for it. Clients retry connecting
+        # until the server is ready, see BackendClient.try_start()
+        self.start_time = time.time()
         self.proc = subprocess.Popen(
             self.server_cmd,
             shell=True,
@@ -58,8 +186,64 @@ class BackendServer:
             start_new_session=True,     # dont send SIGINT from nuqql to
                                         # subprocess
         )
-        # give it some time
-        time.sleep(1)
+
+        # drain server's stdout and stderr, so it never blocks on full pipes
+        if SERVER_OUTPUT_FILE and self.output_logger is None:
+            self.output_logger = get_output_logger(
+                self.server_path + "/" + SERVER_OUTPUT_FILE)
+        for name, pipe in (("stdout", self.proc.stdout),
+                           ("stderr", self.proc.stderr)):
+            thread = threading.Thread(target=self._read_output,
+                                      args=(name, pipe), daemon=True)
+            thread.start()
+
+        # let the event loop know when the server exits
+        thread = threading.Thread(target=self._wait_exit, args=(self.proc, ),
+                                  daemon=True)
+        thread.start()
+
+    def _read_output(self, name, pipe):
+        """
+        Read output lines from the server's pipe and store them in the output
+        ring buffer. Runs in its own thread until the pipe is closed.
+        """
+
+        # limit line length, so output without newlines cannot fill memory
+        for line in iter(lambda: pipe.readline(BUFFER_SIZE), b""):
+            line = line.decode(errors="replace").rstrip("\r\n")
+            self.output.append((time.time(), name, line))
+            if self.output_logger:
+                self.output_logger.info("%s: %s", name, line)
+        pipe.close()
+
+    @staticmethod
+    def _wait_exit(proc):
+        """
+        Wait for the server process proc to exit and wake up the event loop,
+        so it supervises the backend. Runs in its own thread.
+        """
+
+        proc.wait()
+        _wake_event_loop()
+
+    def get_output(self, num_lines=SERVER_OUTPUT_LINES):
+        """
+        Get the last num_lines output lines of the server as a list of
+        (timestamp, pipe name, line) tuples
+        """
+
+        # copy ring buffer first, it is modified by the reader threads
+        output = list(self.output)
+        if num_lines <= 0:
+            return []
+        return output[-num_lines:]
+
+    def is_running(self):
+        """
+        Check if the backend's server process is still running
+        """
+
+        return self.proc is not None and self.proc.poll() is None
 
     def stop(self):
         """
@@ -67,7 +251,8 @@ class BackendServer:
         """
 
         # stop running server
-        self.proc.terminate()
+        if self.is_running():
+            self.proc.terminate()
 
 
 class BackendClient:
@@ -76,6 +261,9 @@ class BackendClient:
     local or remote backend server process
     """
 
+    # can the network thread read from this client? See start_io_thread()
+    threaded = True
+
     def __init__(self, sock_af=socket.AF_UNIX, ip_addr="127.0.0.1", port=32000,
                  sock_file=""):
         # client
@@ -86,53 +274,254 @@ class BackendClient:
         self.port = port
         self.buffer = ""
 
+        # decoder for received data, characters can be split over multiple
+        # reads
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        # receive times of the complete lines in the buffer and of the last
+        # returned message, for latency tracing
+        self.stamps = deque()
+        self.msg_stamp = None
+
+        # lock for socket, buffer and capture file; only needed if the
+        # network thread reads from this client, see start_io_thread()
+        self.lock = threading.Lock()
+
+        # asyncio protocol and transport, if the asyncio event loop reads
+        # from this client, see attach_clients()
+        self.protocol = None
+        self.transport = None
+
+        # capture file for recording traffic
+        self.capture = None
+
     def start(self):
         """
         Start the backend's client
         """
 
         # open sockets and connect
+        sock = None
         if self.sock_af == socket.AF_INET:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.ip_addr, self.port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._connect(sock, (self.ip_addr, self.port))
         elif self.sock_af == socket.AF_UNIX:
-            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.sock.connect(self.sock_file)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._connect(sock, self.sock_file)
+
+        # reset buffer, it could contain parts of messages from an old
+        # connection
+        with self.lock:
+            self.buffer = ""
+            self.decoder.reset()
+            self.stamps.clear()
+            self.sock = sock
+
+    @staticmethod
+    def _connect(sock, address):
+        """
+        Helper for connecting sock to address, sock is closed on error
+        """
+
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+
+    def try_start(self):
+        """
+        Try to start the backend's client. Return True if the connection to
+        the server was established, False if the server is not ready yet,
+        e.g., its socket file does not exist or does not accept connections
+        """
+
+        # socket file does not exist yet, do not try to connect
+        if self.sock_af == socket.AF_UNIX and \
+           not os.path.exists(self.sock_file):
+            return False
+
+        try:
+            self.start()
+        except OSError:
+            # server not ready
+            return False
+
+        return True
 
     def stop(self):
         """
         Stop the backend's client
         """
 
-        self.sock.close()
+        with self.lock:
+            self.protocol = None
+            if self.transport:
+                # transport owns the socket and closes it
+                self.transport.close()
+                self.transport = None
+                self.sock = None
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+
+    def is_connected(self):
+        """
+        Check if the client is connected to the server
+        """
+
+        return self.sock is not None
 
     def read(self):
         """
-        Read from the client connection
+        Read from the client connection and return the next message or None
         """
 
-        reads, unused_writes, errs = select.select([self.sock, ], [],
-                                                   [self.sock, ], 0)
-        if self.sock in errs:
-            # something is wrong
-            return None
+        msg = self.get_msg()
+        if msg is None:
+            self.recv_data()
+            msg = self.get_msg()
+        return msg
+
+    def get_backlog(self):
+        """
+        Get number of received messages that are not handled yet
+        """
+
+        return len(self.stamps)
+
+    def recv_data(self):
+        """
+        Receive data from the client connection, if there is any, and add it
+        to the buffer. Return the number of received bytes.
+        """
+
+        with self.lock:
+            # connection is closed, see BackendSupervisor
+            if self.sock is None:
+                return 0
+
+            reads, unused_writes, errs = select.select([self.sock, ], [],
+                                                       [self.sock, ], 0)
+            if self.sock in errs:
+                # something is wrong
+                self.sock.close()
+                self.sock = None
+                return 0
+
+            if self.sock not in reads:
+                return 0
 
-        if self.sock in reads:
             # read data from socket and add it to buffer
-            data = self.sock.recv(BUFFER_SIZE)
-            self.buffer += data.decode()
+            try:
+                data = self.sock.recv(BUFFER_SIZE)
+            except OSError:
+                data = b""
+            if data == b"":
+                # connection closed by server, complete messages in the
+                # buffer are still handled
+                self.sock.close()
+                self.sock = None
+                return 0
+            self.add_data(data)
+            return len(data)
+
+    def add_data(self, data):
+        """
+        Add received data to the buffer, caller must hold the lock
+        """
 
-        # get next message from buffer and return it
-        eom = self.buffer.find("\r\n")
-        if eom == -1:
-            # no message found
-            return None
+        nuqql.stats.count("network.bytes_in", len(data))
 
-        # remove message from buffer and return it
-        msg = self.buffer[:eom]
-        # remove message including "\r\n" from buffer
-        self.buffer = self.buffer[eom + 2:]
-        return msg
+        # stamp each line completed by the new data with the receive time
+        num_lines = data.count(b"\r\n")
+        if data[:1] == b"\n" and self.buffer[-1:] == "\r":
+            num_lines += 1
+        if num_lines:
+            self.stamps.extend([time.perf_counter()] * num_lines)
+        self.buffer += self.decoder.decode(data)
+
+    def get_msg(self):
+        """
+        Get the next message from the buffer or None if there is no complete
+        message
+        """
+
+        with self.lock:
+            # get next message from buffer and return it
+            eom = self.buffer.find("\r\n")
+            if eom == -1:
+                # no message found
+                return None
+
+            # remove message from buffer and return it
+            msg = self.buffer[:eom]
+            # remove message including "\r\n" from buffer
+            self.buffer = self.buffer[eom + 2:]
+            if self.stamps:
+                self.msg_stamp = self.stamps.popleft()
+            else:
+                self.msg_stamp = time.perf_counter()
+            if self.capture:
+                self._capture("in", msg)
+            return msg
+
+    def start_capture(self, file_name):
+        """
+        Start recording all received and sent messages in capture file
+        file_name
+        """
+
+        capture = open(file_name, "a")
+        with self.lock:
+            if self.capture:
+                self.capture.close()
+            self.capture = capture
+
+    def stop_capture(self):
+        """
+        Stop recording messages
+        """
+
+        with self.lock:
+            if self.capture:
+                self.capture.close()
+                self.capture = None
+
+    def _capture(self, direction, msg):
+        """
+        Write message with direction "in" or "out" and current time to
+        capture file
+        """
+
+        record = [time.time(), direction, msg]
+        self.capture.write(json.dumps(record) + "\n")
+
+    def _send(self, msg):
+        """
+        Send msg over the client connection, if it is connected
+        """
+
+        with self.lock:
+            if self.capture:
+                self._capture("out", msg[:-2])
+            sock = self.sock
+            transport = self.transport
+
+        if sock is None:
+            return
+
+        data = msg.encode()
+        nuqql.stats.count("network.bytes_out", len(data))
+        if transport:
+            # asyncio transport buffers data it cannot send immediately
+            transport.write(data)
+            return
+        try:
+            sock.sendall(data)
+        except OSError:
+            # connection is broken, see BackendSupervisor
+            self.stop()
 
     def send_command(self, cmd):
         """
@@ -140,8 +529,7 @@ class BackendClient:
         """
 
         msg = cmd + "\r\n"
-        msg = msg.encode()
-        self.sock.send(msg)
+        self._send(msg)
 
     def send_msg(self, account, buddy, msg):
         """
@@ -152,22 +540,17 @@ class BackendClient:
         msg = html.escape(msg)
         msg = "<br/>".join(msg.split("\n"))
         msg = prefix + msg + "\r\n"
-        msg = msg.encode()
-        self.sock.send(msg)
+        self._send(msg)
 
-    def send_collect(self, account):
+    def send_collect(self, account, tstamp=0):
         """
         Send "collect" message over the client connection,
-        which collects all messages received by the backend
+        which collects all messages received by the backend since tstamp
         """
 
-        # collect all messages since time 0
-        # TODO: only works as intended if we spawn our own purpled daemon at
-        # nuqql's startup, FIXME?
-        msg = "account {0} collect 0\r\n".format(account)
-        msg = msg.encode()
+        msg = "account {0} collect {1}\r\n".format(account, tstamp)
         # self.collect_acc = account
-        self.sock.send(msg)
+        self._send(msg)
 
     def send_buddies(self, account):
         """
@@ -176,8 +559,7 @@ class BackendClient:
         """
 
         msg = "account {0} buddies\r\n".format(account)
-        msg = msg.encode()
-        self.sock.send(msg)
+        self._send(msg)
 
     def send_accounts(self):
         """
@@ -186,8 +568,7 @@ class BackendClient:
         """
 
         msg = "account list\r\n"
-        msg = msg.encode()
-        self.sock.send(msg)
+        self._send(msg)
 
     def send_status_set(self, account, status):
         """
@@ -196,8 +577,81 @@ class BackendClient:
         """
 
         msg = "account {} status set {}\r\n".format(account, status)
-        msg = msg.encode()
-        self.sock.send(msg)
+        self._send(msg)
+
+
+class BackendProtocol(asyncio.Protocol):
+    """
+    Class for the asyncio protocol of a backend's client connection, feeds
+    received data to the backend's client and handles the messages
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+        # are received messages left over for handling in a later callback?
+        self.pending = False
+
+    def _is_current(self):
+        """
+        Check if this protocol is (still) the client's protocol, the client
+        could have been stopped and restarted in the meantime
+        """
+
+        return self.backend.client.protocol is self
+
+    def connection_made(self, transport):
+        if not self._is_current():
+            transport.close()
+            return
+        self.backend.client.transport = transport
+
+    def data_received(self, data):
+        if not self._is_current():
+            return
+        client = self.backend.client
+        with client.lock:
+            client.add_data(data)
+        if not self.pending:
+            self._handle_received()
+
+    def _handle_received(self):
+        """
+        Handle received messages within the backend's budget and leave the
+        rest for a later callback, so other callbacks run in between
+        """
+
+        self.pending = False
+        if self.backend.client.protocol not in (self, None):
+            # client was restarted, messages of this connection are gone
+            return
+        if nuqql.watchdog.run_iteration("handle_network",
+                                        self.backend.handle_received):
+            self.pending = True
+            asyncio.get_running_loop().call_soon(self._handle_received)
+
+        # stop reading while the backend's inbox is full
+        transport = self.backend.client.transport
+        if transport:
+            if self.backend.inbox.is_full():
+                transport.pause_reading()
+            elif not transport.is_reading():
+                transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if not self._is_current():
+            return
+
+        # connection closed, complete messages in the buffer are still
+        # handled; see BackendSupervisor for reconnecting
+        client = self.backend.client
+        with client.lock:
+            client.protocol = None
+            client.transport = None
+            client.sock = None
+        if not self.pending:
+            self._handle_received()
+        _wake_event_loop()
 
 
 class Backend:
@@ -219,6 +673,22 @@ class Backend:
         # client
         self.client = None
 
+        # time in seconds it took the backend to accept connections
+        self.startup_time = None
+
+        # supervisor for server and client, see init_backend()
+        self.supervisor = None
+
+        # prefix of stats names of this backend
+        self.stats_prefix = "backend." + name + "."
+
+        # received messages waiting for handling
+        self.inbox = Inbox(self.stats_prefix)
+
+        # keep history and collect marks of this backend on disk, disabled
+        # for replay backends, see start_replay()
+        self.persistent = True
+
         # self.collect_acc = -1
 
     def start_server(self, cmd, path):
@@ -246,6 +716,15 @@ class Backend:
         self.client = BackendClient(sock_af, ip_addr, port, sock_file)
         self.client.start()
 
+    def add_client(self, sock_af=socket.AF_UNIX, ip_addr="127.0.0.1",
+                   port=32000, sock_file=""):
+        """
+        Add a client to this backend without starting it, it is started
+        later with wait_for_backends()
+        """
+
+        self.client = BackendClient(sock_af, ip_addr, port, sock_file)
+
     def stop_client(self):
         """
         Stop the client of this backend
@@ -254,23 +733,237 @@ class Backend:
         if self.client:
             self.client.stop()
 
-    def handle_network(self):
+    def resync(self):
         """
-        Try to read from the client connection and handle messages.
+        Re-request accounts and buddies from the backend, e.g., after the
+        client reconnected
         """
 
-        # try to read message
-        msg = self.client.read()
-        if msg is None:
+        self.client.send_accounts()
+        for acc in self.accounts.values():
+            acc.set_buddies_update()
+            self.client.send_buddies(acc.aid)
+            self.send_collect(acc)
+
+    def send_collect(self, acc):
+        """
+        Collect messages of account acc the backend received since the last
+        message nuqql received
+        """
+
+        # messages with the high-water mark's timestamp are sent again by
+        # the backend, expect them as duplicates
+        acc.collect_dupes = Counter(acc.collect_digests)
+        self.client.send_collect(acc.aid, acc.collect_tstamp)
+
+        # ingest the collected messages in bulk, the end of the burst is
+        # checked in handle_network()
+        acc.collect_start = time.time()
+        acc.collect_last = acc.collect_start
+        _wake_event_loop()
+
+    def check_collects(self, now):
+        """
+        End collect bursts of all accounts that are over at time now
+        """
+
+        for acc in self.accounts.values():
+            if acc.collect_start and acc.is_collect_over(now):
+                self.end_collect(acc)
+
+    def end_collect(self, acc):
+        """
+        End collect burst of account acc: write, paint and notify the
+        messages ingested in bulk
+        """
+
+        acc.collect_start = 0
+        nuqql.ui.flush_bulk()
+        self.save_collect_marks(force=True)
+
+    def save_collect_marks(self, force=False):
+        """
+        Write high-water marks of received messages of all accounts, at most
+        every COLLECT_SAVE_TIMER seconds unless force is True
+        """
+
+        # messages ingested in bulk must be in the history before the marks
+        if force:
+            nuqql.ui.flush_bulk()
+        if not self.persistent:
             return
 
-        # parse it
-        parsed_msg = parse_msg(msg)
-        msg_type = parsed_msg[0]
+        now = time.time()
+        for acc in self.accounts.values():
+            if not acc.collect_dirty:
+                continue
+            if not force and (acc.collect_start or
+                              now - acc.collect_saved <= COLLECT_SAVE_TIMER):
+                continue
+            nuqql.history.set_collect_mark(self.name, acc.aid,
+                                           acc.collect_tstamp,
+                                           acc.collect_digests)
+            acc.collect_dirty = False
+            acc.collect_saved = now
+
+    def handle_network(self):
+        """
+        Try to read from the client connection and handle messages. Return
+        True if the budget was used up, see handle_inbox()
+        """
+
+        # read at most NETWORK_BYTE_BUDGET bytes and only if there is room
+        # in the inbox
+        num_bytes = 0
+        while num_bytes < NETWORK_BYTE_BUDGET and not self.inbox.is_full():
+            received = self.client.recv_data()
+            if not received:
+                break
+            num_bytes += received
+
+        return self.handle_received()
+
+    def handle_received(self):
+        """
+        Handle complete messages received by the client, e.g., after the
+        asyncio event loop added data to the client's buffer. Return True if
+        the budget was used up, see handle_inbox()
+        """
+
+        # parse received messages and put them into the inbox
+        while not self.inbox.is_full():
+            msg = self.client.get_msg()
+            if msg is None:
+                break
+            parsed_msg = parse_msg(msg)
+            self.inbox.add((parsed_msg, self.client.msg_stamp,
+                            time.perf_counter(), len(msg)))
+
+        return self.handle_inbox()
+
+    def handle_queued_msgs(self, msg_queue):
+        """
+        Handle messages queued by the network thread in msg_queue. Return
+        True if the budget was used up, see handle_inbox()
+        """
+
+        # move queued messages into the inbox
+        while not self.inbox.is_full():
+            try:
+                self.inbox.add(msg_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return self.handle_inbox()
+
+    def handle_inbox(self):
+        """
+        Handle messages in the inbox by priority until there are no more
+        messages or the budget of NETWORK_MSG_BUDGET messages or
+        NETWORK_BYTE_BUDGET bytes is used up. Return True if the budget was
+        used up, i.e., there might be more messages.
+        """
+
+        num_bytes = 0
+        try:
+            for unused_i in range(NETWORK_MSG_BUDGET):
+                item = self.inbox.pop()
+                if item is None:
+                    return False
+                parsed_msg, recv_stamp, parse_stamp, size = item
+
+                # account and buddy of a chat message could be unknown yet,
+                # handle their waiting messages first
+                if parsed_msg.type == "message":
+                    self.handle_inbox_deps(parsed_msg)
+
+                num_bytes += size
+                self.handle_msg(parsed_msg, recv_stamp, parse_stamp)
+                if num_bytes >= NETWORK_BYTE_BUDGET:
+                    break
+            return True
+        finally:
+            self.update_backlog()
+
+    def get_account(self, aid):
+        """
+        Get account with account id aid or None if there is no such account
+        """
+
+        for acc in self.accounts.values():
+            if acc.aid == aid:
+                return acc
+        return None
+
+    def handle_inbox_deps(self, parsed_msg):
+        """
+        Handle messages in the inbox the chat message parsed_msg depends on:
+        account messages, if its account is unknown, and presence updates of
+        its sender, if the sender is not a known buddy
+        """
+
+        # unknown account, handle waiting account messages
+        account = self.get_account(parsed_msg.aid)
+        if account is None:
+            for item in self.inbox.pop_priority(MSG_PRIORITY_DEFAULT):
+                self.handle_msg(*item[:3])
+            account = self.get_account(parsed_msg.aid)
+            if account is None:
+                return
+
+        # unknown buddy, handle its waiting presence update; xmpp senders
+        # contain a resource
+        sender = parsed_msg.sender
+        for name in (sender, sender.split("/")[0]):
+            if name in account.buddy_index:
+                return
+            item = self.inbox.pop_presence(parsed_msg.aid, name)
+            if item:
+                self.handle_msg(*item[:3])
+                return
+
+    def update_backlog(self):
+        """
+        Update stats of received messages that are not handled yet: number
+        of messages and size of the client's buffer
+        """
+
+        backlog = self.client.get_backlog() + len(self.inbox)
+        msg_queue = IO.queues.get(self.name)
+        if msg_queue:
+            backlog += msg_queue.qsize()
+        nuqql.stats.gauge(self.stats_prefix + "backlog", backlog)
+        nuqql.stats.gauge(self.stats_prefix + "buffer",
+                          len(self.client.buffer))
+
+    def handle_msg(self, parsed_msg, recv_stamp, parse_stamp):
+        """
+        Handle a parsed message that was received at time recv_stamp and
+        parsed at time parse_stamp, see time.perf_counter()
+        """
+
+        nuqql.stats.count(self.stats_prefix + "received")
+        nuqql.stats.count(self.stats_prefix + "parsed." + parsed_msg.type)
+        nuqql.watchdog.set_msg_type(self.name + " " + parsed_msg.type)
+
+        # trace latency of message handling stages from receiving the message
+        nuqql.stats.start_trace(recv_stamp)
+        try:
+            nuqql.stats.trace("parse", parse_stamp)
+            self.handle_parsed_msg(parsed_msg)
+        finally:
+            nuqql.stats.stop_trace()
+
+    def handle_parsed_msg(self, parsed_msg):
+        """
+        Handle a parsed message received from the backend
+        """
+
+        msg_type = parsed_msg.type
 
         # handle info message or error message
         if msg_type in ("info", "error"):
-            text = msg_type + ": " + parsed_msg[1]
+            text = msg_type + ": " + parsed_msg.text
             self.conversation.log("nuqql", text)
             return
 
@@ -281,8 +974,13 @@ class Backend:
 
         # handle status message
         if msg_type == "status":
-            text = "account {} status: {}".format(parsed_msg[1], parsed_msg[2])
+            text = "account {} status: {}".format(parsed_msg.aid,
+                                                  parsed_msg.status)
             self.conversation.log("nuqql", text)
+            # account status changed, buddies will probably change soon
+            for account in self.accounts.values():
+                if account.aid == parsed_msg.aid:
+                    account.set_buddies_activity()
             return
 
         # handle buddy messages
@@ -302,16 +1000,16 @@ class Backend:
 
         # TODO: do not ignore account name; it's not even an acc_name,
         # it's the name of the buddy? FIXME
-        # msg_type = msg[0]
-        acc_id = parsed_msg[1]
-        # acc_name = msg[2]
-        tstamp = parsed_msg[3]
-        sender = parsed_msg[4]
-        msg = parsed_msg[5]
+        acc_id = parsed_msg.aid
+        tstamp = parsed_msg.tstamp
+        sender = parsed_msg.sender
+        msg = parsed_msg.msg
 
         # account specific message parsing
+        account = None
         for tmp_acc in self.accounts.values():
             if tmp_acc.aid == acc_id:
+                account = tmp_acc
                 if tmp_acc.type == "icq":
                     if sender[-1] == ":":
                         sender = sender[:-1]
@@ -324,21 +1022,37 @@ class Backend:
                     sender = sender.split("/")[0]
                     break
 
+        # update high-water mark of received messages and drop messages the
+        # backend sent again
+        bulk = False
+        if account:
+            if not account.update_collect(tstamp, sender, msg):
+                return
+            self.save_collect_marks()
+            account.set_buddies_activity()
+
+            # ingest messages of a collect burst in bulk
+            if account.collect_start:
+                now = time.time()
+                if account.is_collect_over(now):
+                    self.end_collect(account)
+                else:
+                    account.collect_last = now
+                    bulk = True
+
         # let ui handle the message
-        nuqql.ui.handle_message(self, acc_id, tstamp, sender, msg)
+        nuqql.ui.handle_message(self, acc_id, tstamp, sender, msg, bulk=bulk)
 
     def handle_account_msg(self, parsed_msg):
         """
         Handle Account message
         """
 
-        # "account", acc_id, acc_alias, acc_prot, acc_user, acc_status
-        # msg_type = parsed_msg[0]
-        acc_id = parsed_msg[1]
-        acc_alias = parsed_msg[2]
-        acc_prot = parsed_msg[3]
-        acc_user = parsed_msg[4]
-        acc_status = parsed_msg[5]
+        acc_id = parsed_msg.aid
+        acc_alias = parsed_msg.alias
+        acc_prot = parsed_msg.prot
+        acc_user = parsed_msg.user
+        acc_status = parsed_msg.status
 
         # output account
         text = "account {0} ({1}) {2} {3} {4}.".format(acc_id, acc_alias,
@@ -352,20 +1066,23 @@ class Backend:
 
         # new account, add it
         acc = Account(acc_id, acc_prot, acc_user)
+        if self.persistent:
+            acc.collect_tstamp, acc.collect_digests = \
+                nuqql.history.get_collect_mark(self.name, acc.aid)
         self.accounts[acc.name] = acc
 
         # collect buddies from backend
         text = "Collecting buddies for {0} account {1}: {2}.".format(
             acc.type, acc.aid, acc.name)
         self.conversation.log("nuqql", text)
-        acc.buddies_update = time.time()
+        acc.set_buddies_update()
         self.client.send_buddies(acc.aid)
 
         # collect messages from backend
         text = "Collecting messages for {0} account {1}: {2}.".format(
             acc.type, acc.aid, acc.name)
         self.conversation.log("nuqql", text)
-        self.client.send_collect(acc.aid)
+        self.send_collect(acc)
 
         # if there is a global_status, set account status to it
         status = nuqql.conversation.read_global_status()
@@ -378,11 +1095,10 @@ class Backend:
         """
 
         # get message parts
-        # msg_type = parsed_msg[0]
-        acc_id = parsed_msg[1]
-        status = parsed_msg[2]
-        name = parsed_msg[3]
-        alias = parsed_msg[4]
+        acc_id = parsed_msg.aid
+        status = parsed_msg.status
+        name = parsed_msg.name
+        alias = parsed_msg.alias
 
         # if there is no alias, just use name
         if alias == "":
@@ -399,16 +1115,361 @@ class Backend:
         Update buddies of this account
         """
 
+        # buddies without an update are removed, so do not update while
+        # presence updates are waiting in the inbox
+        if self.inbox.has_presence():
+            return
+
         # update buddies
         for acc in self.accounts.values():
             if acc.update_buddies():
                 self.client.send_buddies(acc.aid)
 
 
+class BackendSupervisor:
+    """
+    Class for supervising a backend's server process and client connection.
+    Restarts exited servers and reconnects lost clients.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+        # time backend went down or None if it is up, and time it came up
+        self.down_since = None
+        self.up_since = time.time()
+
+        # restart/reconnect timing
+        self.backoff = SUPERVISOR_BACKOFF_MIN
+        self.next_try = 0
+        self.connect_deadline = 0
+        self.connect_backoff = BACKEND_START_BACKOFF_MIN
+
+        # statistics
+        self.restarts = 0
+        self.reconnects = 0
+        self.lost_uptime = 0
+
+    def log(self, text):
+        """
+        Log text in the backend's conversation
+        """
+
+        self.backend.conversation.log("nuqql", text)
+
+    def is_up(self):
+        """
+        Check if server process and client connection are up
+        """
+
+        if not self.backend.client.is_connected():
+            return False
+        if self.backend.server and not self.backend.server.is_running():
+            return False
+        return True
+
+    def _went_down(self, now):
+        """
+        Handle backend that went down
+        """
+
+        self.down_since = now
+
+        # if the backend did not run long enough, it might be crashing over
+        # and over again. So, increase backoff; otherwise reset it
+        if now - self.up_since < SUPERVISOR_STABLE_TIME:
+            self.backoff = min(self.backoff * 2, SUPERVISOR_BACKOFF_MAX)
+        else:
+            self.backoff = SUPERVISOR_BACKOFF_MIN
+        self.next_try = now + self.backoff
+        self.connect_deadline = 0
+
+        # clean up client and log it
+        self.backend.client.stop()
+        self.backend.save_collect_marks(force=True)
+        server = self.backend.server
+        if server and not server.is_running():
+            reason = "server exited with code {}".format(
+                server.proc.returncode)
+        else:
+            reason = "connection lost"
+        self.log("Backend went down ({}), retrying in {} s.".format(
+            reason, self.backoff))
+
+    def _came_up(self, now):
+        """
+        Handle backend that came up again
+        """
+
+        lost = now - self.down_since
+        self.lost_uptime += lost
+        self.reconnects += 1
+        self.down_since = None
+        self.up_since = now
+        self.log("Backend reconnected after {0:.1f} s (reconnects: {1}, "
+                 "restarts: {2}, lost uptime: {3:.1f} s).".format(
+                     lost, self.reconnects, self.restarts,
+                     self.lost_uptime))
+
+        # get accounts and buddies again
+        self.backend.resync()
+
+    def get_next_check(self):
+        """
+        Get time of the next due check of a backend that is down, or None if
+        the backend is up
+        """
+
+        if self.down_since is None:
+            return None
+        return self.next_try
+
+    def check(self):
+        """
+        Check backend and restart/reconnect it if necessary
+        """
+
+        now = time.time()
+
+        # check if backend is (still) up
+        if self.down_since is None:
+            if not self.is_up():
+                self._went_down(now)
+            return
+
+        # wait for next try
+        if now < self.next_try:
+            return
+
+        # restart server if necessary and wait for it to accept connections
+        server = self.backend.server
+        if self.connect_deadline == 0:
+            if server and not server.is_running():
+                server.start()
+                self.restarts += 1
+                self.log("Restarted backend server.")
+            self.connect_deadline = now + BACKEND_START_TIMEOUT
+            self.connect_backoff = BACKEND_START_BACKOFF_MIN
+
+        # try to reconnect
+        if self.backend.client.try_start():
+            self._came_up(now)
+            return
+
+        # server is not ready (yet), retry soon
+        server_failed = server and not server.is_running()
+        if not server_failed and now < self.connect_deadline:
+            self.next_try = now + self.connect_backoff
+            self.connect_backoff = min(self.connect_backoff * 2,
+                                       BACKEND_START_BACKOFF_MAX)
+            return
+
+        # server did not come up, try again later with increased backoff
+        if server and not server_failed:
+            server.stop()
+        self.backoff = min(self.backoff * 2, SUPERVISOR_BACKOFF_MAX)
+        self.next_try = now + self.backoff
+        self.connect_deadline = 0
+        self.log("Backend did not come up, retrying in {} s.".format(
+            self.backoff))
+
+
+class ReplayClient(BackendClient):
+    """
+    Class for a backend client that replays messages from a capture file
+    instead of connecting to a backend server
+    """
+
+    # replayed messages are read by the main loop
+    threaded = False
+
+    def __init__(self, records, speed=1.0):
+        BackendClient.__init__(self)
+
+        # received messages as (timestamp, message) tuples
+        self.records = records
+        self.index = 0
+
+        # replay speed factor; 0 replays as fast as possible
+        self.speed = speed
+        self.start_time = 0
+
+        # messages sent to the non-existing server
+        self.sent = []
+
+    def start(self):
+        self.index = 0
+        self.start_time = time.time()
+
+    def try_start(self):
+        self.start()
+        return True
+
+    def stop(self):
+        # nothing to close
+        pass
+
+    def is_connected(self):
+        return True
+
+    def is_done(self):
+        """
+        Check if all messages have been replayed
+        """
+
+        return self.index >= len(self.records)
+
+    def get_msg(self):
+        """
+        Get next message from capture, if it is due
+        """
+
+        if self.is_done():
+            return None
+
+        # check if message is due, relative to the first message
+        tstamp, msg = self.records[self.index]
+        if self.speed > 0:
+            due = (tstamp - self.records[0][0]) / self.speed
+            if time.time() - self.start_time < due:
+                return None
+
+        self.index += 1
+        self.msg_stamp = time.perf_counter()
+        if self.capture:
+            self._capture("in", msg)
+        return msg
+
+    def _send(self, msg):
+        if self.capture:
+            self._capture("out", msg[:-2])
+        self.sent.append(msg)
+
+
 ##################
 # Helper Classes #
 ##################
 
+class Inbox:
+    """
+    Class for parsed messages of a backend waiting for handling, queued by
+    priority, see MSG_PRIORITIES. Messages are (parsed message, receive
+    time, parse time, message size) tuples.
+    """
+
+    def __init__(self, stats_prefix):
+        # queues for each priority; presence updates are queued as
+        # [(account, buddy name), message] slots, so they can be collapsed
+        self.queues = [deque() for unused_i in
+                       range(MSG_PRIORITY_PRESENCE + 1)]
+        self.size = 0
+
+        # queued slots of presence updates by (account, buddy name); slots
+        # of updates that were handled early are emptied
+        self.slots = {}
+
+        # name of the stats counter of collapsed presence updates
+        self.stats_collapsed = stats_prefix + "collapsed"
+
+    def __len__(self):
+        return self.size
+
+    def is_full(self):
+        """
+        Check if the inbox reached its maximum size INBOX_SIZE
+        """
+
+        return self.size >= INBOX_SIZE
+
+    def has_presence(self):
+        """
+        Check if there are presence updates in the inbox
+        """
+
+        return bool(self.slots)
+
+    def add(self, item):
+        """
+        Add message item to the inbox
+        """
+
+        parsed_msg = item[0]
+        priority = MSG_PRIORITIES.get(parsed_msg.type, MSG_PRIORITY_DEFAULT)
+        if priority != MSG_PRIORITY_PRESENCE:
+            self.queues[priority].append(item)
+            self.size += 1
+            return
+
+        # collapse presence updates of the same buddy if there are too many
+        key = (parsed_msg.aid, parsed_msg.name)
+        slots = self.slots.get(key)
+        presence = self.queues[MSG_PRIORITY_PRESENCE]
+        if slots and len(presence) > PRESENCE_COLLAPSE_THRESHOLD:
+            slots[-1][1] = item
+            nuqql.stats.count(self.stats_collapsed)
+            return
+
+        slot = [key, item]
+        presence.append(slot)
+        self.slots.setdefault(key, []).append(slot)
+        self.size += 1
+
+    def pop(self):
+        """
+        Remove the next message with the highest priority from the inbox and
+        return it, or None if the inbox is empty
+        """
+
+        for priority in range(MSG_PRIORITY_PRESENCE):
+            if self.queues[priority]:
+                self.size -= 1
+                return self.queues[priority].popleft()
+
+        presence = self.queues[MSG_PRIORITY_PRESENCE]
+        while presence:
+            slot = presence.popleft()
+            key, item = slot
+            if item is None:
+                # handled early, see pop_presence()
+                continue
+            self.size -= 1
+            slots = self.slots[key]
+            slots.pop(0)
+            if not slots:
+                del self.slots[key]
+            return item
+
+        return None
+
+    def pop_priority(self, priority):
+        """
+        Remove all messages with priority from the inbox and return them.
+        Presence updates are removed with pop_presence().
+        """
+
+        items = list(self.queues[priority])
+        self.queues[priority].clear()
+        self.size -= len(items)
+        return items
+
+    def pop_presence(self, aid, name):
+        """
+        Remove all presence updates of buddy name of account aid from the
+        inbox and return the last one, or None if there is none
+        """
+
+        slots = self.slots.pop((aid, name), None)
+        if not slots:
+            return None
+        item = slots[-1][1]
+        for slot in slots:
+            slot[1] = None
+        self.size -= len(slots)
+        if len(slots) > 1:
+            nuqql.stats.count(self.stats_collapsed, len(slots) - 1)
+        return item
+
+
 class Account:
     """
     Class for Accounts
@@ -421,20 +1482,139 @@ class Account:
         self.buddies = []
         self.buddies_update = 0
 
+        # buddy list update scheduling, see update_buddies()
+        self.buddy_index = {}
+        self.buddies_interval = BUDDY_UPDATE_TIMER
+        self.buddies_due = 0
+        self.buddies_changed = False
+        self.buddies_pushed = 0
+
+        # reply to the last buddy list request: is it outstanding, time of
+        # the request or its last buddy message, was anything received, and
+        # number of pushed buddy messages in this update cycle
+        self.buddies_pending = False
+        self.buddies_last = 0
+        self.buddies_replied = False
+        self.buddies_cycle_pushes = 0
+
+        # high-water mark of received messages for collecting only new
+        # messages from the backend: timestamp of the last messages, digests
+        # of messages with this timestamp, and expected duplicates. The same
+        # message can be received more than once with the same timestamp, so
+        # digests and duplicates are counted.
+        self.collect_tstamp = 0
+        self.collect_digests = Counter()
+        self.collect_dupes = Counter()
+        self.collect_dirty = False
+        self.collect_saved = 0
+
+        # start of the current collect burst or 0, and time of its last
+        # message, see Backend.send_collect()
+        self.collect_start = 0
+        self.collect_last = 0
+
+    def is_collect_over(self, now):
+        """
+        Check if the current collect burst is over at time now
+        """
+
+        return now - self.collect_last > COLLECT_QUIET_TIME or \
+            now - self.collect_start > COLLECT_MAX_TIME
+
+    def update_collect(self, tstamp, sender, msg):
+        """
+        Update the high-water mark of received messages with a message.
+        Return False if the message is a duplicate of an already received
+        message, True otherwise.
+        """
+
+        # messages older than the high-water mark are not tracked
+        if tstamp < self.collect_tstamp:
+            return True
+
+        # check for duplicates sent again by the backend after collect
+        digest = nuqql.history.get_msg_digest(sender, msg)
+        if tstamp == self.collect_tstamp and self.collect_dupes[digest] > 0:
+            self.collect_dupes[digest] -= 1
+            return False
+
+        # update high-water mark
+        if tstamp > self.collect_tstamp:
+            self.collect_tstamp = tstamp
+            self.collect_digests = Counter()
+            self.collect_dupes = Counter()
+        self.collect_digests[digest] += 1
+        self.collect_dirty = True
+        return True
+
+    def is_buddies_pushed(self):
+        """
+        Check if the backend pushes buddy updates for this account
+        """
+
+        return self.buddies_pushed >= BUDDY_PUSH_THRESHOLD
+
+    def set_buddies_update(self):
+        """
+        Set time of last buddy list update request to now and schedule the
+        next update
+        """
+
+        now = time.time()
+        self.buddies_update = now
+
+        # a replied update cycle without pushed buddy messages means the
+        # backend does not push buddy updates (any more)
+        if self.buddies_replied and self.buddies_cycle_pushes == 0:
+            self.buddies_pushed = 0
+        self.buddies_cycle_pushes = 0
+        self.buddies_replied = False
+        self.buddies_pending = True
+        self.buddies_last = now
+
+        # spread updates of multiple accounts with some random jitter
+        jitter = random.uniform(-BUDDY_UPDATE_JITTER, BUDDY_UPDATE_JITTER)
+        self.buddies_due = now + self.buddies_interval * (1 + jitter)
+
+    def set_buddies_activity(self):
+        """
+        Activity on this account, e.g., new messages: the buddy list will
+        probably change, so update it sooner
+        """
+
+        if self.is_buddies_pushed():
+            return
+
+        self.buddies_interval = BUDDY_UPDATE_TIMER
+        self.buddies_due = min(self.buddies_due,
+                               self.buddies_update + BUDDY_UPDATE_TIMER)
+
     def update_buddies(self):
         """
         Update the buddy list of this account.
         Return True if an update is pending, False otherwise.
         """
 
-        # update only once every BUDDY_UPDATE_TIMER seconds
-        if time.time() - self.buddies_update <= BUDDY_UPDATE_TIMER:
+        # update only if next update is due
+        if time.time() < self.buddies_due:
             return False
-        self.buddies_update = time.time()
+
+        # adapt update interval: reconcile pushed buddy lists only rarely,
+        # update more often if buddy list changed, back off otherwise
+        if self.is_buddies_pushed():
+            self.buddies_interval = BUDDY_RECONCILE_TIMER
+        elif self.buddies_changed:
+            self.buddies_interval = BUDDY_UPDATE_TIMER
+        else:
+            self.buddies_interval = min(self.buddies_interval * 2,
+                                        BUDDY_UPDATE_TIMER_MAX)
+        self.buddies_changed = False
+        self.set_buddies_update()
 
         # remove buddies, that have not been updated for a while
         # TODO: tell ui, buddy does not exist any more
         self.buddies = [buddy for buddy in self.buddies if buddy.updated]
+        self.buddy_index = {buddy.name: buddy for buddy in self.buddies}
 
         # set update pending in buddy
         for buddy in self.buddies:
@@ -447,20 +1627,37 @@ class Account:
         Update a single buddy of this account. Could be a new buddy.
         """
 
-        # look for existing buddy
-        for buddy in self.buddies:
-            if buddy.name == name:
-                if buddy.update(status, alias):
-                    # tell ui about the update
-                    nuqql.ui.update_buddy(buddy)
+        # buddy updates received while no reply to a buddy list request is
+        # outstanding are pushed by the backend
+        now = time.time()
+        timeout = BUDDY_REPLY_TIMEOUT
+        if self.buddies_replied:
+            timeout = BUDDY_REPLY_TIME
+        if self.buddies_pending and now - self.buddies_last <= timeout:
+            self.buddies_last = now
+            self.buddies_replied = True
+        else:
+            self.buddies_pending = False
+            self.buddies_pushed += 1
+            self.buddies_cycle_pushes += 1
 
-                # found existing buddy; stop here
-                return
+        # look for existing buddy
+        buddy = self.buddy_index.get(name)
+        if buddy:
+            if buddy.update(status, alias):
+                # tell ui about the update
+                self.buddies_changed = True
+                nuqql.ui.update_buddy(buddy)
+
+            # found existing buddy; stop here
+            return
 
         # new buddy
         new_buddy = Buddy(backend, self, name)
         new_buddy.update(status, alias)
         self.buddies.append(new_buddy)
+        self.buddy_index[name] = new_buddy
+        self.buddies_changed = True
 
         # tell ui there is a new buddy
         nuqql.ui.add_buddy(new_buddy)
@@ -522,7 +1719,26 @@ class Buddy:
 # Parsing functions #
 #####################
 
-def parse_error_msg(orig_msg):
+# parsed messages received from backend
+InfoMsg = namedtuple("InfoMsg", "type text")
+AccountMsg = namedtuple("AccountMsg", "type aid alias prot user status")
+MessageMsg = namedtuple("MessageMsg", "type aid acc_name tstamp sender msg")
+BuddyMsg = namedtuple("BuddyMsg", "type aid status name alias")
+StatusMsg = namedtuple("StatusMsg", "type aid status")
+
+# fast constructors for parsed messages from a tuple of all fields; they
+# skip the argument handling of the namedtuple's __new__()
+make_info_msg = partial(tuple.__new__, InfoMsg)
+make_account_msg = partial(tuple.__new__, AccountMsg)
+make_message_msg = partial(tuple.__new__, MessageMsg)
+make_buddy_msg = partial(tuple.__new__, BuddyMsg)
+make_status_msg = partial(tuple.__new__, StatusMsg)
+
+# line breaks in message texts
+BR_RE = re.compile("<br/>", re.IGNORECASE)
+
+
+def parse_error_msg(msg):
     """
     Parse "error" message received from backend
 
@@ -530,11 +1746,10 @@ def parse_error_msg(orig_msg):
         "error: %s\r\n"
     """
 
-    error = orig_msg[7:]
-    return "error", error
+    return make_info_msg(("error", msg))
 
 
-def parse_info_msg(orig_msg):
+def parse_info_msg(msg):
     """
     Parse "info" message received from backend
 
@@ -542,11 +1757,10 @@ def parse_info_msg(orig_msg):
         "info: %s\r\n"
     """
 
-    info = orig_msg[6:]
-    return "info", info
+    return make_info_msg(("info", msg))
 
 
-def parse_account_msg(orig_msg):
+def parse_account_msg(msg):
     """
     Parse "account" message received from backend
 
@@ -554,70 +1768,90 @@ def parse_account_msg(orig_msg):
         "account: %d %s %s %s [%s]\r\n"
     """
 
-    orig_msg = orig_msg[9:]
-    part = orig_msg.split(" ")
-    acc_id = part[0]
-    acc_alias = part[1]
-    acc_prot = part[2].lower()
-    acc_user = part[3]
-    acc_status = part[4]    # ignore [ and ] for now
-    return "account", acc_id, acc_alias, acc_prot, acc_user, acc_status
+    part = msg.split(" ", 5)
+    if len(part) < 5:
+        return None
+
+    # ignore [ and ] of account status for now
+    return make_account_msg(("account", part[0], part[1], part[2].lower(),
+                             part[3], part[4]))
 
 
-def parse_collect_msg(orig_msg):
+def parse_collect_msg(msg):
     """
     Parse "collect" message received from backend
     """
 
     # collect response and message have the same message format
-    return parse_message_msg(orig_msg)
+    return parse_message_msg(msg)
 
 
-def parse_message_msg(orig_msg):
+def unescape_msg(msg):
+    """
+    Convert line breaks and html entities in message text received from
+    backend
+    """
+
+    # only run the expensive conversions if necessary
+    if "<" in msg:
+        msg = BR_RE.sub("\n", msg)
+    if "&" in msg:
+        msg = html.unescape(msg)
+    return msg
+
+
+def parse_message_msg(msg):
     """
     Parse "message" message received from backend
+
+    Format:
+        "message: %s %s %d %s %s\r\n"
     """
 
-    orig_msg = orig_msg[9:]
-    part = orig_msg.split(" ")
-    acc = part[0]
-    acc_name = part[1]
-    tstamp = part[2]
-    sender = part[3]
-    msg = " ".join(part[4:])
-    msg = "\n".join(re.split("<br/>", msg, flags=re.IGNORECASE))
-    msg = html.unescape(msg)
+    # split off the four fields in front of the message text only
+    part = msg.split(" ", 4)
+    if len(part) < 4:
+        return None
+    try:
+        tstamp = int(part[2])
+    except ValueError:
+        return None
+    text = ""
+    if len(part) == 5:
+        text = unescape_msg(part[4])
 
-    return "message", acc, acc_name, int(tstamp), sender, msg
+    return make_message_msg(("message", part[0], part[1], tstamp, part[3],
+                             text))
 
 
-def parse_buddy_msg(orig_msg):
+def parse_buddy_msg(msg):
     """
     Parse "buddy" message received from backend
+
+    Format:
+        "buddy: <acc> status: <status> name: <name> alias: <alias>\r\n"
     """
 
-    orig_msg = orig_msg[7:]
-    # <acc> status: <Offline/Available> name: <name> alias: <alias>
-    part = orig_msg.split(" ")
-    acc = part[0]
-    status = part[2]
-    name = part[4]
-    alias = part[6]
-    return "buddy", acc, status, name, alias
+    part = msg.split(" ", 7)
+    if len(part) < 7:
+        return None
+
+    return make_buddy_msg(("buddy", part[0], part[2], part[4], part[6]))
 
 
-def parse_status_msg(orig_msg):
+def parse_status_msg(msg):
     """
     Parse "status" message received from backend
+
+    Format:
+        "status: account <acc> status: <status>\r\n"
     """
 
-    orig_msg = orig_msg[9:]
-    # account <acc> status: <status>
-    part = orig_msg.split(" ")
-    acc = part[1]
-    status = part[3]
+    part = msg.split(" ", 4)
+    if len(part) < 4:
+        return None
 
-    return "status", acc, status
+    return make_status_msg(("status", part[1], part[3]))
 
 
 # dictionary for parsing functions, used by parse_msg()
@@ -638,24 +1872,58 @@ def parse_msg(orig_msg):
     calls more specific parsing functions
     """
 
-    # extract message type and then call respectice parsing function
-    msg_type = orig_msg.split(maxsplit=1)[0]
-    try:
-        return PARSE_FUNCTIONS[msg_type](orig_msg)
-    except KeyError:
-        # return this as parsing error
-        acc = "-1"
-        acc_name = "error"
-        tstamp = int(time.time())
-        sender = "<backend>"
-        msg = "Error parsing message: " + orig_msg
-        return "parsing error", acc, acc_name, tstamp, sender, msg
+    # split message type from the rest of the message once, and then call
+    # respective parsing function with the rest of the message
+    msg_type, unused_sep, msg = orig_msg.partition(" ")
+    parse_func = PARSE_FUNCTIONS.get(msg_type)
+    if parse_func:
+        parsed_msg = parse_func(msg)
+        if parsed_msg is not None:
+            return parsed_msg
+
+    # return this as parsing error
+    acc = "-1"
+    acc_name = "error"
+    tstamp = int(time.time())
+    sender = "<backend>"
+    msg = "Error parsing message: " + orig_msg
+    return make_message_msg(("parsing error", acc, acc_name, tstamp, sender,
+                             msg))
 
 
 ####################
 # HELPER FUNCTIONS #
 ####################
 
+def get_output_logger(file_name):
+    """
+    Create a logger for a backend server's output, that writes to a
+    rotating file
+    """
+
+    # create logger
+    logger = logging.getLogger("backend output " + file_name)
+    logger.setLevel(logging.DEBUG)
+
+    # create handler
+    fileh = logging.handlers.RotatingFileHandler(
+        file_name, maxBytes=SERVER_OUTPUT_FILE_SIZE,
+        backupCount=SERVER_OUTPUT_FILE_COUNT)
+    fileh.setLevel(logging.DEBUG)
+
+    # create formatter
+    formatter = logging.Formatter(fmt="%(asctime)s %(message)s")
+
+    # add formatter to handler
+    fileh.setFormatter(formatter)
+
+    # add handler to logger
+    logger.addHandler(fileh)
+
+    # return logger to caller
+    return logger
+
+
 def update_buddies():
     """
     Helper for updating buddies on all backends
@@ -665,13 +1933,319 @@ def update_buddies():
         backend.update_buddies()
 
 
+def supervise_backends():
+    """
+    Helper for checking all backends and restarting/reconnecting them
+    """
+
+    for backend in BACKENDS.values():
+        backend.supervisor.check()
+
+
+def get_next_supervise():
+    """
+    Helper for getting the time of the next due check of a backend that is
+    down, or None if all backends are up
+    """
+
+    next_checks = [backend.supervisor.get_next_check()
+                   for backend in BACKENDS.values()]
+    next_checks = [next_check for next_check in next_checks
+                   if next_check is not None]
+    if not next_checks:
+        return None
+    return min(next_checks)
+
+
+def get_backends_round_robin():
+    """
+    Helper for getting all backends as a list, starting with a different
+    backend on every call
+    """
+
+    backends = list(BACKENDS.values())
+    if not backends:
+        return backends
+    start = NETWORK.start % len(backends)
+    NETWORK.start = start + 1
+    return backends[start:] + backends[:start]
+
+
 def handle_network():
     """
-    Helper for handling network events on all backends
+    Helper for handling network events on all backends, each backend gets a
+    budget of messages, see Backend.handle_inbox(). Return True if a backend
+    used up its budget, i.e., there might be more messages.
+    """
+
+    more = False
+    now = time.time()
+    for backend in get_backends_round_robin():
+        backend.check_collects(now)
+        if backend.client.protocol:
+            # client is read by the asyncio event loop
+            continue
+        if IO.thread and backend.client.threaded:
+            # messages read by the network thread
+            msg_queue = IO.queues.get(backend.name)
+            if msg_queue and backend.handle_queued_msgs(msg_queue):
+                more = True
+            continue
+        if backend.handle_network():
+            more = True
+
+    # messages left in the network thread's queues or in the backends'
+    # inboxes, do not wait for user input in the next main loop iteration
+    if more and IO.thread:
+        _wake_main_loop()
+    return more
+
+
+def needs_polling():
+    """
+    Helper for checking if handle_network() has to be called periodically:
+    there are clients that are not read by the asyncio event loop, e.g.,
+    replay clients, with messages left, or collect bursts that did not end
+    yet
+    """
+
+    for backend in BACKENDS.values():
+        client = backend.client
+        if not client.threaded and (not client.is_done() or
+                                    len(backend.inbox) > 0):
+            return True
+        for acc in backend.accounts.values():
+            if acc.collect_start:
+                return True
+    return False
+
+
+def _wake_event_loop():
+    """
+    Helper for waking up the asyncio event loop, so it supervises the
+    backends and starts polling if necessary. Can be called from any thread.
+    """
+
+    wake = NETWORK.wake
+    if wake:
+        wake()
+
+
+def save_collect_marks():
+    """
+    Helper for writing due high-water marks of received messages on all
+    backends
+    """
+
+    for backend in BACKENDS.values():
+        backend.save_collect_marks()
+
+
+def attach_clients():
+    """
+    Helper for attaching all connected clients that are not attached yet to
+    the running asyncio event loop
+    """
+
+    loop = asyncio.get_running_loop()
+    for backend in BACKENDS.values():
+        client = backend.client
+        if not client.threaded or client.sock is None or client.protocol:
+            continue
+        client.protocol = BackendProtocol(backend)
+        loop.create_task(_attach_client(loop, client.protocol, client.sock))
+
+
+async def _attach_client(loop, protocol, sock):
+    """
+    Helper for creating an asyncio transport for the connected socket sock
+    """
+
+    try:
+        await loop.create_connection(lambda: protocol, sock=sock)
+    except (OSError, ValueError):
+        # socket was closed in the meantime, see BackendSupervisor
+        pass
+
+
+def start_io_thread():
+    """
+    Start the network thread that reads and parses messages from all
+    backend clients and queues them for the main loop. Return the file
+    descriptor the main loop can wait on, it becomes readable when messages
+    are queued.
+    """
+
+    IO.queues = {}
+    IO.wake_read, IO.wake_write = os.pipe()
+    os.set_blocking(IO.wake_read, False)
+    os.set_blocking(IO.wake_write, False)
+    IO.stop.clear()
+    IO.thread = threading.Thread(target=_run_io_thread, daemon=True)
+    IO.thread.start()
+    return IO.wake_read
+
+
+def stop_io_thread():
+    """
+    Stop the network thread
+    """
+
+    if IO.thread is None:
+        return
+    IO.stop.set()
+    IO.thread.join()
+    IO.thread = None
+    os.close(IO.wake_read)
+    os.close(IO.wake_write)
+
+
+def _get_io_queue(backend):
+    """
+    Helper for getting the network thread's queue of backend
+    """
+
+    msg_queue = IO.queues.get(backend.name)
+    if msg_queue is None:
+        msg_queue = queue.Queue(maxsize=IO_QUEUE_SIZE)
+        IO.queues[backend.name] = msg_queue
+    return msg_queue
+
+
+def _queue_io_msg(msg_queue, item):
+    """
+    Helper for queueing a message for the main loop and waking it up. If the
+    queue is full, wait until there is space; the network thread stops
+    reading until the main loop catches up.
+    """
+
+    while not IO.stop.is_set():
+        try:
+            msg_queue.put(item, timeout=IO_SELECT_TIMEOUT)
+            break
+        except queue.Full:
+            continue
+    _wake_main_loop()
+
+
+def _wake_main_loop():
+    """
+    Helper for waking up the main loop while it waits for user input
+    """
+
+    try:
+        os.write(IO.wake_write, b"x")
+    except BlockingIOError:
+        # pipe is full, main loop will wake up anyway
+        pass
+
+
+def _run_io_thread():
+    """
+    Network thread: read from all connected clients, split received data
+    into messages, parse them, and queue them for the main loop
     """
 
+    while not IO.stop.is_set():
+        # wait for data on connected clients; clients are connected,
+        # reconnected and closed by the main loop. Do not read from clients
+        # with a full queue until the main loop catches up.
+        clients = {}
+        for backend in list(BACKENDS.values()):
+            client = backend.client
+            if client.threaded and client.sock is not None and \
+               not _get_io_queue(backend).full():
+                clients[client.sock] = backend
+        if not clients:
+            IO.stop.wait(IO_SELECT_TIMEOUT)
+            continue
+        try:
+            reads, unused_writes, unused_errs = select.select(
+                list(clients), [], [], IO_SELECT_TIMEOUT)
+        except (OSError, ValueError):
+            # a socket was closed in the meantime, try again
+            continue
+
+        # read, parse and queue messages
+        for sock in reads:
+            backend = clients[sock]
+            msg_queue = _get_io_queue(backend)
+            backend.client.recv_data()
+            while not IO.stop.is_set():
+                msg = backend.client.get_msg()
+                if msg is None:
+                    break
+                parsed_msg = parse_msg(msg)
+                _queue_io_msg(msg_queue, (parsed_msg,
+                                          backend.client.msg_stamp,
+                                          time.perf_counter(), len(msg)))
+
+
+def start_capture():
+    """
+    Helper for recording traffic of all backends in capture files. Return
+    list of capture files
+    """
+
+    Path(CAPTURE_DIR).mkdir(parents=True, exist_ok=True)
+    now = time.strftime("%Y%m%d-%H%M%S")
+    files = []
     for backend in BACKENDS.values():
-        backend.handle_network()
+        file_name = "{}/{}-{}.jsonl".format(CAPTURE_DIR, backend.name, now)
+        backend.client.start_capture(file_name)
+        files.append(file_name)
+    return files
+
+
+def stop_capture():
+    """
+    Helper for stopping recording traffic of all backends
+    """
+
+    for backend in BACKENDS.values():
+        backend.client.stop_capture()
+
+
+def read_capture(file_name):
+    """
+    Read received messages from capture file and return them as list of
+    (timestamp, message) tuples. Malformed records are skipped
+    """
+
+    records = []
+    with open(file_name) as in_file:
+        for line in in_file:
+            try:
+                tstamp, direction, msg = json.loads(line)
+            except (ValueError, TypeError):
+                continue
+            if direction == "in":
+                records.append((tstamp, msg))
+    return records
+
+
+def start_replay(file_name, speed=1.0):
+    """
+    Helper for starting a backend that replays the messages in capture file
+    file_name with speed factor speed; speed 0 replays as fast as possible
+    """
+
+    # find a name for the backend
+    name = "replay"
+    count = 1
+    while name in BACKENDS:
+        count += 1
+        name = "replay-{}".format(count)
+
+    # create backend with replay client and initialize it; replayed
+    # messages are neither written to the history nor deduplicated against
+    # the collect marks of earlier runs
+    backend = Backend(name)
+    backend.persistent = False
+    backend.client = ReplayClient(read_capture(file_name), speed)
+    backend.client.start()
+    init_backend(backend)
+    return backend
 
 
 def start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
@@ -686,15 +2260,24 @@ def start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
         exe = shutil.which(backend_exe)
     if exe is None:
         # does not exist, stop here
-        return
+        return None
 
     backend_cmd = backend_cmd_fmt.format(exe, backend_path)
 
+    # start server process, the client is connected when the server is ready
     backend = Backend(backend_name)
     backend.start_server(cmd=backend_cmd, path=backend_path)
-    backend.start_client(sock_file=backend_sockfile)
+    backend.add_client(sock_file=backend_sockfile)
+    return backend
 
-    BACKENDS[backend_name] = backend
+
+def init_backend(backend):
+    """
+    Helper for initializing a backend after its client is connected
+    """
+
+    BACKENDS[backend.name] = backend
+    backend.supervisor = BackendSupervisor(backend)
 
     # add conversation
     conv = nuqql.conversation.BackendConversation(backend, None, backend.name)
@@ -708,6 +2291,56 @@ def start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
     # log it
     log_msg = "Collecting accounts for \"{0}\".".format(backend.name)
     nuqql.conversation.log_main_window(log_msg)
+    _wake_event_loop()
+
+
+def wait_for_backends(backends):
+    """
+    Helper for connecting clients to all started backend servers. Servers
+    start concurrently, each backend is initialized as soon as its server
+    accepts connections.
+    """
+
+    start = time.time()
+    backoff = BACKEND_START_BACKOFF_MIN
+    pending = [backend for backend in backends if backend]
+    while pending:
+        for backend in pending[:]:
+            # try to connect to server
+            if backend.client.try_start():
+                pending.remove(backend)
+                backend.startup_time = time.time() - \
+                    backend.server.start_time
+                nuqql.stats.gauge(backend.stats_prefix + "startup_time",
+                                  backend.startup_time)
+                log_msg = "Backend \"{0}\" ready after {1:.3f} s.".format(
+                    backend.name, backend.startup_time)
+                nuqql.conversation.log_main_window(log_msg)
+                init_backend(backend)
+                continue
+
+            # server process died, give up
+            if not backend.server.is_running():
+                pending.remove(backend)
+                log_msg = "Backend \"{0}\" exited during startup.".format(
+                    backend.name)
+                nuqql.conversation.log_main_window(log_msg)
+
+        if not pending:
+            break
+
+        # server did not start in time, give up
+        if time.time() - start > BACKEND_START_TIMEOUT:
+            for backend in pending:
+                log_msg = "Backend \"{0}\" did not start in time.".format(
+                    backend.name)
+                nuqql.conversation.log_main_window(log_msg)
+                backend.stop_server()
+            break
+
+        # retry with backoff
+        time.sleep(backoff)
+        backoff = min(backoff * 2, BACKEND_START_BACKOFF_MAX)
 
 
 def start_purpled():
@@ -721,7 +2354,7 @@ def start_purpled():
         exe = shutil.which("purpled")
     if exe is None:
         # does not exist, stop here
-        return
+        return None
 
     ###########
     # purpled #
@@ -733,8 +2366,8 @@ def start_purpled():
     backend_cmd_fmt = "{0} -u -w{1}"
     backend_sockfile = backend_path + "/purpled.sock"
 
-    start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
-                  backend_sockfile)
+    return start_backend(backend_name, backend_exe, backend_path,
+                         backend_cmd_fmt, backend_sockfile)
 
 
 def start_based():
@@ -752,8 +2385,8 @@ def start_based():
     backend_cmd_fmt = "{0} --af unix --dir {1} --sockfile based.sock"
     backend_sockfile = backend_path + "/based.sock"
 
-    start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
-                  backend_sockfile)
+    return start_backend(backend_name, backend_exe, backend_path,
+                         backend_cmd_fmt, backend_sockfile)
 
 
 def start_slixmppd():
@@ -771,8 +2404,35 @@ def start_slixmppd():
     backend_cmd_fmt = "{0} --af unix --dir {1} --sockfile slixmppd.sock"
     backend_sockfile = backend_path + "/slixmppd.sock"
 
-    start_backend(backend_name, backend_exe, backend_path, backend_cmd_fmt,
-                  backend_sockfile)
+    return start_backend(backend_name, backend_exe, backend_path,
+                         backend_cmd_fmt, backend_sockfile)
+
+
+def start_fakebackend():
+    """
+    Helper for starting the "fakebackend" backend for load testing. It is
+    only started if the environment variable NUQQL_FAKEBACKEND is set; its
+    value is passed to the backend as workload arguments, e.g.,
+    NUQQL_FAKEBACKEND="--accounts 2 --buddies 1000 --rate 50"
+    """
+
+    workload = os.environ.get(FAKEBACKEND_ENV)
+    if workload is None:
+        return None
+
+    ###############
+    # fakebackend #
+    ###############
+
+    backend_name = "fakebackend"
+    backend_exe = "fakebackend.py"
+    backend_path = str(Path.home()) + "/.config/nuqql/backend/fakebackend"
+    backend_cmd_fmt = "{0} --af unix --dir {1} --sockfile fakebackend.sock"
+    backend_cmd_fmt += " " + workload.replace("{", "{{").replace("}", "}}")
+    backend_sockfile = backend_path + "/fakebackend.sock"
+
+    return start_backend(backend_name, backend_exe, backend_path,
+                         backend_cmd_fmt, backend_sockfile)
 
 
 def start_backends():
@@ -780,10 +2440,15 @@ def start_backends():
     Helper for starting all backends
     """
 
+    # start all server processes first, then wait for them concurrently
     nuqql.conversation.log_main_window("Start backends.")
-    start_purpled()
-    start_based()
-    start_slixmppd()
+    backends = [
+        start_purpled(),
+        start_based(),
+        start_slixmppd(),
+        start_fakebackend(),
+    ]
+    wait_for_backends(backends)
 
 
 def stop_backends():
@@ -792,5 +2457,7 @@ def stop_backends():
     """
 
     for backend in BACKENDS.values():
+        backend.save_collect_marks(force=True)
+        backend.client.stop_capture()
         backend.stop_client()
         backend.stop_server()
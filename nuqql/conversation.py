@@ -2,12 +2,15 @@
 Nuqql Conversations
 """
 
-import datetime
+import time
 
 from types import SimpleNamespace
 from pathlib import Path
 
+import nuqql.backend
 import nuqql.history
+import nuqql.profiling
+import nuqql.stats
 import nuqql.win
 
 
@@ -24,6 +27,8 @@ class Conversation:
         # general
         self.name = name
         self.notification = 0
+        # number of unread messages shown in the conversation list
+        self.unread = 0
 
         # backend info
         self.backend = backend
@@ -37,9 +42,15 @@ class Conversation:
 
         # history and logging
         self.history = SimpleNamespace()
-        self.history.log = []
+        self.history.log = nuqql.history.LogStore()
         self.history.logger = None
         self.history.log_file = None
+        # format version of the log file, see history.init_logger()
+        self.history.version = nuqql.history.HISTORY_VERSION
+        # read watermark in the log file, see history.get_lastread()
+        self.history.lastread = None
+        # lines waiting to be written to the log file, see history.log()
+        self.history.pending = []
 
     def activate(self):
         """
@@ -93,31 +104,34 @@ class Conversation:
 
         # implemented in sub classes
 
-    def log(self, sender, msg, tstamp=None):
+    def log(self, sender, msg, tstamp=None, redraw=True):
         """
-        Log message to conversation's history/log window
+        Log message to conversation's history/log window. If redraw is False,
+        the caller is responsible for redrawing the log window.
         """
 
         # create a log message and put it into conversation's history
         if tstamp is None:
-            tstamp = datetime.datetime.now()
+            tstamp = int(time.time())
         log_msg = nuqql.history.LogMessage(tstamp, sender, msg)
         self.history.log.append(log_msg)
 
         # if conversation is already active, redraw the log window
-        if self.is_active():
+        if redraw and self.is_active():
             self.wins.log_win.redraw()
 
         return log_msg
 
-    def notify(self):
+    def notify(self, num=1, redraw=True):
         """
-        Notify this conversation about new messages
+        Notify this conversation about num new messages. If redraw is False,
+        the caller redraws the list window
         """
 
         self.notification = 1
+        self.unread += num
 
-        if self.wins.list_win:
+        if redraw and self.wins.list_win:
             self.wins.list_win.redraw_pad()
 
     def clear_notifications(self):
@@ -126,9 +140,22 @@ class Conversation:
         """
 
         self.notification = 0
+        self.unread = 0
         if self.wins.list_win:
             self.wins.list_win.redraw_pad()
 
+    def get_notify(self):
+        """
+        Get notification prefix for the name of the conversation, e.g.,
+        "# (12) " if there are 12 unread messages
+        """
+
+        if self.notification == 0:
+            return ""
+        if self.unread > 0:
+            return "# ({}) ".format(self.unread)
+        return "# "
+
     def __lt__(self, other):
         # sort based on get_key output
         return self.get_key() < other.get_key()
@@ -177,14 +204,15 @@ class Conversation:
 
         return False
 
-    def process_input(self, char):
+    def process_input(self, char, redraw=True):
         """
-        Process user input in active window
+        Process user input in active window. If redraw is False, the caller
+        is responsible for redrawing the input window.
         """
 
         # try to give control to the input win first...
         if self.wins.input_win and self.wins.input_win.state.active:
-            self.wins.input_win.process_input(char)
+            self.wins.input_win.process_input(char, redraw=redraw)
             return
 
         # then, try to give control to the log win
@@ -218,8 +246,9 @@ class BuddyConversation(Conversation):
 
         self.peers = []
         self.wins.list_win = nuqql.win.MAIN_WINS["list"]
-        self.history.logger, self.history.log_file = nuqql.history.init_logger(
-            self)
+        if backend.persistent:
+            self.history.logger, self.history.log_file = \
+                nuqql.history.init_logger(self)
 
     def create_windows(self):
         """
@@ -246,10 +275,7 @@ class BuddyConversation(Conversation):
         """
 
         # check if there are pending notifications
-        if self.notification > 0:
-            notify = "# "
-        else:
-            notify = ""
+        notify = self.get_notify()
 
         peer = self.peers[0]
         return "{0}[{1}] {2}".format(notify, peer.status, peer.alias)
@@ -282,7 +308,7 @@ class BuddyConversation(Conversation):
 
         # TODO: unify the logging in a method of Conversation?
         # log message
-        tstamp = datetime.datetime.now()
+        tstamp = int(time.time())
         log_msg = nuqql.history.LogMessage(tstamp, "you", msg, own=True)
         self.wins.log_win.add(log_msg)
 
@@ -296,19 +322,8 @@ class BuddyConversation(Conversation):
         thus, marking all messages as read.
         """
 
-        log_msg = None
-        if self.wins.log_win.list:
-            log_msg = self.wins.log_win.list[-1]
-            # do not put new conversation event in last_read
-            if log_msg.sender == "<event>" and \
-               log_msg.msg == "<Started new conversation.>":
-                log_msg = None
-                if len(self.wins.log_win.list) > 1:
-                    log_msg = self.wins.log_win.list[-2]
-
-        # if there is a log message, write it to lastread
-        if log_msg:
-            nuqql.history.set_lastread(self, log_msg)
+        self.history.log.mark_all_read()
+        nuqql.history.set_lastread(self)
 
 
 class BackendConversation(Conversation):
@@ -316,6 +331,14 @@ class BackendConversation(Conversation):
     Class for backend conversations
     """
 
+    def __init__(self, backend, account, name):
+        Conversation.__init__(self, backend, account, name)
+
+        # command logs can grow without bounds, keep only the most recent
+        # messages in memory
+        scrollback_file = nuqql.history.get_scrollback_file("backend/" + name)
+        self.history.log = nuqql.history.ScrollbackStore(scrollback_file)
+
     def create_windows(self):
         """
         Create windows for this conversation
@@ -338,10 +361,7 @@ class BackendConversation(Conversation):
         """
 
         # check if there are pending notifications
-        if self.notification > 0:
-            notify = "# "
-        else:
-            notify = ""
+        notify = self.get_notify()
 
         return "{0}{{backend}} {1}".format(notify, self.name)
 
@@ -367,20 +387,65 @@ class BackendConversation(Conversation):
 
         # TODO: unify the logging in a method of Conversation?
         # log message
-        tstamp = datetime.datetime.now()
+        tstamp = int(time.time())
         log_msg = nuqql.history.LogMessage(tstamp, "you", msg, own=True)
         self.wins.log_win.add(log_msg)
 
+        # handle local commands, that are not sent to the backend
+        parts = msg.split()
+        if parts and parts[0] == "server-output":
+            self.show_server_output(parts[1:])
+            return
+
         # send command message to backend
         if self.backend is not None:
             self.backend.client.send_command(msg)
 
+    def show_server_output(self, parts):
+        """
+        Show the last lines of the backend server's stdout/stderr output in
+        the log window. The number of lines can be specified in parts.
+        """
+
+        # there is only output if nuqql started the server itself
+        server = None
+        if self.backend is not None:
+            server = self.backend.server
+        if server is None:
+            tstamp = int(time.time())
+            log_msg = nuqql.history.LogMessage(tstamp, "nuqql",
+                                               "server-output: no server")
+            self.wins.log_win.add(log_msg)
+            return
+
+        # get number of lines
+        num_lines = 20
+        if parts:
+            try:
+                num_lines = int(parts[0])
+            except ValueError:
+                pass
+
+        # add output lines to log and redraw log window only once
+        for tstamp, name, line in server.get_output(num_lines):
+            log_msg = nuqql.history.LogMessage(int(tstamp), name, line)
+            self.history.log.append(log_msg)
+        self.wins.log_win.redraw()
+
 
 class NuqqlConversation(Conversation):
     """
     Class for the nuqql conversation
     """
 
+    def __init__(self, backend, account, name):
+        Conversation.__init__(self, backend, account, name)
+
+        # command logs can grow without bounds, keep only the most recent
+        # messages in memory
+        scrollback_file = nuqql.history.get_scrollback_file(name)
+        self.history.log = nuqql.history.ScrollbackStore(scrollback_file)
+
     def create_windows(self):
         """
         Create windows for this conversation
@@ -412,10 +477,7 @@ class NuqqlConversation(Conversation):
         """
 
         # check if there are pending notifications
-        if self.notification > 0:
-            notify = "# "
-        else:
-            notify = ""
+        notify = self.get_notify()
 
         return "{0}{{nuqql}}".format(notify)
 
@@ -441,7 +503,7 @@ class NuqqlConversation(Conversation):
 
         # TODO: unify the logging in a method of Conversation?
         # log message
-        tstamp = datetime.datetime.now()
+        tstamp = int(time.time())
         log_msg = nuqql.history.LogMessage(tstamp, "you", msg, own=True)
         self.wins.log_win.add(log_msg)
 
@@ -487,7 +549,7 @@ def handle_nuqql_global_status_set(conv, status):
                 conversation.backend.client.send_status_set(acc.aid, status)
 
     # log message
-    tstamp = datetime.datetime.now()
+    tstamp = int(time.time())
     msg = "global-status: " + status
     log_msg = nuqql.history.LogMessage(tstamp, "nuqql", msg)
     conv.wins.log_win.add(log_msg)
@@ -505,7 +567,7 @@ def handle_nuqql_global_status_get(conv):
         return
 
     # log message
-    tstamp = datetime.datetime.now()
+    tstamp = int(time.time())
     msg = "global-status: " + status
     log_msg = nuqql.history.LogMessage(tstamp, "nuqql", msg)
     conv.wins.log_win.add(log_msg)
@@ -547,6 +609,160 @@ def read_global_status():
         return ""
 
 
+def handle_nuqql_capture(parts):
+    """
+    Handle nuqql command: capture
+    Start or stop recording backend traffic in capture files
+    """
+
+    if not parts:
+        return
+    sub_command = parts[0]
+    if sub_command == "start":
+        for file_name in nuqql.backend.start_capture():
+            log_main_window("capture: writing " + file_name)
+    elif sub_command == "stop":
+        nuqql.backend.stop_capture()
+        log_main_window("capture: stopped")
+
+
+def handle_nuqql_replay(parts):
+    """
+    Handle nuqql command: replay
+    Replay backend traffic from a capture file with an optional speed factor
+    """
+
+    if not parts:
+        return
+    file_name = parts[0]
+    speed = 1.0
+    if len(parts) > 1:
+        try:
+            speed = float(parts[1])
+        except ValueError:
+            return
+
+    try:
+        backend = nuqql.backend.start_replay(file_name, speed)
+    except (OSError, ValueError) as error:
+        log_main_window("replay: " + str(error))
+        return
+    log_main_window("replay: replaying {} as {}".format(file_name,
+                                                        backend.name))
+
+
+def handle_nuqql_stats(parts):
+    """
+    Handle nuqql command: stats
+    Show, reset, or dump runtime stats, or dump them periodically
+    """
+
+    sub_command = "show"
+    if parts:
+        sub_command = parts[0]
+
+    if sub_command == "show":
+        log_main_window_lines("stats:", nuqql.stats.format_stats())
+    elif sub_command == "latency":
+        log_main_window_lines("stats: latency since receiving messages "
+                              "(latency) and of each stage (stage)",
+                              nuqql.stats.format_latency())
+    elif sub_command == "reset":
+        nuqql.stats.reset()
+        log_main_window("stats: reset")
+    elif sub_command == "dump":
+        file_name = None
+        if len(parts) > 1:
+            file_name = parts[1]
+        try:
+            file_name = nuqql.stats.dump(file_name)
+        except OSError as error:
+            log_main_window("stats: " + str(error))
+            return
+        log_main_window("stats: dumped to " + file_name)
+    elif sub_command == "autodump":
+        if len(parts) < 2:
+            return
+        if parts[1] == "off":
+            nuqql.stats.set_autodump(0)
+            log_main_window("stats: autodump off")
+            return
+        try:
+            interval = float(parts[1])
+        except ValueError:
+            return
+        file_name = None
+        if len(parts) > 2:
+            file_name = parts[2]
+        nuqql.stats.set_autodump(interval, file_name)
+        log_main_window("stats: dumping to {} every {} s".format(
+            nuqql.stats.DUMP.file, interval))
+
+
+def handle_nuqql_profile(parts):
+    """
+    Handle nuqql command: profile
+    Start or stop profiling nuqql with cProfile, or dump the profile to a
+    file
+    """
+
+    if not parts:
+        return
+    sub_command = parts[0]
+    if sub_command == "start":
+        if nuqql.profiling.start_profile():
+            log_main_window("profile: started")
+        else:
+            log_main_window("profile: already running")
+    elif sub_command == "stop":
+        lines = nuqql.profiling.stop_profile()
+        if lines is None:
+            log_main_window("profile: not running")
+            return
+        log_main_window_lines("profile: stopped", lines)
+    elif sub_command == "dump":
+        file_name = None
+        if len(parts) > 1:
+            file_name = parts[1]
+        try:
+            path = nuqql.profiling.dump_profile(file_name)
+        except OSError as error:
+            log_main_window("profile: " + str(error))
+            return
+        if path is None:
+            log_main_window("profile: no profile")
+            return
+        log_main_window_lines("profile: dumped to " + path,
+                              nuqql.profiling.get_profile_summary())
+
+
+def handle_nuqql_memory(parts):
+    """
+    Handle nuqql command: memory
+    Take memory snapshots with tracemalloc and compare them
+    """
+
+    if not parts:
+        return
+    sub_command = parts[0]
+    if sub_command == "snapshot":
+        try:
+            path, lines = nuqql.profiling.take_snapshot()
+        except OSError as error:
+            log_main_window("memory: " + str(error))
+            return
+        log_main_window_lines("memory: snapshot " + path, lines)
+    elif sub_command == "diff":
+        lines = nuqql.profiling.diff_snapshot()
+        if lines is None:
+            log_main_window("memory: no snapshot")
+            return
+        log_main_window_lines("memory: diff to last snapshot", lines)
+    elif sub_command == "stop":
+        nuqql.profiling.stop_memory()
+        log_main_window("memory: stopped")
+
+
 def handle_nuqql_command(conv, msg):
     """
     Handle a nuqql command (from the nuqql conversation)
@@ -561,6 +777,16 @@ def handle_nuqql_command(conv, msg):
     command = parts[0]
     if command == "global-status":
         handle_nuqql_global_status(conv, parts[1:])
+    elif command == "capture":
+        handle_nuqql_capture(parts[1:])
+    elif command == "replay":
+        handle_nuqql_replay(parts[1:])
+    elif command == "stats":
+        handle_nuqql_stats(parts[1:])
+    elif command == "profile":
+        handle_nuqql_profile(parts[1:])
+    elif command == "memory":
+        handle_nuqql_memory(parts[1:])
 
 
 def log_main_window(msg):
@@ -568,11 +794,20 @@ def log_main_window(msg):
     Log message to main windows
     """
 
-    now = datetime.datetime.now()
+    now = int(time.time())
     log_msg = nuqql.history.LogMessage(now, "nuqql", msg)
     nuqql.win.MAIN_WINS["log"].add(log_msg)
 
 
+def log_main_window_lines(title, lines):
+    """
+    Log message with title and multiple lines to main windows as a single
+    log message, so the window is only redrawn once
+    """
+
+    log_main_window(title + "\n" + "\n".join(lines))
+
+
 def resize_main_window():
     """
     Resize main window
@@ -0,0 +1,222 @@
+"""
+Event loop: asyncio-based alternative to nuqql's polling main loop
+"""
+
+import asyncio
+import functools
+import sys
+import time
+
+from types import SimpleNamespace
+
+import nuqql.backend
+import nuqql.history
+import nuqql.stats
+import nuqql.ui
+import nuqql.watchdog
+
+# intervals in seconds of periodic tasks: updating buddies, writing
+# high-water marks of received messages, finishing upgrades of history files,
+# and dumping stats
+BUDDY_UPDATE_INTERVAL = 0.5
+COLLECT_SAVE_INTERVAL = 1
+UPGRADE_CHECK_INTERVAL = 1
+STATS_DUMP_INTERVAL = 1
+
+# backends are supervised when a client connection is lost, a server exits,
+# or a retry of a backend that is down is due; as a fallback, they are also
+# supervised every SUPERVISE_INTERVAL seconds
+SUPERVISE_INTERVAL = 10
+
+# while there are clients that are not attached to the event loop, e.g.,
+# replay clients, or collect bursts, the backends are polled every
+# POLL_INTERVAL seconds
+POLL_INTERVAL = 0.01
+
+# curses can buffer user input and reports terminal resizes as user input
+# without stdin becoming readable, so user input is also polled every
+# INPUT_POLL_INTERVAL seconds
+INPUT_POLL_INTERVAL = 0.1
+
+# state of the event loop
+EVENT_LOOP = SimpleNamespace(
+    # future that is done when the user quits
+    done=None,
+    # timer handle of the next supervision of the backends and its due time
+    supervise=None,
+    supervise_time=0,
+    # task polling the backends, see start_polling()
+    poll=None,
+)
+
+
+def run():
+    """
+    Run the event loop until the user quits
+    """
+
+    asyncio.run(_run())
+
+
+async def _run():
+    """
+    Helper for running the event loop: user input is handled when stdin is
+    readable, backend messages when they are received, everything else in
+    periodic tasks
+    """
+
+    loop = asyncio.get_running_loop()
+    EVENT_LOOP.done = loop.create_future()
+
+    # handle user input when there is some
+    nuqql.ui.set_blocking(False)
+    loop.add_reader(sys.stdin, handle_input)
+
+    # supervise backends and poll them when woken up by them; supervise them
+    # now to attach the clients that are already connected
+    nuqql.backend.NETWORK.wake = functools.partial(_wake, loop)
+    schedule_supervise(0)
+
+    # start periodic tasks
+    periodic = [
+        (INPUT_POLL_INTERVAL, None, handle_input),
+        (BUDDY_UPDATE_INTERVAL, "update_buddies",
+         nuqql.backend.update_buddies),
+        (COLLECT_SAVE_INTERVAL, "save_collect_marks",
+         nuqql.backend.save_collect_marks),
+        (UPGRADE_CHECK_INTERVAL, "check_upgrades",
+         nuqql.history.check_upgrades),
+        (STATS_DUMP_INTERVAL, None, nuqql.stats.check_dump),
+    ]
+    tasks = [loop.create_task(_run_periodic(interval, stage, func))
+             for interval, stage, func in periodic]
+
+    try:
+        await EVENT_LOOP.done
+    finally:
+        loop.remove_reader(sys.stdin)
+        nuqql.ui.set_blocking(True)
+        nuqql.backend.NETWORK.wake = None
+        if EVENT_LOOP.supervise:
+            EVENT_LOOP.supervise.cancel()
+            EVENT_LOOP.supervise = None
+        if EVENT_LOOP.poll:
+            EVENT_LOOP.poll.cancel()
+        for task in tasks:
+            task.cancel()
+
+        # close client transports while the event loop is still running
+        for backend in nuqql.backend.BACKENDS.values():
+            backend.stop_client()
+
+
+async def _run_periodic(interval, stage, func):
+    """
+    Helper for running func every interval seconds. If stage is set, func
+    is run as a main loop iteration, see nuqql.watchdog.run_iteration()
+    """
+
+    while True:
+        if stage:
+            nuqql.watchdog.run_iteration(stage, func)
+        else:
+            func()
+        await asyncio.sleep(interval)
+
+
+def handle_input():
+    """
+    Handle pending user input and stop the event loop if the user quit
+    """
+
+    if nuqql.watchdog.run_iteration("handle_input", nuqql.ui.handle_input):
+        return
+    if not EVENT_LOOP.done.done():
+        EVENT_LOOP.done.set_result(None)
+
+
+def _wake(loop):
+    """
+    Helper for waking up the event loop from any thread, see
+    nuqql.backend._wake_event_loop()
+    """
+
+    try:
+        loop.call_soon_threadsafe(_handle_wake)
+    except RuntimeError:
+        # event loop is already closed
+        pass
+
+
+def _handle_wake():
+    """
+    Helper for supervising backends and starting to poll them after a wake
+    up
+    """
+
+    if EVENT_LOOP.done.done():
+        return
+    schedule_supervise(0)
+    start_polling()
+
+
+def schedule_supervise(delay):
+    """
+    Schedule supervision of the backends in delay seconds, unless it is
+    already scheduled earlier
+    """
+
+    loop = asyncio.get_running_loop()
+    due = loop.time() + delay
+    if EVENT_LOOP.supervise:
+        if EVENT_LOOP.supervise_time <= due:
+            return
+        EVENT_LOOP.supervise.cancel()
+    EVENT_LOOP.supervise = loop.call_at(due, supervise_backends)
+    EVENT_LOOP.supervise_time = due
+
+
+def supervise_backends():
+    """
+    Restart/reconnect backends that went down and attach their new client
+    connections to the event loop. Schedule the next supervision when a
+    retry of a backend that is down is due, or after SUPERVISE_INTERVAL.
+    """
+
+    EVENT_LOOP.supervise = None
+    nuqql.watchdog.run_iteration("supervise_backends",
+                                 nuqql.backend.supervise_backends)
+    nuqql.backend.attach_clients()
+    start_polling()
+
+    delay = SUPERVISE_INTERVAL
+    next_check = nuqql.backend.get_next_supervise()
+    if next_check is not None:
+        delay = min(max(next_check - time.time(), 0), delay)
+    schedule_supervise(delay)
+
+
+def start_polling():
+    """
+    Start polling the backends if it is necessary and not running already,
+    see nuqql.backend.needs_polling()
+    """
+
+    if EVENT_LOOP.poll or not nuqql.backend.needs_polling():
+        return
+    EVENT_LOOP.poll = asyncio.get_running_loop().create_task(_run_polling())
+
+
+async def _run_polling():
+    """
+    Helper for polling the backends every POLL_INTERVAL seconds as long as
+    it is necessary
+    """
+
+    try:
+        while nuqql.backend.needs_polling():
+            nuqql.watchdog.run_iteration("handle_network",
+                                         nuqql.backend.handle_network)
+            await asyncio.sleep(POLL_INTERVAL)
+    finally:
+        EVENT_LOOP.poll = None
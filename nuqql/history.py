@@ -2,31 +2,138 @@
 History: (file) logging for nuqql conversations
 """
 
-import datetime
+import hashlib
+import itertools
 import logging
+import logging.handlers
+import mmap
 import pathlib
 import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from array import array
+from collections import Counter
+from types import SimpleNamespace
+
+import nuqql.stats
 
 
 HISTORY_FILE = "/history"
 LASTREAD_FILE = "/lastread"
+COLLECT_FILE = "/lastcollect"
+
+# version of the history file format and header of history files. Version 1
+# files have no header and contain "<tstamp> IN|OUT <sender> <msg>\r\n"
+# records. Version 2 records look the same, but backslashes, "\r" and "\n"
+# in senders and messages as well as spaces in senders are escaped, so
+# records cannot break.
+HISTORY_VERSION = 2
+HISTORY_HEADER = b"nuqql history v2\r\n"
+
+# suffix of history files while they are upgraded to the current version
+UPGRADE_SUFFIX = ".upgrade"
+
+# translation tables for escaping senders and messages in version 2 records
+ESCAPE_MSG = str.maketrans({"\\": "\\\\", "\r": "\\r", "\n": "\\n"})
+ESCAPE_SENDER = str.maketrans({"\\": "\\\\", "\r": "\\r", "\n": "\\n",
+                               " ": "\\s"})
+
+# escape sequences in version 2 records and their characters
+UNESCAPE_RE = re.compile(rb"\\(.)", re.DOTALL)
+UNESCAPES = {b"\\": b"\\", b"r": b"\r", b"n": b"\n", b"s": b" "}
+
+# size in bytes of the chunks in which history files are read
+HISTORY_CHUNK_SIZE = 1024 * 1024
+
+# ids of senders in history records for LogStores, see get_sender_id(), per
+# format version: format version -> raw sender -> sender id
+RECORD_SENDER_IDS = {1: {}, 2: {}}
+
+# state of background upgrades of history files, see start_upgrade()
+UPGRADE = SimpleNamespace(
+    # helper thread, started on first use
+    thread=None,
+    # upgrades waiting for the helper thread
+    jobs=queue.Queue(),
+    # upgrades waiting to be finished in the main loop, see check_upgrades()
+    done=queue.Queue(),
+)
+
+# directory for scrollback files of logs with bounded scrollback, see
+# ScrollbackStore
+SCROLLBACK_DIR = str(pathlib.Path.home()) + "/.config/nuqql/scrollback"
+
+# maximum number of messages kept in memory by logs with bounded scrollback;
+# older messages are spilled to the scrollback file. The log is trimmed in
+# chunks of SCROLLBACK_TRIM messages beyond the maximum, so it is not trimmed
+# on every new message.
+SCROLLBACK_LINES = 10000
+SCROLLBACK_TRIM = 1000
+
+# maximum size in bytes and number of rotated scrollback files
+SCROLLBACK_FILE_SIZE = 1024 * 1024
+SCROLLBACK_FILE_COUNT = 3
+
+# number of messages loaded from the scrollback file at once when scrolling
+# beyond the first message in memory
+SCROLLBACK_LOAD_LINES = 500
+
+# maximum number of cached time strings, see format_time()
+TIME_CACHE_SIZE = 4096
+
+# cache of formatted time strings: timestamp in seconds -> time string
+TIME_CACHE = {}
+
+# flags of log messages in a LogStore: own message, and message that is read
+# regardless of the read watermark, e.g., an event marker after unread
+# messages
+FLAG_OWN = 1
+FLAG_READ = 2
+
+# senders of log messages in LogStores, shared by all LogStores: sender id
+# -> sender, sender -> sender id, and sender id -> short sender
+SENDERS = []
+SENDER_IDS = {}
+SHORT_SENDERS = []
+
+
+def format_time(tstamp):
+    """
+    Format timestamp in seconds since the epoch as time string for log
+    windows. Time strings are cached, messages often share the same second.
+    """
+
+    time_str = TIME_CACHE.get(tstamp)
+    if time_str is None:
+        if len(TIME_CACHE) >= TIME_CACHE_SIZE:
+            TIME_CACHE.clear()
+        time_str = time.strftime("%H:%M:%S", time.localtime(tstamp))
+        TIME_CACHE[tstamp] = time_str
+    return time_str
 
 
 class LogMessage:
     """Class for log messages to be displayed in LogWins"""
 
+    __slots__ = ("tstamp", "sender", "own", "msg", "is_read")
+
     def __init__(self, tstamp, sender, msg, own=False):
         """
-        Initialize log message with timestamp, sender of the message, and
-        the message itself
+        Initialize log message with timestamp in seconds since the epoch,
+        sender of the message, and the message itself
         """
 
         # timestamp
         self.tstamp = tstamp
 
         # sender could be us or buddy/other user, as
-        # indicated by self.own (helps with coloring etc. later)
-        self.sender = sender
+        # indicated by self.own (helps with coloring etc. later); there are
+        # only a few different senders, share their strings
+        self.sender = sys.intern(sender)
         self.own = own
 
         # the message itself
@@ -43,22 +150,6 @@ class LogMessage:
         # TODO: improve? Save short name in account and buddy instead?
         return self.sender.split("@")[0]
 
-    def read(self, mark_read=True):
-        """
-        Format and return log message; mark it as read
-        """
-
-        # format message
-        msg = "{0} {1}: {2}\n".format(self.tstamp.strftime("%H:%M:%S"),
-                                      self.get_short_sender(),
-                                      self.msg)
-
-        # message has now been read
-        if mark_read:
-            self.is_read = True
-
-        return msg
-
     def is_equal(self, other):
         """
         Check if this message and the LogMessage "other" match
@@ -74,6 +165,402 @@ class LogMessage:
         return True
 
 
+def get_sender_id(sender):
+    """
+    Get id of sender for LogStores
+    """
+
+    sender_id = SENDER_IDS.get(sender)
+    if sender_id is None:
+        sender_id = len(SENDERS)
+        sender = sys.intern(sender)
+        SENDERS.append(sender)
+        SENDER_IDS[sender] = sender_id
+        SHORT_SENDERS.append(sender.split("@")[0])
+    return sender_id
+
+
+class LogStore:
+    """
+    Class for the log of a conversation, stored in columns to save memory:
+    timestamps, flags, sender ids, and the end offsets of the message texts
+    in a single UTF-8 arena. It can be used like a list of LogMessages,
+    LogMessages are created on access. Read state is a watermark: all
+    messages before read_index have been read; messages after it can be
+    flagged as read individually. Formatted messages and their number of
+    lines are cached once the log is drawn.
+    """
+
+    def __init__(self, log_msgs=()):
+        self._init_columns()
+        for log_msg in log_msgs:
+            self.append(log_msg)
+
+    def _init_columns(self):
+        """
+        Helper for initializing empty columns
+        """
+
+        self.tstamps = array("q")
+        self.flags = bytearray()
+        self.senders = array("I")
+        self.ends = array("Q")
+        self.arena = bytearray()
+
+        # number of bytes removed from the start of the arena, see
+        # remove_first(); end offsets include them
+        self.offset = 0
+
+        # read watermark: index of the first unread message
+        self.read_index = 0
+
+        # cache of formatted messages, and of their number of lines in a pad
+        # with width lines_width and the sum of them; filled on demand, see
+        # iter_lines() and get_num_lines()
+        self.lines = []
+        self.line_counts = array("I")
+        self.lines_width = 0
+        self.num_lines = 0
+
+    def __len__(self):
+        return len(self.tstamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("log index out of range")
+        return self._get(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._get(index)
+
+    def _get_text(self, index):
+        """
+        Helper for getting the message text at index
+        """
+
+        start = self.ends[index - 1] if index else self.offset
+        return self.arena[start - self.offset:
+                          self.ends[index] - self.offset].decode(
+                              errors="replace")
+
+    def _get(self, index):
+        """
+        Helper for creating the LogMessage at index
+        """
+
+        flags = self.flags[index]
+        log_msg = LogMessage(self.tstamps[index],
+                             SENDERS[self.senders[index]],
+                             self._get_text(index),
+                             own=bool(flags & FLAG_OWN))
+        log_msg.is_read = index < self.read_index or bool(flags & FLAG_READ)
+        return log_msg
+
+    def append(self, log_msg):
+        """
+        Add LogMessage log_msg to the end of the log. If it is read, it moves
+        the read watermark if all previous messages have been read, otherwise
+        it is flagged as read.
+        """
+
+        watermark = self.read_index == len(self)
+        self.append_raw(log_msg.tstamp, log_msg.sender, log_msg.msg.encode(),
+                        log_msg.own)
+        if log_msg.is_read and watermark:
+            self.read_index += 1
+        elif log_msg.is_read:
+            self.flags[-1] |= FLAG_READ
+
+    def append_raw(self, tstamp, sender, msg, own=False):
+        """
+        Add an unread message with timestamp, sender and UTF-8 encoded msg to
+        the end of the log
+        """
+
+        self.arena += msg
+        self.ends.append(self.offset + len(self.arena))
+        self.tstamps.append(tstamp)
+        self.senders.append(get_sender_id(sender))
+        self.flags.append(FLAG_OWN if own else 0)
+
+    def extend_records(self, lines, version):
+        """
+        Add unread messages from records lines of a history file with the
+        given format version to the end of the log, see parse_record(). All
+        records are parsed at once column by column; malformed records are
+        skipped.
+        """
+
+        records = [line.split(b" ", 3) for line in lines]
+        records = [record for record in records
+                   if len(record) == 4 and record[0].isdigit()]
+
+        # make sure all senders have ids
+        sender_ids = RECORD_SENDER_IDS[version]
+        for raw_sender in {record[2] for record in records}:
+            if raw_sender not in sender_ids:
+                sender_ids[raw_sender] = get_sender_id(
+                    parse_sender(raw_sender, version))
+
+        msgs = [record[3] for record in records]
+        if version >= 2:
+            msgs = [unescape_field(msg) if b"\\" in msg else msg
+                    for msg in msgs]
+
+        self.tstamps.extend([int(record[0]) for record in records])
+        self.flags.extend([FLAG_OWN if record[1] == b"OUT" else 0
+                           for record in records])
+        self.senders.extend([sender_ids[record[2]] for record in records])
+        ends = itertools.accumulate([len(msg) for msg in msgs],
+                                    initial=self.offset + len(self.arena))
+        next(ends)
+        self.ends.extend(ends)
+        self.arena += b"".join(msgs)
+
+    def clear(self):
+        """
+        Remove all messages from the log
+        """
+
+        self._init_columns()
+
+    def remove_first(self, num):
+        """
+        Remove the first num messages from the log
+        """
+
+        num = min(num, len(self))
+        if num <= 0:
+            return
+        end = self.ends[num - 1]
+        del self.arena[:end - self.offset]
+        self.offset = end
+        self.read_index = max(0, self.read_index - num)
+        del self.lines[:num]
+        self.num_lines -= sum(self.line_counts[:num])
+        del self.line_counts[:num]
+        del self.tstamps[:num]
+        del self.flags[:num]
+        del self.senders[:num]
+        del self.ends[:num]
+
+    def insert_first(self, log_msgs):
+        """
+        Insert LogMessages log_msgs before the first message of the log
+        """
+
+        log_msgs = list(log_msgs) + self[:]
+        self._init_columns()
+        for log_msg in log_msgs:
+            LogStore.append(self, log_msg)
+
+    def load_older(self):
+        """
+        Load messages older than the first message of the log, e.g., when the
+        user scrolls beyond it. Return the number of loaded messages.
+        """
+
+        # all messages are in memory
+        return 0
+
+    def _format_lines(self):
+        """
+        Helper for formatting the messages that are not in the cache of
+        formatted messages yet
+        """
+
+        for index in range(len(self.lines), len(self)):
+            self.lines.append("{0} {1}: {2}\n".format(
+                format_time(self.tstamps[index]),
+                SHORT_SENDERS[self.senders[index]],
+                self._get_text(index)))
+
+    def iter_lines(self):
+        """
+        Iterate over the formatted messages in the log without creating
+        LogMessages. Yield (formatted message, own, is_read) tuples.
+        """
+
+        self._format_lines()
+        for index, line in enumerate(self.lines):
+            flags = self.flags[index]
+            yield line, flags & FLAG_OWN, \
+                index < self.read_index or bool(flags & FLAG_READ)
+
+    @staticmethod
+    def _count_lines(line, width):
+        """
+        Helper for counting the lines the formatted message line uses in a
+        pad with width
+        """
+
+        parts = line.split("\n")
+        lines = len(parts) - 1
+        for part in parts:
+            if len(part) >= width:
+                lines += len(part) // width
+        return lines
+
+    def get_num_lines(self, width, num=None):
+        """
+        Get number of lines the first num messages, or all messages if num is
+        None, use in a pad with width
+        """
+
+        # line counts depend on the width, e.g., after a resize
+        if width != self.lines_width:
+            self.line_counts = array("I")
+            self.lines_width = width
+            self.num_lines = 0
+
+        # count lines of messages added since the last call
+        self._format_lines()
+        for index in range(len(self.line_counts), len(self)):
+            count = self._count_lines(self.lines[index], width)
+            self.line_counts.append(count)
+            self.num_lines += count
+
+        if num is None:
+            return self.num_lines
+        return sum(self.line_counts[:num])
+
+    def get_unread(self):
+        """
+        Get number of unread messages in the log
+        """
+
+        flagged = sum(1 for flags in self.flags[self.read_index:]
+                      if flags & FLAG_READ)
+        return len(self) - self.read_index - flagged
+
+    def set_read(self, num):
+        """
+        Mark the first num messages in the log as read, the others as unread
+        """
+
+        self.read_index = max(0, min(num, len(self)))
+
+    def mark_all_read(self):
+        """
+        Mark all messages in the log as read
+        """
+
+        self.read_index = len(self)
+
+
+class ScrollbackStore(LogStore):
+    """
+    Class for logs with bounded scrollback: only the last max_len messages
+    are kept in memory, older messages are spilled to a rotating scrollback
+    file and loaded from it again when the user scrolls back
+    """
+
+    def __init__(self, file_name, max_len=None):
+        self.file_name = file_name
+        self.max_len = max_len or SCROLLBACK_LINES
+        self.logger = None
+
+        # number of first messages loaded from the scrollback file; they are
+        # the last messages in the scrollback file
+        self.loaded = 0
+
+        LogStore.__init__(self)
+
+    def append(self, log_msg):
+        """
+        Add LogMessage log_msg to the end of the log and spill old messages
+        to the scrollback file if there are too many in memory
+        """
+
+        LogStore.append(self, log_msg)
+        if len(self) > self.max_len + SCROLLBACK_TRIM:
+            self.trim()
+
+    def clear(self):
+        """
+        Remove all messages from the log
+        """
+
+        LogStore.clear(self)
+        self.loaded = 0
+
+    def trim(self):
+        """
+        Remove messages from memory until there are only max_len left, spill
+        them to the scrollback file unless they were loaded from it
+        """
+
+        num = len(self) - self.max_len
+        if num <= 0:
+            return
+        lines = [create_log_line(self._get(index))
+                 for index in range(min(num, self.loaded), num)]
+        if lines:
+            self.get_logger().info("\r\n".join(lines))
+            nuqql.stats.count("scrollback.spilled", len(lines))
+        self.loaded = max(0, self.loaded - num)
+        self.remove_first(num)
+
+    def get_logger(self):
+        """
+        Get logger for the scrollback file, create it and remove scrollback
+        files of previous runs on first use
+        """
+
+        if self.logger is None:
+            for index in range(SCROLLBACK_FILE_COUNT + 1):
+                file_name = self.file_name
+                if index:
+                    file_name += ".{}".format(index)
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass
+            self.logger = get_scrollback_logger(self.file_name)
+        return self.logger
+
+    def load_older(self):
+        """
+        Load messages older than the first message of the log from the
+        scrollback file. Return the number of loaded messages.
+        """
+
+        if self.logger is None:
+            return 0
+
+        # read scrollback files from oldest to newest
+        lines = []
+        for index in range(SCROLLBACK_FILE_COUNT, -1, -1):
+            file_name = self.file_name
+            if index:
+                file_name += ".{}".format(index)
+            try:
+                with open(file_name, newline="\r\n") as in_file:
+                    lines += in_file.readlines()
+            except FileNotFoundError:
+                continue
+
+        # last loaded messages are already in memory
+        end = len(lines) - self.loaded
+        if end <= 0:
+            return 0
+        start = max(0, end - SCROLLBACK_LOAD_LINES)
+        log_msgs = []
+        for line in lines[start:end]:
+            log_msg = parse_log_line(line)
+            log_msg.is_read = True
+            log_msgs.append(log_msg)
+        self.insert_first(log_msgs)
+        self.loaded += len(log_msgs)
+        nuqql.stats.count("scrollback.loaded", len(log_msgs))
+        return len(log_msgs)
+
+
 ####################
 # Helper Functions #
 ####################
@@ -95,6 +582,20 @@ def get_conv_path(conv):
     return conv_dir
 
 
+def get_account_path(backend_name, acc_id):
+    """
+    Get path for account specific files as a string and make sure it exists
+    """
+
+    # construct directory path
+    acc_dir = str(pathlib.Path.home()) + \
+        "/.config/nuqql/account/{}/{}".format(backend_name, acc_id)
+    # make sure directory exists
+    pathlib.Path(acc_dir).mkdir(parents=True, exist_ok=True)
+
+    return acc_dir
+
+
 def get_logger(name, file_name):
     """
     Create a logger for a conversation
@@ -125,132 +626,489 @@ def get_logger(name, file_name):
     return logger
 
 
+def get_scrollback_logger(file_name):
+    """
+    Create a logger for a scrollback file, rotated when it is full
+    """
+
+    # create logger without propagation to the root logger
+    logger = logging.getLogger("scrollback " + file_name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    if logger.handlers:
+        return logger
+
+    # create handler
+    pathlib.Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    fileh = logging.handlers.RotatingFileHandler(
+        file_name, maxBytes=SCROLLBACK_FILE_SIZE,
+        backupCount=SCROLLBACK_FILE_COUNT)
+    fileh.setLevel(logging.DEBUG)
+    fileh.terminator = "\r\n"
+    fileh.setFormatter(logging.Formatter(fmt="%(message)s"))
+    logger.addHandler(fileh)
+
+    return logger
+
+
+def get_scrollback_file(name):
+    """
+    Get path of the scrollback file of the log with name
+    """
+
+    return SCROLLBACK_DIR + "/" + name
+
+
 def init_logger(conv):
     """
-    Init logger for a conversation
+    Init logger for a conversation. New log files are created with the
+    current format version, older log files are upgraded in the background.
     """
 
     # get log dir and make sure it exists
     log_dir = get_conv_path(conv)
+    log_file = log_dir + HISTORY_FILE
+
+    # check format version of log file
+    header = b""
+    try:
+        with open(log_file, "rb") as in_file:
+            header = in_file.read(len(HISTORY_HEADER))
+    except FileNotFoundError:
+        pass
+    if not header:
+        with open(log_file, "wb") as out_file:
+            out_file.write(HISTORY_HEADER)
+    elif header != HISTORY_HEADER:
+        conv.history.version = 1
 
     # create logger with log name and log file
     log_name = "{} {} {}".format(conv.backend.name, conv.account.aid,
                                  conv.name)
-    log_file = log_dir + HISTORY_FILE
     logger = get_logger(log_name, log_file)
+    conv.history.logger, conv.history.log_file = logger, log_file
+    if conv.history.version < HISTORY_VERSION:
+        start_upgrade(conv)
 
     # return the ready logger and the log file to caller
     return logger, log_file
 
 
-def parse_log_line(line):
+def start_upgrade(conv):
+    """
+    Upgrade the conversation's log file to the current format version in a
+    helper thread. Until the upgrade is finished by check_upgrades(), the
+    log file is still used with its old format version.
+    """
+
+    job = SimpleNamespace(
+        conv=conv,
+        file_name=conv.history.log_file,
+        upgrade_file=conv.history.log_file + UPGRADE_SUFFIX,
+        # offset of the next record to convert in the old file
+        offset=0,
+        # size of the new file and number of records in it
+        size=0,
+        count=0,
+        # size of and number of records in the new file after each record of
+        # the old file, for moving the read watermark
+        sizes=array("Q"),
+        counts=array("Q"),
+        error=None,
+    )
+    UPGRADE.jobs.put(job)
+    if UPGRADE.thread is None:
+        UPGRADE.thread = threading.Thread(target=_run_upgrades, daemon=True)
+        UPGRADE.thread.start()
+
+
+def _run_upgrades():
+    """
+    Helper thread: convert log files of upgrade jobs to the current format
+    version and hand them over to check_upgrades()
+    """
+
+    while True:
+        job = UPGRADE.jobs.get()
+        try:
+            with open(job.upgrade_file, "wb") as out_file:
+                out_file.write(HISTORY_HEADER)
+                job.size = len(HISTORY_HEADER)
+                convert_log(job, out_file)
+        except OSError as error:
+            job.error = error
+        UPGRADE.done.put(job)
+
+
+def convert_log(job, out_file):
+    """
+    Convert the records of the old log file of upgrade job from job.offset
+    to the last complete record to the current format version and write them
+    to out_file
+    """
+
+    for version, offset, lines in iter_history_chunks(job.file_name,
+                                                      job.offset):
+        out_lines = []
+        for line in lines:
+            try:
+                tstamp, own, sender, msg = parse_record(line, version)
+                log_msg = LogMessage(tstamp, sender,
+                                     msg.decode(errors="replace"), own=own)
+                out_line = (create_log_line(log_msg) + "\r\n").encode()
+                out_lines.append(out_line)
+                job.size += len(out_line)
+                job.count += 1
+            except ValueError:
+                # skip malformed records
+                pass
+            job.sizes.append(job.size)
+            job.counts.append(job.count)
+            offset += len(line) + 2
+        out_file.write(b"".join(out_lines))
+        job.offset = offset
+
+
+def check_upgrades():
+    """
+    Finish upgrades of log files converted by the helper thread: convert the
+    records written in the meantime, replace the old log file, and move the
+    read watermark to the new log file. Called from the main loop.
+    """
+
+    while True:
+        try:
+            job = UPGRADE.done.get_nowait()
+        except queue.Empty:
+            return
+        finish_upgrade(job)
+
+
+def finish_upgrade(job):
+    """
+    Finish upgrade job, see check_upgrades()
+    """
+
+    conv = job.conv
+    if job.error:
+        nuqql.stats.count("history.upgrade_errors")
+        return
+
+    # get read watermark in the old log file
+    flush_log(conv)
+    count, unused_offset = get_lastread(conv)
+
+    # replace old log file, the logger has to reopen it
+    try:
+        with open(job.upgrade_file, "ab") as out_file:
+            convert_log(job, out_file)
+        os.replace(job.upgrade_file, job.file_name)
+    except OSError:
+        nuqql.stats.count("history.upgrade_errors")
+        return
+    for handler in conv.history.logger.handlers:
+        handler.acquire()
+        try:
+            if handler.stream:
+                handler.stream.close()
+                handler.stream = None
+        finally:
+            handler.release()
+    conv.history.version = HISTORY_VERSION
+    nuqql.stats.count("history.upgrades")
+
+    # move read watermark
+    lastread = (0, 0)
+    if count and job.counts:
+        index = min(count, len(job.counts)) - 1
+        lastread = (job.counts[index], job.sizes[index])
+    write_lastread(conv, lastread)
+
+
+def parse_log_line(line, version=HISTORY_VERSION):
+    """
+    Parse line from log file with the given format version and return a
+    LogMessage
+    """
+
+    tstamp, own, sender, msg = parse_record(line[:-2].encode(), version)
+    return LogMessage(tstamp, sender, msg.decode(errors="replace"), own=own)
+
+
+def unescape_field(data):
+    """
+    Replace escape sequences in a field of a version 2 record
+    """
+
+    return UNESCAPE_RE.sub(lambda match: UNESCAPES.get(match.group(1),
+                                                       match.group(1)), data)
+
+
+def parse_sender(raw_sender, version):
     """
-    Parse line from log file and return a LogMessage
+    Get sender from the raw sender field of a record with the given format
+    version
     """
 
-    # parse line
-    parts = line.split(sep=" ", maxsplit=3)
-    tstamp = parts[0]
-    direction = parts[1]
-    is_own = False
-    if direction == "OUT":
-        is_own = True
-    sender = parts[2]
-    msg = parts[3][:-2]
-    tstamp = datetime.datetime.fromtimestamp(int(tstamp))
+    if version >= 2 and b"\\" in raw_sender:
+        raw_sender = unescape_field(raw_sender)
+    return sys.intern(raw_sender.decode(errors="replace"))
+
+
+def parse_record(line, version):
+    """
+    Parse record line of a history file with the given format version,
+    without the line terminator. Return timestamp, own, sender, and the
+    message as UTF-8 encoded bytes, or raise ValueError if the record is
+    malformed.
+    """
 
-    # create and return LogMessage
-    log_msg = LogMessage(tstamp, sender, msg, own=is_own)
-    return log_msg
+    parts = line.split(b" ", 3)
+    if len(parts) != 4 or not parts[0].isdigit():
+        raise ValueError("malformed history record")
+    msg = parts[3]
+    if version >= 2 and b"\\" in msg:
+        msg = unescape_field(msg)
+    return (int(parts[0]), parts[1] == b"OUT",
+            parse_sender(parts[2], version), msg)
 
 
-def create_log_line(log_msg):
+def iter_history_chunks(file_name, offset=0):
     """
-    Create a line for the log files from a LogMessage
+    Iterate over the records of history file file_name from offset on in
+    chunks, without reading the whole file into memory. Files of all format
+    versions are supported. Yield (format version, offset of the first
+    record, list of records) tuples, records without line terminators.
+    """
+
+    try:
+        in_file = open(file_name, "rb")
+    except FileNotFoundError:
+        return
+
+    with in_file:
+        # empty files cannot be mapped
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            version = 1
+            if data[:len(HISTORY_HEADER)] == HISTORY_HEADER:
+                version = HISTORY_VERSION
+                offset = max(offset, len(HISTORY_HEADER))
+
+            while offset < len(data):
+                # read a chunk of complete records; a chunk contains at
+                # least one record
+                chunk = data[offset:offset + HISTORY_CHUNK_SIZE]
+                last = chunk.rfind(b"\r\n")
+                if last < 0:
+                    last = data.find(b"\r\n", offset) - offset
+                    if last < 0:
+                        return
+                    chunk = data[offset:offset + last]
+                yield version, offset, chunk[:last].split(b"\r\n")
+                offset += last + 2
+
+
+def create_log_line(log_msg, version=HISTORY_VERSION):
+    """
+    Create a line for the log files with the given format version from a
+    LogMessage
     """
 
     # determine log line contents
-    tstamp = round(log_msg.tstamp.timestamp())
+    tstamp = log_msg.tstamp
     direction = "IN"
     sender = log_msg.sender
     if log_msg.own:
         direction = "OUT"
         sender = "you"
     msg = log_msg.msg
+    if version >= 2:
+        sender = sender.translate(ESCAPE_SENDER)
+        msg = msg.translate(ESCAPE_MSG)
 
     return "{} {} {} {}".format(tstamp, direction, sender, msg)
 
 
 def get_lastread(conv):
     """
-    Get last read message from "lastread" file of the conversation
+    Get read watermark of the conversation from its "lastread" file: the
+    number of read messages in the history file and the offset of the first
+    unread message in it. Legacy "lastread" files contain the last read
+    message instead, it is looked up in the history file.
     """
 
+    if conv.history.lastread is not None:
+        return conv.history.lastread
+
     # get lastread dir and make sure it exists
     lastread_dir = get_conv_path(conv)
     lastread_file = lastread_dir + LASTREAD_FILE
 
+    line = ""
     try:
         with open(lastread_file, newline="\r\n") as in_file:
-            lines = in_file.readlines()
-            for line in lines:
-                log_msg = parse_log_line(line)
-                log_msg.is_read = True
-                return log_msg
+            line = in_file.readline()
+    except FileNotFoundError:
+        pass
+
+    # no lastread file means no messages have been read
+    lastread = (0, 0)
+    parts = line[:-2].split(" ")
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        lastread = (int(parts[0]), int(parts[1]))
+    elif line:
+        lastread = find_lastread(conv, parse_log_line(line, version=1))
+    conv.history.lastread = lastread
+    return lastread
+
+
+def find_lastread(conv, last_read):
+    """
+    Get read watermark from the legacy last read LogMessage last_read by
+    looking it up in the history file. If it is not found, all messages
+    count as read.
+    """
+
+    # count all records like get_unread(), including malformed ones
+    count = 0
+    offset = 0
+    msg = last_read.msg.encode()
+    for version, offset, lines in iter_history_chunks(conv.history.log_file):
+        for line in lines:
+            count += 1
+            offset += len(line) + 2
+            try:
+                tstamp, unused_own, sender, text = parse_record(line, version)
+            except ValueError:
+                continue
+            if tstamp == last_read.tstamp and sender == last_read.sender and \
+               text == msg:
+                return count, offset
+    return count, offset
+
+
+def read_history_tail(conv, offset):
+    """
+    Read the conversation's history file from offset, skipping the header,
+    and return the offset and the data as bytes
+    """
+
+    try:
+        with open(conv.history.log_file, "rb") as in_file:
+            if offset == 0 and \
+               in_file.read(len(HISTORY_HEADER)) == HISTORY_HEADER:
+                offset = len(HISTORY_HEADER)
+            in_file.seek(offset)
+            return offset, in_file.read()
     except FileNotFoundError:
-        return None
+        return offset, b""
 
 
-def set_lastread(conv, log_msg):
+def get_unread(conv):
     """
-    Set last read message in "lastread" file of the conversation
+    Get number of unread messages in the conversation's history file
+    """
+
+    if conv.history.log_file is None:
+        return 0
+
+    unused_count, offset = get_lastread(conv)
+    unused_offset, tail = read_history_tail(conv, offset)
+    return tail.count(b"\r\n")
+
+
+def set_lastread(conv):
+    """
+    Set read watermark in "lastread" file of the conversation to the end of
+    the history file, i.e., mark all messages in it as read
+    """
+
+    if conv.history.log_file is None:
+        return
+
+    # move watermark over the messages written since the last one
+    flush_log(conv)
+    count, offset = get_lastread(conv)
+    offset, tail = read_history_tail(conv, offset)
+    write_lastread(conv, (count + tail.count(b"\r\n"), offset + len(tail)))
+
+
+def write_lastread(conv, lastread):
+    """
+    Write read watermark lastread to "lastread" file of the conversation
     """
 
     # get lastread dir and make sure it exists
     lastread_dir = get_conv_path(conv)
     lastread_file = lastread_dir + LASTREAD_FILE
 
-    # create log line and write it to lastread file
-    line = create_log_line(log_msg) + "\r\n"
-    lines = []
-    lines.append(line)
-    with open(lastread_file, "w+") as in_file:
-        lines = in_file.writelines(lines)
+    # write watermark to lastread file
+    conv.history.lastread = lastread
+    with open(lastread_file, "w+") as out_file:
+        out_file.write("{} {}\r\n".format(*lastread))
 
 
-def get_last_log_line(conv):
+def get_msg_digest(sender, msg):
     """
-    Read last LogMessage from log file
+    Get a digest of a message, used to recognize messages that were already
+    received
     """
 
-    # get history dir and make sure it exists
-    history_dir = get_conv_path(conv)
-    history_file = history_dir + HISTORY_FILE
+    return hashlib.sha1((sender + " " + msg).encode()).hexdigest()
+
+
+def get_collect_mark(backend_name, acc_id):
+    """
+    Get high-water mark of received messages from "lastcollect" file of the
+    account: the timestamp of the last received messages and the digests
+    of all messages received with this timestamp as a Counter
+    """
+
+    # get lastcollect dir and make sure it exists
+    collect_dir = get_account_path(backend_name, acc_id)
+    collect_file = collect_dir + COLLECT_FILE
 
     try:
-        # negative seeking requires binary mode
-        with open(history_file, "rb") as in_file:
-            # check if file contains at least 2 bytes
-            in_file.seek(0, os.SEEK_END)
-            if in_file.tell() < 3:
-                return None
-
-            # try to find last line
-            in_file.seek(-3, os.SEEK_END)
-            while in_file.read(2) != b"\r\n":
-                try:
-                    in_file.seek(-3, os.SEEK_CUR)
-                except IOError:
-                    in_file.seek(-2, os.SEEK_CUR)
-                    if in_file.tell() == 0:
-                        break
-
-            # read and return last line as LogMessage
-            last_line = in_file.read()
-            log_msg = parse_log_line(last_line.decode())
-            return log_msg
+        with open(collect_file, newline="\r\n") as in_file:
+            lines = [line[:-2] for line in in_file.readlines()]
     except FileNotFoundError:
-        return None
+        return 0, Counter()
+
+    # first line is the timestamp, remaining lines are message digests and
+    # how often they were received; older files only contain the digests
+    try:
+        tstamp = int(lines[0])
+    except (IndexError, ValueError):
+        return 0, Counter()
+    digests = Counter()
+    for line in lines[1:]:
+        digest, unused_sep, count = line.partition(" ")
+        try:
+            digests[digest] += int(count or 1)
+        except ValueError:
+            continue
+    return tstamp, digests
+
+
+def set_collect_mark(backend_name, acc_id, tstamp, digests):
+    """
+    Set high-water mark of received messages in "lastcollect" file of the
+    account, digests is a Counter of message digests
+    """
+
+    # get lastcollect dir and make sure it exists
+    collect_dir = get_account_path(backend_name, acc_id)
+    collect_file = collect_dir + COLLECT_FILE
+
+    # write timestamp and digests to lastcollect file
+    lines = ["{}\r\n".format(tstamp)]
+    for digest, count in digests.items():
+        lines.append("{} {}\r\n".format(digest, count))
+    with open(collect_file, "w+") as out_file:
+        out_file.writelines(lines)
 
 
 def init_log_from_file(conv):
@@ -258,43 +1116,71 @@ def init_log_from_file(conv):
     Initialize a conversation's log from the conversation's log file
     """
 
-    # get last read log message
-    last_read = get_lastread(conv)
-    is_read = True
-
-    lines = []
-    with open(conv.history.log_file, newline="\r\n") as in_file:
-        lines = in_file.readlines()
-        for line in lines:
-            # add log message to the conversation's log
-            log_msg = parse_log_line(line)
-            log_msg.is_read = is_read
-            conv.history.log.append(log_msg)
-
-            # if this is the last read message, following message will be
-            # marked as unread
-            if last_read and last_read.is_equal(log_msg):
-                is_read = False
-    if lines:
+    if conv.history.log_file is None:
+        return
+
+    # get number of read records in the log file, malformed ones included
+    count, unused_offset = get_lastread(conv)
+    log_store = conv.history.log
+    start = len(log_store)
+    read_end = start
+
+    # add log messages to the conversation's log; malformed records are
+    # skipped, so the read watermark is the end of the messages loaded from
+    # the first count records
+    for version, unused_offset, lines in iter_history_chunks(
+            conv.history.log_file):
+        if count > 0:
+            read_lines, lines = lines[:count], lines[count:]
+            count -= len(read_lines)
+            log_store.extend_records(read_lines, version)
+            read_end = len(log_store)
+        log_store.extend_records(lines, version)
+    log_store.set_read(read_end)
+    if len(log_store) > start:
         # if there were any log messages in the log file, put a marker in the
-        # log where the new messages start
-        tstamp = datetime.datetime.now()
+        # log where the new messages start; it is read even if there are
+        # unread messages before it
+        tstamp = int(time.time())
         log_msg = LogMessage(tstamp, "<event>", "<Started new conversation.>",
                              own=True)
         log_msg.is_read = True
-        conv.history.log.append(log_msg)
+        log_store.append(log_msg)
 
 
-def log(conv, log_msg):
+def flush_log(conv):
     """
-    Write LogMessage to history log file and set lastread message
+    Write pending lines of a conversation to history log file in one write
     """
 
-    # create line and write it to history
-    line = create_log_line(log_msg)
-    conv.history.logger.info(line)
+    pending = conv.history.pending
+    if not pending:
+        return
+    conv.history.logger.info("\r\n".join(pending))
+    pending.clear()
+    nuqql.stats.trace("persist")
+
+
+def log(conv, log_msg, bulk=False):
+    """
+    Write LogMessage to history log file and move the read watermark. If
+    bulk is True, the line is only added to the pending lines, see
+    flush_log().
+    """
+
+    # conversations without log file, e.g., of replay backends, have no history
+    if conv.history.log_file is None:
+        return
+
+    # create line and write it to history together with all pending lines
+    line = create_log_line(log_msg, conv.history.version)
+    nuqql.stats.count("history.lines")
+    conv.history.pending.append(line)
+    if bulk:
+        return
+    flush_log(conv)
 
     # assume user read all previous messages when user sends a message and set
     # lastread accordingly
     if log_msg.own:
-        set_lastread(conv, log_msg)
+        set_lastread(conv)
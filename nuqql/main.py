@@ -6,34 +6,84 @@ Main part of nuqql.
 # Main Part #
 #############
 
+import argparse
+import functools
 import signal
 
 import nuqql.backend
+import nuqql.eventloop
+import nuqql.history
+import nuqql.stats
 import nuqql.ui
+import nuqql.watchdog
 
 
 ###############
 # MAIN (LOOP) #
 ###############
 
-def main_loop():
+def main_loop(io_thread=False, event_loop=False):
     """
-    Main loop of nuqql.
+    Main loop of nuqql. If io_thread is set, backend messages are read and
+    parsed in a separate network thread. If event_loop is set, the asyncio
+    event loop is used instead of polling.
     """
 
     try:
         # init and start all backends
         nuqql.backend.start_backends()
 
+        # start network thread and let it wake up the main loop
+        if io_thread:
+            nuqql.ui.set_wake_fd(nuqql.backend.start_io_thread())
+
+        # watch main loop for slow iterations and stalls
+        nuqql.watchdog.start()
+
+        # run event loop as long as user does not quit
+        if event_loop:
+            nuqql.eventloop.run()
+            return ""
+
         # loop as long as user does not quit
-        while nuqql.ui.handle_input():
+        while True:
+            # wait for user input, the wait is not part of the iteration
+            chars = nuqql.ui.read_input()
+            nuqql.watchdog.start_iteration()
+
+            # handle user input
+            nuqql.watchdog.start_stage("handle_input")
+            if not nuqql.ui.handle_input(chars):
+                break
+
+            # restart/reconnect backends that went down
+            nuqql.watchdog.start_stage("supervise_backends")
+            nuqql.backend.supervise_backends()
+
             # update buddies
+            nuqql.watchdog.start_stage("update_buddies")
             nuqql.backend.update_buddies()
 
-            # handle network input
-            nuqql.backend.handle_network()
+            # finish upgrades of history files
+            nuqql.watchdog.start_stage("check_upgrades")
+            nuqql.history.check_upgrades()
+
+            # handle network input; if there are more messages, do not wait
+            # for user input in the next iteration
+            nuqql.watchdog.start_stage("handle_network")
+            more = nuqql.backend.handle_network()
+            nuqql.ui.set_blocking(not more)
+
+            # check duration of this iteration, collect stats and dump them
+            # if it is due
+            duration = nuqql.watchdog.end_iteration()
+            nuqql.stats.observe("main.loop_time", duration)
+            nuqql.stats.check_dump()
     finally:
-        # shut down backends
+        # stop watchdog and network thread and shut down backends
+        nuqql.watchdog.stop()
+        nuqql.backend.stop_io_thread()
+        nuqql.ui.set_wake_fd(None)
         nuqql.backend.stop_backends()
 
     # quit nuqql
@@ -46,8 +96,20 @@ def run():
     Main entry point of nuqql
     """
 
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description="Run nuqql.")
+    parser.add_argument("--io-thread", action="store_true",
+                        help="read and parse backend messages in a separate "
+                        "network thread")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="use an asyncio event loop instead of polling")
+    args = parser.parse_args()
+    if args.io_thread and args.asyncio:
+        parser.error("--io-thread and --asyncio cannot be combined")
+
     # ignore SIGINT
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     # initialize ui and run main_loop
-    nuqql.ui.init(main_loop)
+    nuqql.ui.init(functools.partial(main_loop, io_thread=args.io_thread,
+                                    event_loop=args.asyncio))
@@ -0,0 +1,151 @@
+"""
+Profiling: on-demand cProfile and tracemalloc hooks for nuqql
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+from pathlib import Path
+from types import SimpleNamespace
+
+# directory for profiles and memory snapshots
+PROFILE_DIR = str(Path.home()) + "/.config/nuqql/profiles"
+
+# number of entries shown in summaries
+PROFILE_TOP = 20
+
+# number of frames stored in tracemalloc tracebacks
+TRACEMALLOC_FRAMES = 1
+
+# state of profiling
+PROFILE = SimpleNamespace(
+    # current or last cProfile profiler
+    profiler=None,
+    # is profiler running?
+    running=False,
+    # last tracemalloc snapshot
+    snapshot=None,
+)
+
+
+def get_file_name(file_name, prefix, suffix):
+    """
+    Helper for getting the path of a file in the profile directory. If
+    file_name is None, a name is created from prefix, the current time and
+    suffix.
+    """
+
+    Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+    if file_name is None:
+        file_name = "{}-{}{}".format(prefix, time.strftime("%Y%m%d-%H%M%S"),
+                                     suffix)
+    return os.path.join(PROFILE_DIR, file_name)
+
+
+def start_profile():
+    """
+    Start profiling, the profile covers everything nuqql does until it is
+    stopped. Return False if profiling is already running.
+    """
+
+    if PROFILE.running:
+        return False
+    PROFILE.profiler = cProfile.Profile()
+    PROFILE.profiler.enable()
+    PROFILE.running = True
+    return True
+
+
+def stop_profile():
+    """
+    Stop profiling and return a summary of the profile as a list of lines
+    """
+
+    if not PROFILE.running:
+        return None
+    PROFILE.profiler.disable()
+    PROFILE.running = False
+    return get_profile_summary()
+
+
+def get_profile_summary():
+    """
+    Get summary of the current or last profile: the top functions sorted
+    by cumulative time, as a list of lines
+    """
+
+    # creating the stats disables the profiler, resume a running profile
+    output = io.StringIO()
+    stats = pstats.Stats(PROFILE.profiler, stream=output)
+    if PROFILE.running:
+        PROFILE.profiler.enable()
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    return [line for line in output.getvalue().splitlines() if line.strip()]
+
+
+def dump_profile(file_name=None):
+    """
+    Write current or last profile to file_name in the profile directory and
+    return the path of the file, or None if there is no profile
+    """
+
+    if PROFILE.profiler is None:
+        return None
+    # dumping the stats disables the profiler, resume a running profile
+    path = get_file_name(file_name, "profile", ".prof")
+    PROFILE.profiler.dump_stats(path)
+    if PROFILE.running:
+        PROFILE.profiler.enable()
+    return path
+
+
+def take_snapshot():
+    """
+    Take a memory snapshot with tracemalloc and write it to the profile
+    directory. Memory tracing is started with the first snapshot, so the
+    first snapshot only contains memory allocated afterwards. Return the
+    path of the snapshot file and a summary of the snapshot as a list of
+    lines.
+    """
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    snapshot = tracemalloc.take_snapshot()
+    PROFILE.snapshot = snapshot
+    path = get_file_name(None, "memory", ".snapshot")
+    snapshot.dump(path)
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines = ["traced: {} KiB, peak: {} KiB".format(current // 1024,
+                                                   peak // 1024)]
+    for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+        lines.append(str(stat))
+    return path, lines
+
+
+def diff_snapshot():
+    """
+    Take a new memory snapshot and compare it to the last one. Return a
+    summary of the differences as a list of lines, or None if there is no
+    previous snapshot.
+    """
+
+    if PROFILE.snapshot is None or not tracemalloc.is_tracing():
+        return None
+    old = PROFILE.snapshot
+    PROFILE.snapshot = tracemalloc.take_snapshot()
+    diff = PROFILE.snapshot.compare_to(old, "lineno")
+    return [str(stat) for stat in diff[:PROFILE_TOP]]
+
+
+def stop_memory():
+    """
+    Stop memory tracing and forget the last snapshot
+    """
+
+    PROFILE.snapshot = None
+    tracemalloc.stop()
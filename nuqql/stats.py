@@ -0,0 +1,303 @@
+"""
+Stats: runtime metrics of nuqql's hot paths
+"""
+
+import json
+import random
+import time
+
+from pathlib import Path
+from types import SimpleNamespace
+
+# file for dumping stats
+STATS_FILE = str(Path.home()) + "/.config/nuqql/stats.json"
+
+# interval in seconds for dumping stats periodically; 0 disables it
+STATS_DUMP_INTERVAL = 0
+
+# number of samples kept in each histogram for calculating percentiles
+RESERVOIR_SIZE = 1024
+
+# percentiles shown for histograms
+PERCENTILES = (50, 90, 99)
+
+# counters: name -> count
+COUNTERS = {}
+
+# gauges: name -> last value
+GAUGES = {}
+
+# histograms: name -> Histogram
+HISTOGRAMS = {}
+
+# state of periodic stats dumps
+DUMP = SimpleNamespace(
+    # dump file
+    file=STATS_FILE,
+    # interval in seconds; 0 disables periodic dumps
+    interval=STATS_DUMP_INTERVAL,
+    # time of next dump
+    next=0,
+)
+
+# start time of stats collection
+START = SimpleNamespace(time=time.time())
+
+# stages of handling a received message for latency tracing, in order
+TRACE_STAGES = ("parse", "route", "persist", "paint")
+
+# latency trace of the message that is currently handled
+TRACE = SimpleNamespace(
+    # receive time of the message; None if no message is traced
+    stamp=None,
+    # time of the last traced stage
+    last=None,
+    # stages already traced
+    stages=set(),
+)
+
+
+class Histogram:
+    """
+    Class for histograms of values, e.g., durations. Percentiles are
+    calculated from a random sample of all values (reservoir sampling).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def add(self, value):
+        """
+        Add value to histogram
+        """
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        # keep a uniform random sample of all values
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(value)
+            return
+        index = random.randrange(self.count)
+        if index < RESERVOIR_SIZE:
+            self.samples[index] = value
+
+    def get_percentile(self, percentile):
+        """
+        Get percentile of values in histogram
+        """
+
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        index = min(len(samples) - 1, len(samples) * percentile // 100)
+        return samples[index]
+
+    def get_summary(self):
+        """
+        Get summary of histogram as dict
+        """
+
+        summary = {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+        for percentile in PERCENTILES:
+            summary["p{}".format(percentile)] = self.get_percentile(
+                percentile)
+        return summary
+
+
+def count(name, value=1):
+    """
+    Increase counter name by value
+    """
+
+    COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def gauge(name, value):
+    """
+    Set gauge name to value
+    """
+
+    GAUGES[name] = value
+
+
+def observe(name, value):
+    """
+    Add value to histogram name
+    """
+
+    hist = HISTOGRAMS.get(name)
+    if hist is None:
+        hist = Histogram()
+        HISTOGRAMS[name] = hist
+    hist.add(value)
+
+
+def start_trace(stamp):
+    """
+    Start tracing the latency of a message received at time stamp, see
+    time.perf_counter()
+    """
+
+    TRACE.stamp = stamp
+    TRACE.last = stamp
+    TRACE.stages = set()
+
+
+def trace(stage, now=None):
+    """
+    Record the latency of the traced message at stage, now or at time now:
+    the time since the message was received as "latency.<stage>" and the
+    time since the previous stage as "stage.<stage>". Only the first time a
+    message reaches a stage is recorded.
+    """
+
+    if TRACE.stamp is None or stage in TRACE.stages:
+        return
+    if now is None:
+        now = time.perf_counter()
+    observe("latency." + stage, now - TRACE.stamp)
+    observe("stage." + stage, now - TRACE.last)
+    TRACE.last = now
+    TRACE.stages.add(stage)
+
+
+def stop_trace():
+    """
+    Stop tracing the latency of the current message
+    """
+
+    TRACE.stamp = None
+
+
+def format_latency():
+    """
+    Format latency percentiles of all message handling stages in ms for
+    output in a log window and return them as a list of lines
+    """
+
+    lines = []
+    for stage in TRACE_STAGES:
+        for prefix in ("latency.", "stage."):
+            hist = HISTOGRAMS.get(prefix + stage)
+            if hist is None:
+                continue
+            summary = hist.get_summary()
+            values = " ".join(
+                "{}={:.3f}".format(key, summary[key] * 1000)
+                for key in ["p{}".format(p) for p in PERCENTILES] + ["max"])
+            lines.append("{}{}: n={} {} ms".format(
+                prefix, stage, summary["count"], values))
+    return lines
+
+
+def reset():
+    """
+    Reset all stats
+    """
+
+    COUNTERS.clear()
+    GAUGES.clear()
+    HISTOGRAMS.clear()
+    START.time = time.time()
+
+
+def get_stats():
+    """
+    Get all stats as dict
+    """
+
+    return {
+        "time": time.time(),
+        "start": START.time,
+        "counters": dict(COUNTERS),
+        "gauges": dict(GAUGES),
+        "histograms": {name: hist.get_summary()
+                       for name, hist in HISTOGRAMS.items()},
+    }
+
+
+def format_value(value):
+    """
+    Helper for formatting a value for output
+    """
+
+    if isinstance(value, float):
+        return "{:.6g}".format(value)
+    return str(value)
+
+
+def format_stats():
+    """
+    Format all stats for output in a log window and return them as a list
+    of lines
+    """
+
+    lines = ["uptime: {:.0f} s".format(time.time() - START.time)]
+    for name in sorted(COUNTERS):
+        lines.append("{}: {}".format(name, COUNTERS[name]))
+    for name in sorted(GAUGES):
+        lines.append("{}: {}".format(name, format_value(GAUGES[name])))
+    for name in sorted(HISTOGRAMS):
+        summary = HISTOGRAMS[name].get_summary()
+        values = " ".join("{}={}".format(key, format_value(value))
+                          for key, value in summary.items())
+        lines.append("{}: {}".format(name, values))
+    return lines
+
+
+def dump(file_name=None):
+    """
+    Write all stats as JSON to file_name or the configured dump file and
+    return the file name
+    """
+
+    if file_name is None:
+        file_name = DUMP.file
+    Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    with open(file_name, "w") as out_file:
+        json.dump(get_stats(), out_file, indent=4, sort_keys=True)
+    return file_name
+
+
+def set_autodump(interval, file_name=None):
+    """
+    Dump stats every interval seconds to file_name or the configured dump
+    file; interval 0 disables it
+    """
+
+    DUMP.interval = interval
+    if file_name is not None:
+        DUMP.file = file_name
+    DUMP.next = time.time() + interval
+
+
+def check_dump():
+    """
+    Dump stats, if a periodic dump is due
+    """
+
+    if not DUMP.interval:
+        return
+    now = time.time()
+    if now < DUMP.next:
+        return
+    DUMP.next = now + DUMP.interval
+    try:
+        dump()
+    except OSError:
+        # do not stop nuqql because of stats, try again next time
+        pass
@@ -0,0 +1,392 @@
+"""
+Stub screen: in-memory replacement for the subset of the curses API used by
+nuqql's windows. It allows measuring and checking rendering without a
+terminal, e.g., in benchmarks. install() makes nuqql.win use it instead of
+curses. Calls and bytes written are recorded per frame; a frame ends with a
+refresh.
+"""
+
+import curses
+import curses.ascii
+import sys
+
+from collections import Counter, deque
+from types import SimpleNamespace
+
+import nuqql.config
+import nuqql.win
+
+# curses' error and constants do not need a terminal, reuse them
+error = curses.error        # pylint: disable=invalid-name
+ascii = curses.ascii        # pylint: disable=redefined-builtin
+COLOR_BLACK = curses.COLOR_BLACK
+COLOR_BLUE = curses.COLOR_BLUE
+COLOR_CYAN = curses.COLOR_CYAN
+COLOR_GREEN = curses.COLOR_GREEN
+COLOR_MAGENTA = curses.COLOR_MAGENTA
+COLOR_RED = curses.COLOR_RED
+COLOR_WHITE = curses.COLOR_WHITE
+COLOR_YELLOW = curses.COLOR_YELLOW
+A_BOLD = curses.A_BOLD
+A_NORMAL = curses.A_NORMAL
+A_REVERSE = curses.A_REVERSE
+
+# maximum number of recorded frames
+MAX_FRAMES = 10000
+
+# state of the stub screen
+STATE = SimpleNamespace(
+    # installed stub screen, see install()
+    screen=None,
+    # color pairs, see init_pair()
+    pairs={},
+)
+
+
+class StubWindow:
+    """
+    In-memory curses window or pad
+    """
+
+    def __init__(self, nlines, ncols, begin_y=0, begin_x=0, is_pad=False):
+        if nlines <= 0 or ncols <= 0:
+            raise error("invalid window size")
+
+        # size and position
+        self.size_y = nlines
+        self.size_x = ncols
+        self.pos_y = begin_y
+        self.pos_x = begin_x
+        self.is_pad = is_pad
+
+        # cursor position and current attributes
+        self.cur_y = 0
+        self.cur_x = 0
+        self.attr = A_NORMAL
+
+        # window content: line number to line
+        self.lines = {}
+
+    def _record(self, name, num_bytes=0):
+        """
+        Record a call and the number of bytes written in the stub screen
+        """
+
+        if STATE.screen:
+            STATE.screen.record(name, num_bytes)
+
+    def getmaxyx(self):
+        """
+        Get window size
+        """
+
+        return self.size_y, self.size_x
+
+    def getbegyx(self):
+        """
+        Get window position
+        """
+
+        return self.pos_y, self.pos_x
+
+    def getyx(self):
+        """
+        Get cursor position
+        """
+
+        return self.cur_y, self.cur_x
+
+    def clear(self):
+        """
+        Clear window
+        """
+
+        self._record("clear")
+        self.lines = {}
+        self.cur_y = 0
+        self.cur_x = 0
+
+    def erase(self):
+        """
+        Erase window
+        """
+
+        self._record("erase")
+        self.lines = {}
+        self.cur_y = 0
+        self.cur_x = 0
+
+    def resize(self, nlines, ncols):
+        """
+        Resize window, content outside of the new size is lost
+        """
+
+        self._record("resize")
+        if nlines <= 0 or ncols <= 0:
+            raise error("invalid window size")
+        self.lines = {y: line[:ncols] for y, line in self.lines.items()
+                      if y < nlines}
+        self.size_y = nlines
+        self.size_x = ncols
+        self.cur_y = min(self.cur_y, nlines - 1)
+        self.cur_x = min(self.cur_x, ncols - 1)
+
+    def mvwin(self, new_y, new_x):
+        """
+        Move window
+        """
+
+        self._record("mvwin")
+        self.pos_y = new_y
+        self.pos_x = new_x
+
+    def move(self, new_y, new_x):
+        """
+        Move cursor
+        """
+
+        self._record("move")
+        if not 0 <= new_y < self.size_y or not 0 <= new_x < self.size_x:
+            raise error("wmove() returned ERR")
+        self.cur_y = new_y
+        self.cur_x = new_x
+
+    def attron(self, attr):
+        """
+        Switch attributes on
+        """
+
+        self._record("attron")
+        self.attr |= attr
+
+    def attroff(self, attr):
+        """
+        Switch attributes off
+        """
+
+        self._record("attroff")
+        self.attr &= ~attr
+
+    def border(self, *unused_args):
+        """
+        Draw border around window
+        """
+
+        self._record("border", 2 * (self.size_y + self.size_x))
+        self.lines[0] = "+" + "-" * (self.size_x - 2) + "+"
+        self.lines[self.size_y - 1] = self.lines[0]
+        for line in range(1, self.size_y - 1):
+            old = self.lines.get(line, "").ljust(self.size_x)
+            self.lines[line] = "|" + old[1:-1] + "|"
+
+    def addstr(self, *args):
+        """
+        Write string at cursor position or at the given position:
+        addstr([y, x,] str[, attr])
+        """
+
+        if len(args) >= 3:
+            self.move(args[0], args[1])
+            text = args[2]
+        else:
+            text = args[0]
+        self._record("addstr", len(text.encode()))
+        self._write(text)
+
+    def _put(self, text):
+        """
+        Helper for putting text without line breaks into the current line
+        """
+
+        line = self.lines.get(self.cur_y, "")
+        if len(line) < self.cur_x:
+            line = line.ljust(self.cur_x)
+        self.lines[self.cur_y] = line[:self.cur_x] + text + \
+            line[self.cur_x + len(text):]
+
+    def _write(self, text):
+        """
+        Helper for writing text at cursor position like curses: wrap at the
+        end of lines and fail at the end of the window
+        """
+
+        parts = text.split("\n")
+        for index, part in enumerate(parts):
+            # write part of text, wrap long lines
+            while part:
+                chunk = part[:self.size_x - self.cur_x]
+                part = part[len(chunk):]
+                self._put(chunk)
+                self.cur_x += len(chunk)
+                if self.cur_x >= self.size_x:
+                    if self.cur_y + 1 >= self.size_y:
+                        self.cur_x = self.size_x - 1
+                        raise error("addwstr() returned ERR")
+                    self.cur_y += 1
+                    self.cur_x = 0
+
+            # line break: clear rest of line and go to next line
+            if index < len(parts) - 1:
+                line = self.lines.get(self.cur_y, "")
+                self.lines[self.cur_y] = line[:self.cur_x]
+                if self.cur_y + 1 >= self.size_y:
+                    raise error("addwstr() returned ERR")
+                self.cur_y += 1
+                self.cur_x = 0
+
+    def refresh(self, *args):
+        """
+        Refresh window; pads need the pad position and the screen area:
+        refresh(pminrow, pmincol, sminrow, smincol, smaxrow, smaxcol)
+        """
+
+        if self.is_pad and len(args) != 6:
+            raise error("refresh() for a pad requires 6 arguments")
+        self._record("refresh")
+        if STATE.screen:
+            STATE.screen.end_frame(self)
+
+    def get_text(self):
+        """
+        Get content of window as list of lines
+        """
+
+        return [self.lines.get(y, "") for y in range(self.size_y)]
+
+
+class StubScreen(StubWindow):
+    """
+    In-memory curses screen that records calls and bytes written by all
+    windows per frame
+    """
+
+    def __init__(self, nlines=24, ncols=80):
+        StubWindow.__init__(self, nlines, ncols)
+
+        # user input for get_wch()
+        self.keys = deque()
+
+        # calls and bytes of the current frame and recorded frames
+        self.calls = Counter()
+        self.bytes = 0
+        self.frames = deque(maxlen=MAX_FRAMES)
+
+    def record(self, name, num_bytes=0):
+        """
+        Record a call and the number of bytes written in the current frame
+        """
+
+        self.calls[name] += 1
+        self.bytes += num_bytes
+
+    def end_frame(self, win):
+        """
+        End current frame with a refresh of window win and record it
+        """
+
+        self.frames.append(SimpleNamespace(
+            win=win,
+            calls=self.calls,
+            bytes=self.bytes,
+        ))
+        self.calls = Counter()
+        self.bytes = 0
+
+    def reset(self):
+        """
+        Reset recorded frames
+        """
+
+        self.calls = Counter()
+        self.bytes = 0
+        self.frames.clear()
+
+    def get_stats(self):
+        """
+        Get statistics of recorded frames: number of frames, calls and bytes
+        """
+
+        calls = Counter()
+        num_bytes = 0
+        for frame in self.frames:
+            calls.update(frame.calls)
+            num_bytes += frame.bytes
+        return {
+            "frames": len(self.frames),
+            "calls": dict(calls),
+            "bytes": num_bytes,
+        }
+
+    def get_wch(self):
+        """
+        Get next user input, raise error if there is none
+        """
+
+        if not self.keys:
+            raise error("no input")
+        return self.keys.popleft()
+
+    def timeout(self, delay):
+        """
+        Set input timeout, ignored
+        """
+
+    def nodelay(self, flag):
+        """
+        Set non-blocking input, ignored
+        """
+
+
+def init_pair(pair_number, fg_color, bg_color):
+    """
+    Initialize color pair
+    """
+
+    STATE.pairs[pair_number] = (fg_color, bg_color)
+
+
+def color_pair(pair_number):
+    """
+    Get attribute for color pair like curses
+    """
+
+    return pair_number << 8
+
+
+def newwin(nlines, ncols, begin_y=0, begin_x=0):
+    """
+    Create a new window
+    """
+
+    return StubWindow(nlines, ncols, begin_y, begin_x)
+
+
+def newpad(nlines, ncols):
+    """
+    Create a new pad
+    """
+
+    return StubWindow(nlines, ncols, is_pad=True)
+
+
+def install(nlines=24, ncols=80):
+    """
+    Make nuqql's windows use a new stub screen instead of curses and return
+    the stub screen
+    """
+
+    screen = StubScreen(nlines, ncols)
+    STATE.screen = screen
+    nuqql.win.curses = sys.modules[__name__]
+    nuqql.win.MAIN_WINS["screen"] = screen
+    nuqql.config.init_win(screen)
+    return screen
+
+
+def uninstall():
+    """
+    Make nuqql's windows use curses again
+    """
+
+    nuqql.win.curses = curses
+    STATE.screen = None
@@ -8,29 +8,82 @@ User Interface part of nuqql
 
 import curses
 import curses.ascii
-import datetime
+import os
+import select
+import sys
+import time
+
+from types import SimpleNamespace
 
 import nuqql.config
 import nuqql.conversation
 import nuqql.history
-
-
-def handle_message(backend, acc_id, tstamp, sender, msg):
+import nuqql.stats
+
+# timeout in ms when waiting for user input
+INPUT_TIMEOUT = 10
+
+# maximum number of pending keys processed in one main loop iteration
+INPUT_BATCH_SIZE = 4096
+
+# state of bulk ingest of collected messages, see handle_message()
+BULK = SimpleNamespace(
+    # conversations with messages that are not written, painted, and
+    # notified yet, in order of their first message -> number of messages
+    convs={},
+)
+
+# bracketed paste mode escape sequences
+PASTE_MODE_ON = "\033[?2004h"
+PASTE_MODE_OFF = "\033[?2004l"
+PASTE_START = "\033[200~"
+PASTE_END = "\033[201~"
+
+# state of waiting for user input; if the network thread is running, the
+# main loop waits for user input and for messages from the network thread
+INPUT = SimpleNamespace(
+    # file descriptor that becomes readable when messages are queued by the
+    # network thread, see set_wake_fd()
+    wake_fd=None,
+    # wait for user input? The asyncio event loop only reads user input if
+    # there is any, the main loop does not wait while backends have more
+    # messages, see set_blocking()
+    blocking=True,
+)
+
+# state of bracketed paste handling; a paste and its start/end markers can
+# be split over multiple main loop iterations
+PASTE = SimpleNamespace(
+    # currently inside a paste?
+    active=False,
+    # pasted text collected so far
+    text=[],
+    # unfinished escape sequence from previous iteration
+    pending=[],
+)
+
+
+def handle_message(backend, acc_id, tstamp, sender, msg, bulk=False):
     """
-    Handle message from backend
+    Handle message from backend. If bulk is True, e.g., while collecting
+    messages, the message is only added to its conversation; writing it to
+    the history, painting it, and notifying the user is left to flush_bulk()
     """
 
-    # convert timestamp
-    tstamp = datetime.datetime.fromtimestamp(tstamp)
-
     # look for an existing conversation and use it
     for conv in nuqql.conversation.CONVERSATIONS:
         if conv.backend is backend and \
            conv.account and conv.account.aid == acc_id and \
            conv.name == sender:
+            nuqql.stats.trace("route")
+
             # log message
-            log_msg = conv.log(conv.name, msg, tstamp=tstamp)
-            nuqql.history.log(conv, log_msg)
+            log_msg = conv.log(conv.name, msg, tstamp=tstamp,
+                               redraw=not bulk)
+            nuqql.history.log(conv, log_msg, bulk=bulk)
+            if bulk:
+                BULK.convs[conv] = BULK.convs.get(conv, 0) + 1
+                return
 
             # if window is not already active notify user
             if not conv.is_active():
@@ -38,7 +91,36 @@ def handle_message(backend, acc_id, tstamp, sender, msg):
             return
 
     # nothing found, log to main window
-    backend.conversation.log(sender, msg, tstamp=tstamp)
+    nuqql.stats.trace("route")
+    backend.conversation.log(sender, msg, tstamp=tstamp, redraw=not bulk)
+    if bulk:
+        conv = backend.conversation
+        BULK.convs[conv] = BULK.convs.get(conv, 0) + 1
+
+
+def flush_bulk():
+    """
+    Write, paint, and notify all messages ingested in bulk
+    """
+
+    if not BULK.convs:
+        return
+    nuqql.stats.count("ui.bulk_flushes")
+
+    notify = False
+    for conv, num in BULK.convs.items():
+        if conv.history.logger:
+            nuqql.history.flush_log(conv)
+        if conv.is_active():
+            conv.wins.log_win.redraw()
+        elif isinstance(conv, nuqql.conversation.BuddyConversation):
+            conv.notify(num, redraw=False)
+            notify = True
+    BULK.convs.clear()
+
+    # redraw list window with all notifications at once
+    if notify:
+        nuqql.win.MAIN_WINS["list"].redraw_pad()
 
 
 def update_buddy(buddy):
@@ -69,29 +151,169 @@ def add_buddy(buddy):
     conv.wins.list_win.redraw()
 
     # check if there are unread messages for this new buddy in the history
-    last_log_msg = nuqql.history.get_last_log_line(conv)
-    last_read_msg = nuqql.history.get_lastread(conv)
-    if last_log_msg:
-        if not last_read_msg or not last_log_msg.is_equal(last_read_msg):
-            # there are unread messages, notify user if
-            # conversation is inactive
-            if not conv.is_active():
-                conv.notify()
+    unread = nuqql.history.get_unread(conv)
+    if unread:
+        # there are unread messages, notify user if
+        # conversation is inactive
+        if not conv.is_active():
+            conv.notify(unread)
 
 
 def read_input():
     """
-    Read user input and return it to caller
+    Read all pending user input and return it to caller as a list
     """
 
-    # try to get input from user (timeout set in init())
+    screen = nuqql.win.MAIN_WINS["screen"]
+    chars = []
+
+    if INPUT.wake_fd is None and INPUT.blocking:
+        # try to get input from user (timeout set in start())
+        try:
+            chars.append(screen.get_wch())
+        except curses.error:
+            # no user input...
+            return chars
+    elif INPUT.wake_fd is not None:
+        # wait for user input or messages from the network thread, then
+        # read pending input; curses may also have buffered input already
+        wait_input()
+
+    # drain all other pending input without waiting
+    screen.nodelay(True)
     try:
-        wch = nuqql.win.MAIN_WINS["screen"].get_wch()
-    except curses.error:
-        # no user input...
-        wch = None
+        while len(chars) < INPUT_BATCH_SIZE:
+            try:
+                chars.append(screen.get_wch())
+            except curses.error:
+                break
+    finally:
+        screen.timeout(INPUT_TIMEOUT)
+
+    return chars
 
-    return wch
+
+def set_wake_fd(wake_fd):
+    """
+    Set file descriptor that wakes up the main loop while it is waiting for
+    user input, e.g., when the network thread queued messages
+    """
+
+    INPUT.wake_fd = wake_fd
+
+
+def set_blocking(blocking):
+    """
+    Set if reading user input waits for input
+    """
+
+    INPUT.blocking = blocking
+
+
+def wait_input():
+    """
+    Wait until there is user input or the wake file descriptor becomes
+    readable, at most INPUT_TIMEOUT ms
+    """
+
+    try:
+        reads, unused_writes, unused_errs = select.select(
+            [sys.stdin, INPUT.wake_fd], [], [], INPUT_TIMEOUT / 1000)
+    except InterruptedError:
+        return
+
+    # drain wake pipe
+    if INPUT.wake_fd in reads:
+        try:
+            while os.read(INPUT.wake_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def _match_sequence(chars, index, seq):
+    """
+    Helper that checks if the escape sequence seq starts at chars[index].
+    Return 1 if it matches completely, 0 if chars end with an incomplete
+    prefix of seq, and -1 if it does not match.
+    """
+
+    for offset, seq_char in enumerate(seq):
+        if index + offset >= len(chars):
+            return 0
+        if chars[index + offset] != seq_char:
+            return -1
+    return 1
+
+
+def split_paste(chars):
+    """
+    Split input characters into single keys and pasted texts. Return a list
+    of events; pasted texts are returned as tuples ("paste", text).
+    """
+
+    chars = PASTE.pending + chars
+    PASTE.pending = []
+    events = []
+    index = 0
+    while index < len(chars):
+        char = chars[index]
+
+        # inside a paste, only look for the end marker
+        if PASTE.active:
+            if char == PASTE_END[0]:
+                match = _match_sequence(chars, index, PASTE_END)
+                if match == 0:
+                    PASTE.pending = chars[index:]
+                    break
+                if match == 1:
+                    events.append(("paste", "".join(PASTE.text)))
+                    PASTE.active = False
+                    PASTE.text = []
+                    index += len(PASTE_END)
+                    continue
+            if isinstance(char, str):
+                PASTE.text.append(char)
+            index += 1
+            continue
+
+        # outside of a paste, look for the start marker. A single escape
+        # key at the end of the input is not held back, it is a normal key
+        if char == PASTE_START[0]:
+            match = _match_sequence(chars, index, PASTE_START)
+            if match == 0 and len(chars) - index > 1:
+                PASTE.pending = chars[index:]
+                break
+            if match == 1:
+                PASTE.active = True
+                index += len(PASTE_START)
+                continue
+        events.append(char)
+        index += 1
+
+    return events
+
+
+def handle_paste(text):
+    """
+    Insert pasted text into the input window of the active conversation as
+    one edit. If no conversation is active, e.g., in the list window, the
+    text is dropped. Return the input window or None if there is no active
+    conversation.
+    """
+
+    # terminals send line breaks in pastes as carriage returns
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+    # pasting is only supported in input windows, also if the conversation's
+    # log window is active; pasted text must not be interpreted as key
+    # commands, e.g., in the list window, and must not end up in a
+    # conversation the user opens later
+    for conv in nuqql.conversation.CONVERSATIONS:
+        if conv.is_active() and conv.wins.input_win:
+            conv.wins.input_win.insert_text(text)
+            return conv.wins.input_win
+    return None
 
 
 def show_terminal_warning():
@@ -130,34 +352,70 @@ def is_input_valid(char):
     return True
 
 
-def handle_input():
+def handle_input(chars=None):
     """
-    Read and handle user input
+    Read and handle all pending user input. If chars is given, it is used
+    as the input instead, see read_input()
     """
 
-    # wait for user input and get timeout or character to process
-    char = read_input()
+    # wait for user input and get all pending characters to process
+    if chars is None:
+        chars = read_input()
+    start = time.perf_counter()
+    events = split_paste(chars)
+
+    # handle user input, input windows are redrawn only once at the end
+    dirty = []
+    for event in events:
+        if isinstance(event, tuple):
+            win = handle_paste(event[1])
+        else:
+            if not is_input_valid(event):
+                # No valid input, continue with next input
+                continue
+            win = handle_char(event)
+            if win is False:
+                # user quit
+                return False
+        if win and win not in dirty:
+            dirty.append(win)
+
+    for win in dirty:
+        win.redraw_pad()
+
+    # stats: latency from reading keys until they are painted
+    if chars:
+        nuqql.stats.count("ui.keys", len(chars))
+        nuqql.stats.observe("ui.key_to_paint", time.perf_counter() - start)
+
+    return True
+
 
-    # handle user input
-    if not is_input_valid(char):
-        # No valid input, keep waiting for input
-        return True
+def handle_char(char):
+    """
+    Handle a single character of user input. Return the input window that
+    needs a redraw, None if there is no such window, or False if user quit.
+    """
 
     # if terminal size is not valid, stop here
     if not nuqql.config.WinConfig.is_terminal_valid():
         show_terminal_warning()
-        return True
+        return None
 
     # if terminal resized, resize and redraw active windows
     if char == curses.KEY_RESIZE:
         nuqql.conversation.resize_main_window()
-        return True
+        return None
 
-    # pass user input to active conversation
+    # pass user input to active conversation, defer input window redraw
     for conv in nuqql.conversation.CONVERSATIONS:
         if conv.is_active():
+            input_win = conv.wins.input_win
+            if input_win and input_win.state.active:
+                conv.process_input(char, redraw=False)
+                return input_win
             conv.process_input(char)
-            return True
+            return None
 
     # if no conversation is active pass input to active list window
     if nuqql.win.MAIN_WINS["list"].state.active:
@@ -165,7 +423,7 @@ def handle_input():
         nuqql.win.MAIN_WINS["input"].redraw()
         nuqql.win.MAIN_WINS["log"].redraw()
         nuqql.win.MAIN_WINS["list"].process_input(char)
-        return True
+        return None
 
     # list window is also inactive -> user quit
     return False
@@ -180,7 +438,7 @@ def start(stdscr, func):
     nuqql.win.MAIN_WINS["screen"] = stdscr
 
     # configuration
-    stdscr.timeout(10)
+    stdscr.timeout(INPUT_TIMEOUT)
 
     # clear everything
     stdscr.clear()
@@ -194,8 +452,25 @@ def start(stdscr, func):
         return "Terminal size invalid."
     nuqql.conversation.create_main_windows()
 
-    # run function provided by caller
-    return func()
+    # enable bracketed paste mode and run function provided by caller
+    set_paste_mode(True)
+    try:
+        return func()
+    finally:
+        set_paste_mode(False)
+
+
+def set_paste_mode(enable):
+    """
+    Enable or disable the terminal's bracketed paste mode
+    """
+
+    # curses owns the terminal, write the escape sequence through curses
+    if enable:
+        curses.putp(PASTE_MODE_ON.encode())
+    else:
+        curses.putp(PASTE_MODE_OFF.encode())
+    nuqql.win.MAIN_WINS["screen"].refresh()
 
 
 def init(func):
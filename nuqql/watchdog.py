@@ -0,0 +1,200 @@
+"""
+Watchdog: detect slow iterations and stalls of nuqql's main loop
+"""
+
+import sys
+import threading
+import time
+import traceback
+
+from types import SimpleNamespace
+
+import nuqql.conversation
+import nuqql.stats
+
+# duration in seconds of a main loop iteration that triggers a warning
+WATCHDOG_THRESHOLD = 0.2
+
+# duration in seconds of a main loop iteration that is considered a stall; a
+# stack sample of the main thread is taken while it is stalled
+WATCHDOG_STALL_TIME = 1
+
+# interval in seconds of the helper thread's stall checks
+WATCHDOG_CHECK_INTERVAL = 0.1
+
+# minimum interval in seconds between warnings, so slow iterations do not
+# flood the log
+WATCHDOG_WARN_INTERVAL = 5
+
+# state of the watchdog
+WATCHDOG = SimpleNamespace(
+    # helper thread and event for stopping it
+    thread=None,
+    stop=threading.Event(),
+    # id of the main thread
+    main_thread=None,
+    # number and start time of the current iteration
+    iteration=0,
+    iteration_start=None,
+    # current stage, its start time and durations of all stages
+    stage=None,
+    stage_start=None,
+    stage_times={},
+    # type of the last message handled in this iteration
+    msg_type=None,
+    # stack sample of a stalled iteration: (iteration, stage, stack)
+    sample=None,
+    # time of the last warning and number of suppressed warnings
+    last_warning=0,
+    suppressed=0,
+)
+
+
+def start():
+    """
+    Start the watchdog's helper thread that samples the stack of the main
+    thread when it is stalled. Must be called from the main thread.
+    """
+
+    WATCHDOG.main_thread = threading.get_ident()
+    WATCHDOG.stop.clear()
+    WATCHDOG.thread = threading.Thread(target=_run, daemon=True)
+    WATCHDOG.thread.start()
+
+
+def stop():
+    """
+    Stop the watchdog's helper thread
+    """
+
+    if WATCHDOG.thread is None:
+        return
+    WATCHDOG.stop.set()
+    WATCHDOG.thread.join()
+    WATCHDOG.thread = None
+
+
+def _run():
+    """
+    Helper thread: take a stack sample of the main thread once per stalled
+    iteration
+    """
+
+    while not WATCHDOG.stop.wait(WATCHDOG_CHECK_INTERVAL):
+        iteration = WATCHDOG.iteration
+        start_time = WATCHDOG.iteration_start
+        if start_time is None:
+            continue
+        if WATCHDOG.sample and WATCHDOG.sample[0] == iteration:
+            continue
+        if time.perf_counter() - start_time < WATCHDOG_STALL_TIME:
+            continue
+
+        # pylint: disable=protected-access
+        frame = sys._current_frames().get(WATCHDOG.main_thread)
+        if frame is None:
+            continue
+        stack = traceback.format_stack(frame)
+        WATCHDOG.sample = (iteration, WATCHDOG.stage, stack)
+
+
+def start_iteration():
+    """
+    Start timing a main loop iteration
+    """
+
+    now = time.perf_counter()
+    WATCHDOG.iteration += 1
+    WATCHDOG.iteration_start = now
+    WATCHDOG.stage = None
+    WATCHDOG.stage_start = now
+    WATCHDOG.stage_times = {}
+    WATCHDOG.msg_type = None
+
+
+def _end_stage(now):
+    """
+    Helper for ending the current stage at time now
+    """
+
+    if WATCHDOG.stage is None:
+        return
+    duration = now - WATCHDOG.stage_start
+    WATCHDOG.stage_times[WATCHDOG.stage] = duration
+    nuqql.stats.observe("main.stage." + WATCHDOG.stage, duration)
+
+
+def start_stage(stage):
+    """
+    Start timing stage of the current main loop iteration, ends the
+    previous stage
+    """
+
+    now = time.perf_counter()
+    _end_stage(now)
+    WATCHDOG.stage = stage
+    WATCHDOG.stage_start = now
+
+
+def set_msg_type(msg_type):
+    """
+    Set type of the message handled in the current stage
+    """
+
+    WATCHDOG.msg_type = msg_type
+
+
+def run_iteration(stage, func, *args):
+    """
+    Run func(*args) as a main loop iteration consisting of a single stage and
+    return its result, e.g., in a callback of the asyncio event loop
+    """
+
+    start_iteration()
+    start_stage(stage)
+    try:
+        return func(*args)
+    finally:
+        nuqql.stats.observe("main.loop_time", end_iteration())
+
+
+def end_iteration():
+    """
+    End timing the current main loop iteration, warn if it was slow, and
+    return its duration
+    """
+
+    now = time.perf_counter()
+    _end_stage(now)
+    duration = now - WATCHDOG.iteration_start
+    WATCHDOG.iteration_start = None
+
+    # stack sample of a stall in this iteration
+    sample = WATCHDOG.sample
+    if sample and sample[0] == WATCHDOG.iteration:
+        text = "watchdog: main loop stalled for {:.3f} s in {}, " \
+            "stack:\n".format(duration, sample[1])
+        text += "".join(sample[2]).rstrip()
+        nuqql.conversation.log_main_window(text)
+        return duration
+
+    if duration < WATCHDOG_THRESHOLD:
+        return duration
+
+    # rate limit warnings
+    if time.time() - WATCHDOG.last_warning < WATCHDOG_WARN_INTERVAL:
+        WATCHDOG.suppressed += 1
+        return duration
+    WATCHDOG.last_warning = time.time()
+
+    # warn about slowest stage and message type
+    stage = max(WATCHDOG.stage_times, key=WATCHDOG.stage_times.get)
+    text = "watchdog: slow main loop iteration {:.3f} s, {} took {:.3f} s" \
+        .format(duration, stage, WATCHDOG.stage_times[stage])
+    if WATCHDOG.msg_type:
+        text += " (last message: {})".format(WATCHDOG.msg_type)
+    if WATCHDOG.suppressed:
+        text += ", {} more slow iterations".format(WATCHDOG.suppressed)
+        WATCHDOG.suppressed = 0
+    nuqql.conversation.log_main_window(text)
+    return duration
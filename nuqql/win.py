@@ -3,10 +3,12 @@ Nuqql UI Windows
 """
 
 import curses
-import math
 
 from types import SimpleNamespace
 
+import nuqql.history
+import nuqql.stats
+
 # screen and main windows
 MAIN_WINS = {}
 
@@ -48,6 +50,10 @@ class Win:
         self.keyfunc = {}
         self._init_keyfunc()
 
+        # stats counter names for redraws of this window type
+        self.stats_redraw = "win.redraw." + type(self).__name__
+        self.stats_redraw_pad = "win.redraw_pad." + type(self).__name__
+
     def _redraw_win(self):
         """
         Redraw entire window
@@ -146,6 +152,7 @@ class Win:
         Redraw the window
         """
 
+        nuqql.stats.count(self.stats_redraw)
         self._redraw_win()
         self.redraw_pad()
 
@@ -331,6 +338,8 @@ class ListWin(Win):
         Redraw pad in window
         """
 
+        nuqql.stats.count(self.stats_redraw_pad)
+
         # if terminal size is invalid, stop here
         if not self.config.is_terminal_valid():
             return
@@ -485,7 +494,7 @@ class LogWin(Win):
         self.zoomed = False
 
         # list entries/message log
-        self.list = []
+        self.list = nuqql.history.LogStore()
 
     def add(self, entry):
         """
@@ -515,26 +524,20 @@ class LogWin(Win):
         many lines each message uses.
         """
 
-        lines = 0
-        for msg in self.list:
-            parts = msg.read(mark_read=False).split("\n")
-            lines += len(parts) - 1
-            for part in parts:
-                if len(part) >= pad_size_x:
-                    lines += math.floor(len(part) / pad_size_x)
-        return lines
+        return self.list.get_num_lines(pad_size_x)
 
     def _print_log(self, props):
         """
         dump log messages and resize pad according to new lines added
         """
 
-        # make sure lines fit into pad
+        # make sure lines fit into pad; formatted messages and their number
+        # of lines are cached in the log
         lines = self._get_num_log_lines(props.pad_size_x)
         if lines >= props.pad_size_y:
             self.pad.resize(lines + 1, props.pad_size_x)
 
-        for msg in self.list:
+        for text, own, is_read in self.list.iter_lines():
             # define colors for own and buddy's messages
             # TODO: move all color definitions to config part?
             curses.init_pair(3, curses.COLOR_YELLOW, curses.COLOR_BLACK)
@@ -543,9 +546,9 @@ class LogWin(Win):
             # set colors and attributes for message:
             # * unread messages are bold
             # * read messages are normal
-            if not msg.own:
+            if not own:
                 # message from buddy
-                if msg.is_read:
+                if is_read:
                     # old message
                     self.pad.attroff(curses.A_BOLD)
                     self.pad.attron(curses.color_pair(3) | curses.A_NORMAL)
@@ -555,7 +558,7 @@ class LogWin(Win):
                     self.pad.attron(curses.color_pair(3) | curses.A_BOLD)
             else:
                 # message from you
-                if msg.is_read:
+                if is_read:
                     # old message
                     self.pad.attroff(curses.A_BOLD)
                     self.pad.attron(curses.color_pair(4) | curses.A_NORMAL)
@@ -565,7 +568,10 @@ class LogWin(Win):
                     self.pad.attron(curses.color_pair(4) | curses.A_BOLD)
 
             # output message
-            self.pad.addstr(msg.read())
+            self.pad.addstr(text)
+
+        # all messages have now been read
+        self.list.mark_all_read()
 
     def _get_properties(self):
         """
@@ -605,6 +611,8 @@ class LogWin(Win):
                          props.pos_x + props.win_size_x - props.pad_x_delta)
 
     def redraw_pad(self):
+        nuqql.stats.count(self.stats_redraw_pad)
+
         # if terminal size is invalid, stop here
         if not self.config.is_terminal_valid():
             return
@@ -628,10 +636,32 @@ class LogWin(Win):
         # check if visible part of pad needs to be moved and display it
         self.state.cur_y, self.state.cur_x = self.pad.getyx()
         self._pad_refresh(props)
+        nuqql.stats.trace("paint")
+
+    def _load_older(self):
+        """
+        Helper for loading older messages into the log, e.g., from the
+        scrollback file, if the cursor is on the first line. Afterwards, the
+        cursor is on the line that was the first line before.
+        """
+
+        if self.state.cur_y > 0:
+            return
+        num = self.list.load_older()
+        if not num:
+            return
+
+        # redraw log and move cursor to the previous first line
+        self.redraw_pad()
+        props = self._get_properties()
+        lines = self.list.get_num_lines(props.pad_size_x, num)
+        self.pad.move(lines, 0)
+        self.state.cur_y, self.state.cur_x = self.pad.getyx()
 
     def _cursor_msg_start(self, *args):
         # TODO: use other method and keybind with more fitting name?
         # jump to first line in log
+        self._load_older()
         if self.state.cur_y > 0 or self.state.cur_x > 0:
             self.pad.move(0, 0)
             props = self._get_properties()
@@ -649,6 +679,7 @@ class LogWin(Win):
     def _cursor_line_start(self, *args):
         # TODO: use other method and keybind with more fitting name?
         # move cursor up one page until first entry in log
+        self._load_older()
         props = self._get_properties()
         if self.state.cur_y > 0:
             if self.state.cur_y - (props.win_size_y - props.pad_y_delta) >= 0:
@@ -674,6 +705,7 @@ class LogWin(Win):
 
     def _cursor_up(self, *args):
         # move cursor up until first entry in list
+        self._load_older()
         if self.state.cur_y > 0:
             self.pad.move(self.state.cur_y - 1, self.state.cur_x)
             self.state.cur_y, self.state.cur_x = self.pad.getyx()
@@ -757,6 +789,8 @@ class InputWin(Win):
         self.msg = ""
 
     def redraw_pad(self):
+        nuqql.stats.count(self.stats_redraw_pad)
+
         # if terminal size is invalid, stop here
         if not self.config.is_terminal_valid():
             return
@@ -912,7 +946,44 @@ class InputWin(Win):
         self.state.active = False
         self.conversation.wins.log_win.state.active = True
 
-    def process_input(self, char):
+    def insert_text(self, text):
+        """
+        Insert text at the cursor position as a single edit, e.g., for pasted
+        text. The caller is responsible for redrawing the pad.
+        """
+
+        if text == "":
+            return
+
+        # insert text into current line
+        segments = self.msg.split("\n")
+        self.state.cur_y, self.state.cur_x = self.pad.getyx()
+        line = segments[self.state.cur_y]
+        segments[self.state.cur_y] = line[:self.state.cur_x] + text + \
+            line[self.state.cur_x:]
+        self.msg = "\n".join(segments)
+
+        # determine new cursor position
+        text_lines = text.split("\n")
+        new_y = self.state.cur_y + len(text_lines) - 1
+        new_x = len(text_lines[-1])
+        if len(text_lines) == 1:
+            new_x += self.state.cur_x
+
+        # make sure new message fits in the pad
+        segments = self.msg.split("\n")
+        pad_size_y, pad_size_x = self.pad.getmaxyx()
+        new_size_y = max(pad_size_y, len(segments) + 1)
+        new_size_x = max(pad_size_x, max(len(seg) for seg in segments) + 2)
+        if new_size_y != pad_size_y or new_size_x != pad_size_x:
+            self.pad.resize(new_size_y, new_size_x)
+
+        # output new message in pad and move cursor to new position
+        self.pad.erase()
+        self.pad.addstr(self.msg)
+        self.pad.move(new_y, new_x)
+
+    def process_input(self, char, redraw=True):
         """
         Process user input (character)
         """
@@ -956,4 +1027,5 @@ class InputWin(Win):
             else:
                 self.pad.move(self.state.cur_y, self.state.cur_x + 1)
         # display changes in the pad
-        self.redraw_pad()
+        if redraw:
+            self.redraw_pad()